@@ -0,0 +1,67 @@
+"""
+Fixtures for the pipeline benchmarks: synthetic rasters generated offline, and a mocked S3 bucket
+
+Rasters are generated at each of BENCHMARK_SIZES pixels square, which can be overridden with a comma separated
+VECT_BENCHMARK_SIZES environment variable, and at each fragmentation level.
+"""
+import os
+
+import boto3
+import pytest
+from moto import mock_s3
+
+from dea_vectoriser.profiling import profile_scene
+
+from synthetic import FRAGMENTATION, synthetic_burn_index, synthetic_wos
+
+BENCHMARK_SIZES = [int(size) for size in os.environ.get('VECT_BENCHMARK_SIZES', '512,2048').split(',')]
+
+BUCKET = 'benchmark-bucket'
+
+
+@pytest.fixture(scope='session', params=BENCHMARK_SIZES, ids=lambda size: f'{size}px')
+def size(request):
+    return request.param
+
+
+@pytest.fixture(scope='session', params=list(FRAGMENTATION))
+def fragmentation(request):
+    return request.param
+
+
+@pytest.fixture(scope='session')
+def wos_dataset(size, fragmentation):
+    return synthetic_wos(size, FRAGMENTATION[fragmentation])
+
+
+@pytest.fixture(scope='session')
+def burn_datasets(size, fragmentation):
+    return [synthetic_burn_index(size, FRAGMENTATION[fragmentation], seed) for seed in range(3)]
+
+
+@pytest.fixture
+def s3_bucket(monkeypatch):
+    for name in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SECURITY_TOKEN', 'AWS_SESSION_TOKEN'):
+        monkeypatch.setenv(name, 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with mock_s3():
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket=BUCKET)
+        yield BUCKET
+
+
+@pytest.fixture
+def record(benchmark):
+    """Benchmark a function, then record its peak memory and, given the pixels it processed, its throughput"""
+
+    def run(func, *args, pixels=None, **kwargs):
+        result = benchmark(func, *args, **kwargs)
+
+        with profile_scene('benchmark', metrics=()) as profile:
+            func(*args, **kwargs)
+        benchmark.extra_info['peak_rss_bytes'] = profile.total['peak_rss_bytes']
+
+        if pixels and benchmark.stats is not None:
+            benchmark.extra_info['megapixels_per_second'] = pixels / 1e6 / benchmark.stats.stats.mean
+        return result
+
+    return run
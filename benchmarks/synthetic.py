@@ -0,0 +1,38 @@
+"""
+Synthetic rasters for benchmarking, generated offline
+
+A fragmented raster has many small features, so produces many more polygons and vertices from the same number of
+pixels.
+"""
+import numpy as np
+import xarray as xr
+from rasterio.transform import from_origin
+
+# Fragmentation level: size in pixels of the blocks features are built from
+FRAGMENTATION = {'low': 64, 'high': 4}
+
+TRANSFORM = from_origin(600000, 7000000, 10, 10)
+CRS = 'EPSG:32753'
+
+
+def blocky(size: int, block: int, seed: int) -> np.ndarray:
+    """Uniform random values in [0, 1), constant over `block` pixel squares"""
+    rng = np.random.default_rng(seed)
+    coarse = rng.random((size // block + 1, size // block + 1), dtype='float32')
+    return np.kron(coarse, np.ones((block, block), dtype='float32'))[:size, :size]
+
+
+def synthetic_wos(size: int, block: int) -> xr.Dataset:
+    """A water observation raster of mostly dry pixels, with water bodies and masked (cloud) areas"""
+    values = blocky(size, block, seed=0)
+    wo = np.zeros((size, size), dtype=np.uint8)
+    wo[values > 0.75] = 128
+    wo[values < 0.1] = 64
+    return xr.Dataset({'wo': (('y', 'x'), wo)})
+
+
+def synthetic_burn_index(size: int, block: int, seed: int) -> xr.Dataset:
+    """A burn index raster in the layout of load_burn_data(), with values around the burn thresholds"""
+    rng = np.random.default_rng(seed)
+    values = blocky(size, block, seed) * 0.4 - 0.1 + rng.normal(0, 0.02, (size, size)).astype('float32')
+    return xr.Dataset({1: (('y', 'x'), values)})
@@ -0,0 +1,111 @@
+"""
+Benchmarks of the hot paths of the vectoriser pipeline, on synthetic rasters
+
+Run with:
+
+    pytest benchmarks [--benchmark-autosave] [--benchmark-compare]
+
+Each benchmark records its peak RSS, and where it processes a raster its throughput in megapixels per second, in
+the benchmark's extra_info. Saved runs can be compared with `pytest-benchmark compare`, or a run failed if it is
+slower than a saved one with eg. `--benchmark-compare-fail=mean:10%`.
+
+Benchmarks comparing alternatives are grouped, eg. vectorise_data() against its original float32 implementation, and
+the output formats by the time to read a small area of them.
+"""
+import geopandas as gp
+import numpy as np
+import pytest
+import rasterio.features
+import shapely
+from shapely.geometry import shape
+
+from dea_vectoriser.vector_burnArea import generate_burn_area
+from dea_vectoriser.vector_wos import generate_raster_layers
+from dea_vectoriser.vectorise import OUTPUT_FORMATS, save_vector_to_s3, vectorise_data, write_vector
+
+from synthetic import CRS, TRANSFORM
+
+pytest.importorskip('pytest_benchmark')
+
+
+@pytest.fixture(scope='session')
+def water_layer(wos_dataset):
+    water, _ = generate_raster_layers(wos_dataset)
+    return water
+
+
+@pytest.fixture(scope='session')
+def water_vectors(water_layer):
+    return vectorise_data(water_layer, TRANSFORM, CRS, label='Water')
+
+
+def test_generate_raster_layers(record, wos_dataset):
+    record(generate_raster_layers, wos_dataset, pixels=wos_dataset.wo.size)
+
+
+def test_generate_burn_area(record, burn_datasets):
+    record(generate_burn_area, *burn_datasets, pixels=burn_datasets[0][1].size)
+
+
+def _original_vectorise_data(data_array, transform, crs, label='Label'):
+    """vectorise_data() as it was, converting the raster to float32 twice"""
+    vector = rasterio.features.shapes(
+        data_array.data.astype('float32'),
+        mask=data_array.data.astype('float32') == 1,
+        transform=transform)
+    polygons = [shape(polygon) for polygon, value in vector]
+    return gp.GeoDataFrame(data={'attribute': [label] * len(polygons)}, geometry=polygons, crs=crs)
+
+
+@pytest.mark.parametrize('implementation', [vectorise_data, _original_vectorise_data],
+                         ids=['current', 'original'])
+def test_vectorise_data(record, benchmark, size, fragmentation, water_layer, implementation):
+    benchmark.group = f'vectorise_data {size}px {fragmentation}'
+    vectors = record(implementation, water_layer, TRANSFORM, CRS, label='Water', pixels=water_layer.size)
+    assert not vectors.empty
+
+
+def test_simplify(record, benchmark, water_vectors):
+    benchmark.extra_info['polygons'] = len(water_vectors)
+    record(water_vectors.simplify, 10)
+
+
+@pytest.mark.parametrize('output_format', ['GeoJSON', 'GPKG', 'FlatGeobuf'])
+def test_save_vector_to_s3(record, benchmark, s3_bucket, water_vectors, output_format):
+    benchmark.extra_info['polygons'] = len(water_vectors)
+    vectors = gp.GeoDataFrame(water_vectors)
+    record(save_vector_to_s3, vectors, f's3://{s3_bucket}/benchmark', 'water', output_format=output_format)
+
+
+def _read_area(path, output_format, bbox):
+    """Read the features intersecting `bbox` (minx, miny, maxx, maxy), through the format's spatial index"""
+    if output_format != 'GeoParquet':
+        return gp.read_file(path, bbox=bbox)
+
+    import pyarrow.parquet as pq
+    minx, miny, maxx, maxy = bbox
+    table = pq.read_table(path, filters=[('bbox_xmin', '<=', maxx), ('bbox_xmax', '>=', minx),
+                                         ('bbox_ymin', '<=', maxy), ('bbox_ymax', '>=', miny)])
+    return gp.GeoSeries(shapely.from_wkb(table.column('geometry').to_numpy()))
+
+
+@pytest.mark.parametrize('output_format', ['GPKG', 'FlatGeobuf', 'GeoParquet'])
+def test_read_area(benchmark, tmp_path, size, fragmentation, water_vectors, output_format):
+    """Time reading the features in a square 2% of the width of the scene, averaged over 20 squares
+
+    Only local reads are timed, on S3 the indexed formats turn the same reads into a few ranged GETs instead of
+    downloading the whole object.
+    """
+    if output_format == 'GeoParquet':
+        pytest.importorskip('pyarrow')
+    path = tmp_path / f'vectors{OUTPUT_FORMATS[output_format]}'
+    write_vector(water_vectors.astype({'attribute': str}), path, output_format)
+    benchmark.extra_info['file_bytes'] = path.stat().st_size
+
+    minx, miny, maxx, maxy = water_vectors.total_bounds
+    width = (maxx - minx) / 50
+    corners = np.random.default_rng(1).random((20, 2)) * [maxx - minx - width, maxy - miny - width] + [minx, miny]
+    bboxes = [(x, y, x + width, y + width) for x, y in corners]
+
+    benchmark.group = f'read_area {size}px {fragmentation}'
+    benchmark(lambda: [_read_area(path, output_format, bbox) for bbox in bboxes])
@@ -7,27 +7,44 @@ It supports:
 - Reading STAC documents from an SQS
 - Running directly on a list of S3 STAC Documents
 """
-import boto3
 import click
+import json
 import logging
 import logging.config
-from typing import Optional
-
-from dea_vectoriser.utils import (asset_url_from_stac, load_document_from_s3,
-                                  output_name_from_url, publish_sns_message,
-                                  receive_messages, stac_to_msg_and_attributes, load_message)
-from dea_vectoriser.vector_wos import vectorise_wos
-from dea_vectoriser.vector_burnArea import vectorise_burn
-from dea_vectoriser.vectorise import OUTPUT_FORMATS, save_vector_to_s3
-import dea_vectoriser
+import time
+from concurrent import futures
+from contextlib import nullcontext
+from functools import partial
+from typing import Callable, Optional, Sequence, Tuple
+
+import geopandas as gp
+import shapely
+from pyproj import Transformer
+
+from dea_vectoriser.utils import (input_fingerprint, load_document_from_s3, object_metadata, publish_sns_message,
+                                  receive_message_batches, stac_to_msg_and_attributes, load_message,
+                                  MessageDeleter, MessageSender, SnsNotifier, VisibilityHeartbeat)
+from dea_vectoriser.raster_io import MAX_RESOLUTION_LEVEL
+from dea_vectoriser.vector_burnArea import DEFAULT_THREADS
+from dea_vectoriser.vectorisers import VECTORISERS, get_vectoriser, plan_workers
+from dea_vectoriser.vectorise import OUTPUT_FORMATS, save_vector_to_s3, vector_output_url
+from dea_vectoriser import raster_cache
+from dea_vectoriser.manifest import DONE, FAILED, Manifest
+from dea_vectoriser.profiling import METRICS_FORMATS, count, profile_scene, stage
 
 DEFAULT_DESTINATION = 's3://dea-public-data-dev/carsa/vector_wos/'
 
+# --skip-existing modes: always convert, skip if the output exists, or skip if it exists and was created from the
+# same input objects
+SKIP_NEVER, SKIP_EXISTS, SKIP_UNCHANGED = 'never', 'exists', 'unchanged'
+
+# S3 user metadata key of the input_fingerprint() of the rasters an output was created from
+FINGERPRINT_METADATA_KEY = 'input-fingerprint'
+
+# Log progress of s3-to-sqs every this many documents
+PROGRESS_INTERVAL = 1000
+
 LOG = logging.getLogger(__name__)
-ALGORITHMS = {
-    'wofs': dea_vectoriser.vector_wos.vectorise_wos,
-    'burns': dea_vectoriser.vector_burnArea.vectorise_burn,
-}
 
 def _validate_destination(ctx, param, value):
     if not value.startswith('s3://'):
@@ -61,12 +78,97 @@ algorithm_option = click.option('--algorithm',
                                 envvar='VECT_ALGORITHM',
                                 default='wofs',
                                 show_default=True,
-                                type=click.Choice(ALGORITHMS.keys())
+                                type=click.Choice(VECTORISERS.keys())
                                 )
+tile_size_option = click.option('--tile-size',
+                                envvar='VECT_TILE_SIZE',
+                                type=click.IntRange(min=256),
+                                help='Process rasters in tiles of this many pixels square, to bound memory use. '
+                                     'Default is to load whole rasters')
+threads_option = click.option('--threads',
+                              envvar='VECT_THREADS',
+                              default=DEFAULT_THREADS,
+                              show_default=True,
+                              type=click.IntRange(min=1),
+                              help='Number of threads the burns algorithm loads and processes its rasters with')
+simplify_native_option = click.option('--simplify-native/--no-simplify-native',
+                                      envvar='VECT_SIMPLIFY_NATIVE',
+                                      default=False,
+                                      show_default=True,
+                                      help='Simplify in the raster CRS before reprojecting, rather than after. Much '
+                                           'faster on dense polygons, but vertices on the edge of the tolerance '
+                                           'may differ')
+include_agreement_option = click.option('--include-agreement/--no-include-agreement',
+                                        envvar='VECT_INCLUDE_AGREEMENT',
+                                        default=False,
+                                        show_default=True,
+                                        help='Also output the levels of agreement between the burns algorithm\'s '
+                                             'three burn models')
+resolution_level_option = click.option('--resolution-level',
+                                       envvar='VECT_RESOLUTION_LEVEL',
+                                       default=0,
+                                       show_default=True,
+                                       type=click.IntRange(0, MAX_RESOLUTION_LEVEL),
+                                       help='Create a low detail preview from rasters decimated by 2 ** this, read '
+                                            'from their COG overviews, with the morphology and simplification '
+                                            "scaled to match. Written alongside the full output, eg. '_preview4x'. "
+                                            'Previews are never tiled')
+pyramid_tolerance_option = click.option('--pyramid-tolerance',
+                                        envvar='VECT_PYRAMID_TOLERANCES',
+                                        multiple=True,
+                                        type=click.FloatRange(min=0, min_open=True),
+                                        help='Also write the vectors simplified at this tolerance in metres, for a '
+                                             'lower zoom level. Each is a layer of the GPKG named eg. '
+                                             "'simplified_50m', or for other formats a separate object with that "
+                                             'suffix. Repeat for a pyramid of levels')
+skip_existing_option = click.option('--skip-existing',
+                                    envvar='VECT_SKIP_EXISTING',
+                                    default=SKIP_NEVER,
+                                    show_default=True,
+                                    type=click.Choice([SKIP_NEVER, SKIP_EXISTS, SKIP_UNCHANGED]),
+                                    help="Skip documents whose output already exists, before reading any rasters. "
+                                         "'unchanged' also requires the input rasters' ETags to match those the "
+                                         "output was created from")
+metrics_option = click.option('--metrics',
+                              envvar='VECT_METRICS',
+                              default=['json'],
+                              show_default=True,
+                              multiple=True,
+                              type=click.Choice(METRICS_FORMATS),
+                              help='Formats to report the time and memory used by each stage of each scene in. '
+                                   'json is logged, emf (CloudWatch Embedded Metric Format) is printed to stdout, '
+                                   'and prometheus is written to --metrics-dir. Repeat for several formats')
+metrics_dir_option = click.option('--metrics-dir',
+                                  envvar='VECT_METRICS_DIR',
+                                  type=click.Path(file_okay=False, exists=True, writable=True),
+                                  help='Directory to write Prometheus text files into, one per process, eg. for '
+                                       "node_exporter's textfile collector")
+
+
+def _validate_metrics(metrics, metrics_dir):
+    if 'prometheus' in metrics and not metrics_dir:
+        raise click.BadOptionUsage(option_name='--metrics-dir', message='--metrics-dir is required for prometheus')
+
+
+def _algorithm_options(algorithm, tile_size, threads, simplify_native, include_agreement, resolution_level):
+    """Collect the command line options which the vectoriser algorithm accepts, to pass through to it"""
+    options = {'tile_size': tile_size, 'threads': threads, 'simplify_native': simplify_native,
+               'include_agreement': include_agreement, 'resolution_level': resolution_level}
+    return {name: value for name, value in options.items() if name in get_vectoriser(algorithm).options}
 
 
 @click.group()
-def cli():
+@click.option('--raster-cache-dir',
+              envvar='VECT_RASTER_CACHE_DIR',
+              type=click.Path(file_okay=False),
+              help='Cache downloaded rasters in this directory, to be reused by later runs over the same scenes')
+@click.option('--raster-cache-bytes',
+              envvar='VECT_RASTER_CACHE_BYTES',
+              default=raster_cache.DEFAULT_MAX_BYTES,
+              show_default=True,
+              type=click.IntRange(min=0),
+              help='Evict the least recently used rasters once the cache is larger than this')
+def cli(raster_cache_dir, raster_cache_bytes):
     logging_config = {
         'version': 1,
         'disable_existing_loggers': False,
@@ -108,6 +210,7 @@ def cli():
     }
 
     logging.config.dictConfig(logging_config)
+    raster_cache.configure(raster_cache_dir, raster_cache_bytes)
 
 
 @cli.command()
@@ -115,19 +218,169 @@ def cli():
 @format_option
 @sns_topic_option
 @algorithm_option
+@tile_size_option
+@threads_option
+@simplify_native_option
+@include_agreement_option
+@resolution_level_option
+@pyramid_tolerance_option
+@skip_existing_option
+@metrics_option
+@metrics_dir_option
+@click.option('--workers',
+              envvar='VECT_WORKERS',
+              default=1,
+              show_default=True,
+              type=click.IntRange(min=1),
+              help='Number of worker processes to convert messages with')
+@click.option('--visibility-timeout',
+              envvar='VECT_VISIBILITY_TIMEOUT',
+              default=300,
+              show_default=True,
+              type=click.IntRange(min=30),
+              help='Seconds to keep in flight messages hidden, extended while they are processed')
+@click.option('--batch-size',
+              envvar='VECT_BATCH_SIZE',
+              default=10,
+              show_default=True,
+              type=click.IntRange(1, 10),
+              help='Maximum number of messages to receive per SQS request')
+@click.option('--wait-time-seconds',
+              envvar='VECT_WAIT_TIME_SECONDS',
+              default=20,
+              show_default=True,
+              type=click.IntRange(0, 20),
+              help='Seconds to long poll SQS for messages')
+@click.option('--max-empty-receives',
+              envvar='VECT_MAX_EMPTY_RECEIVES',
+              default=1,
+              show_default=True,
+              type=click.IntRange(min=0),
+              help='Exit after this many consecutive receives return no messages. 0 to never exit')
 @click.argument('queue_url', envvar='VECT_SQS_URL')
-def process_sqs_messages(queue_url, destination, output_format, algorithm, sns_topic):
+def process_sqs_messages(queue_url, destination, output_format, algorithm, sns_topic, tile_size, threads,
+                         simplify_native, include_agreement, resolution_level, pyramid_tolerance, skip_existing,
+                         metrics, metrics_dir, workers, visibility_timeout, batch_size, wait_time_seconds,
+                         max_empty_receives):
     """Read STAC documents from an SQS Queue continuously and convert to vector format.
 
-    The queue will be read from continuously until empty.
+    The queue will be read from until it has been empty for `--max-empty-receives` consecutive long polls. Messages
+    which fail to convert are logged and left to reappear on the queue.
     """
+    _validate_metrics(metrics, metrics_dir)
     LOG.info(f'Processing messages from SQS: {queue_url}')
-    for message in receive_messages(queue_url):
-        stac_document = load_message(message)
-
-        vector_convert(stac_document, destination, output_format, algorithm, sns_topic)
-
-        message.delete()
+    batches = receive_message_batches(queue_url,
+                                      batch_size=batch_size,
+                                      wait_time_seconds=wait_time_seconds,
+                                      max_empty_receives=max_empty_receives or None,
+                                      yield_empty=True)
+    convert = partial(vector_convert, destination=destination, output_format=output_format, algorithm=algorithm,
+                      sns_topic=sns_topic, skip_existing=skip_existing, pyramid_tolerances=pyramid_tolerance,
+                      metrics=metrics, metrics_dir=metrics_dir,
+                      **_algorithm_options(algorithm, tile_size, threads, simplify_native, include_agreement,
+                                           resolution_level))
+
+    with VisibilityHeartbeat(visibility_timeout, interval=visibility_timeout // 3) as heartbeat, \
+            MessageDeleter(queue_url, heartbeat) as deleter, \
+            (SnsNotifier(sns_topic) if sns_topic else nullcontext()) as notifier:
+        notify = notifier.add if notifier is not None else None
+        workers = plan_workers(get_vectoriser(algorithm), workers, tile_size, resolution_level=resolution_level)
+        if workers > 1:
+            process_messages_in_pool(batches, workers, heartbeat, deleter, convert, notify)
+        else:
+            process_messages_serially(batches, heartbeat, deleter, convert, notify)
+
+    _check_notifications(notifier)
+
+
+def process_messages_serially(batches, heartbeat, deleter, convert, notify=None):
+    """Convert batches of SQS messages one at a time in this process, see :func:`process_messages_in_pool`"""
+    for messages in batches:
+        if not messages:
+            # The queue is idle, don't hold on to the receipts of messages already processed
+            deleter.flush()
+            continue
+
+        for message in messages:
+            heartbeat.add(message)
+
+        for message in messages:
+            try:
+                convert(load_message(message), notify=notify)
+            except Exception:  # pylint: disable=broad-except
+                LOG.exception(f'Failed to process message {message.message_id}, leaving it on the queue')
+                heartbeat.remove(message)
+            else:
+                deleter.add(message)
+
+
+def process_messages_in_pool(batches, workers, heartbeat, deleter, convert, notify=None):
+    """Convert batches of SQS messages using a pool of worker processes
+
+    `convert` is called with each STAC document, and must be picklable. Notifications from the workers are passed
+    to `notify` in this process.
+
+    Messages are prefetched until twice as many as there are workers are in flight, so that a worker never waits
+    on SQS. The visibility timeout of every in flight message is extended by `heartbeat`, and each message is only
+    passed to `deleter` once its vector has been uploaded. Messages which fail are left to reappear on the queue.
+    """
+    prefetch = workers * 2
+    in_flight = {}
+
+    def finish(done):
+        for future in done:
+            message = in_flight.pop(future)
+            try:
+                _, notifications = future.result()
+            except Exception:  # pylint: disable=broad-except
+                LOG.exception(f'Failed to process message {message.message_id}, leaving it on the queue')
+                heartbeat.remove(message)
+            else:
+                _forward(notifications, notify)
+                deleter.add(message)
+
+    with futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        for messages in batches:
+            for message in messages:
+                heartbeat.add(message)
+                try:
+                    stac_document = load_message(message)
+                except Exception:  # pylint: disable=broad-except
+                    LOG.exception(f'Failed to load message {message.message_id}, leaving it on the queue')
+                    heartbeat.remove(message)
+                    continue
+                in_flight[executor.submit(_collecting_notifications, convert, stac_document)] = message
+
+            # Collect whatever has finished since the last receive, which may have come back empty
+            finish(futures.wait(in_flight, timeout=0).done)
+            if not messages:
+                deleter.flush()
+
+            while len(in_flight) >= prefetch:
+                done, _ = futures.wait(in_flight, return_when=futures.FIRST_COMPLETED)
+                finish(done)
+
+        finish(futures.wait(in_flight).done)
+
+
+def _check_notifications(notifier: Optional[SnsNotifier]):
+    """Fail the command if any SNS notifications couldn't be published. Each has already been logged"""
+    if notifier is not None and notifier.failed:
+        raise click.ClickException(f'{len(notifier.failed)} SNS notifications could not be published')
+
+
+def _collecting_notifications(convert, *args):
+    """Call `convert` in a worker process, returning its result and the notifications it made, to be published by
+    the parent process"""
+    notifications = []
+    result = convert(*args, notify=lambda message, attributes: notifications.append((message, attributes)))
+    return result, notifications
+
+
+def _forward(notifications, notify):
+    if notify is not None:
+        for message, attributes in notifications:
+            notify(message, attributes)
 
 
 @cli.command()
@@ -135,89 +388,281 @@ def process_sqs_messages(queue_url, destination, output_format, algorithm, sns_t
 @format_option
 @sns_topic_option
 @algorithm_option
+@tile_size_option
+@threads_option
+@simplify_native_option
+@include_agreement_option
+@resolution_level_option
+@pyramid_tolerance_option
+@skip_existing_option
+@metrics_option
+@metrics_dir_option
+@click.option('--jobs',
+              envvar='VECT_JOBS',
+              default=1,
+              show_default=True,
+              type=click.IntRange(min=1),
+              help='Number of documents to process in parallel, each in its own process')
+@click.option('--manifest',
+              type=click.Path(dir_okay=False, writable=True),
+              help='Record the status of each document in this local file. Documents it records as done are '
+                   'skipped, so an interrupted run can be resumed by rerunning the same command')
 @click.argument('s3_urls', nargs=-1)
-def run_from_s3_url(s3_urls, destination, output_format, algorithm, sns_topic):
+def run_from_s3_url(s3_urls, destination, output_format, algorithm, sns_topic, tile_size, threads, simplify_native,
+                    include_agreement, resolution_level, pyramid_tolerance, skip_existing, metrics, metrics_dir, jobs,
+                    manifest):
     """Convert WO dataset/s to Vector format and upload to S3
 
     S3_URLs should be one or more paths to STAC documents.
     """
-    LOG.info(f'Processing {len(s3_urls)} S3 paths')
-    for s3_url in s3_urls:
-        LOG.info(f"Processing {s3_url}")
-
-        stac_document = load_document_from_s3(s3_url)
-
-        vector_convert(stac_document, destination, output_format, algorithm, sns_topic)
+    _validate_metrics(metrics, metrics_dir)
+    convert = partial(convert_s3_url, destination=destination, output_format=output_format, algorithm=algorithm,
+                      sns_topic=sns_topic, skip_existing=skip_existing, pyramid_tolerances=pyramid_tolerance,
+                      metrics=metrics, metrics_dir=metrics_dir,
+                      **_algorithm_options(algorithm, tile_size, threads, simplify_native, include_agreement,
+                                           resolution_level))
+
+    with (Manifest(manifest) if manifest else nullcontext()) as run_manifest, \
+            (SnsNotifier(sns_topic) if sns_topic else nullcontext()) as notifier:
+        if run_manifest is not None:
+            done = [s3_url for s3_url in s3_urls if run_manifest.is_done(s3_url)]
+            if done:
+                LOG.info(f'Skipping {len(done)} S3 paths already done according to {manifest}')
+            s3_urls = [s3_url for s3_url in s3_urls if not run_manifest.is_done(s3_url)]
+
+        LOG.info(f'Processing {len(s3_urls)} S3 paths')
+        jobs = plan_workers(get_vectoriser(algorithm), min(jobs, max(len(s3_urls), 1)), tile_size,
+                            resolution_level=resolution_level)
+        failed = 0
+        notify = notifier.add if notifier is not None else None
+        for s3_url, written_url, error in _convert_all(s3_urls, convert, jobs, notify):
+            if error is None:
+                LOG.info(f'Finished {s3_url}')
+            else:
+                LOG.error(f'Failed to process {s3_url}: {error}')
+                failed += 1
+            if run_manifest is not None:
+                run_manifest.record(s3_url, DONE if error is None else FAILED, output=written_url,
+                                    error=None if error is None else repr(error))
+
+    if failed:
+        raise click.ClickException(f'{failed} of {len(s3_urls)} S3 paths failed')
+    _check_notifications(notifier)
+
+
+def convert_s3_url(s3_url, **convert_options) -> str:
+    """Load a STAC document from S3 and convert it with :func:`vector_convert`, returning the written URL"""
+    LOG.info(f"Processing {s3_url}")
+    stac_document = load_document_from_s3(s3_url)
+    return vector_convert(stac_document, **convert_options)
+
+
+def _convert_all(s3_urls, convert, jobs, notify=None):
+    """Yield (url, written url or None, exception or None) as each of `s3_urls` is converted
+
+    With more than one job, URLs are converted in a pool of `jobs` processes and yielded as they finish.
+    Notifications are passed to `notify` in this process.
+    """
+    if jobs == 1:
+        for s3_url in s3_urls:
+            try:
+                yield s3_url, convert(s3_url, notify=notify), None
+            except Exception as e:  # pylint: disable=broad-except
+                LOG.debug('Conversion failed', exc_info=True)
+                yield s3_url, None, e
+        return
+
+    with futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        in_flight = {executor.submit(_collecting_notifications, convert, s3_url): s3_url for s3_url in s3_urls}
+        for future in futures.as_completed(in_flight):
+            exception = future.exception()
+            if exception is not None:
+                yield in_flight[future], None, exception
+                continue
+            written_url, notifications = future.result()
+            _forward(notifications, notify)
+            yield in_flight[future], written_url, None
 
 
 @cli.command()
 @click.option('--queue-url')
+@click.option('--from-file',
+              type=click.File('r'),
+              help='Also read S3 URLs from this file, one per line. Use - to read from stdin')
+@click.option('--fetch-threads',
+              default=16,
+              show_default=True,
+              type=click.IntRange(min=1),
+              help='Number of STAC documents to fetch from S3 at once')
 @click.argument('s3_urls', nargs=-1)
-def s3_to_sqs(queue_url, s3_urls):
-    """Submit STAC documents to an SQS Queue"""
-    LOG.info(f'Submitting {len(s3_urls)} S3 STAC documents to {queue_url}')
-
-    client = boto3.client("sqs")
-    for s3_url in s3_urls:
-        LOG.info(f'Sending {s3_url}')
-        stac_document = load_document_from_s3(s3_url)
-
-        msg, msg_attribs = stac_to_msg_and_attributes(stac_document)
-        client.send_message(QueueUrl=queue_url,
-                            MessageBody=msg,
-                            MessageAttributes=msg_attribs)
-
+def s3_to_sqs(queue_url, s3_urls, from_file, fetch_threads):
+    """Submit STAC documents to an SQS Queue
 
-def vector_convert(stac_document, destination, output_format, algorithm, sns_topic: Optional[str] = None):
-    """Convert a raster dataset represented by a STAC document into a Vector stored on S3
-
-    Optionally sends an SNS notification of the new vector output.
+    Documents are fetched concurrently, and sent in batches of up to 10 messages.
+    """
+    LOG.info(f'Submitting S3 STAC documents to {queue_url}')
+    urls = _iter_urls(s3_urls, from_file)
+
+    fetched = failed = 0
+    start = time.monotonic()
+    with MessageSender(queue_url) as sender:
+        for s3_url, stac_document in _fetch_documents(urls, fetch_threads):
+            if isinstance(stac_document, Exception):
+                LOG.error(f'Unable to load {s3_url}: {stac_document}')
+                failed += 1
+                continue
+
+            msg, msg_attribs = stac_to_msg_and_attributes(stac_document)
+            sender.add(msg, msg_attribs)
+
+            fetched += 1
+            if fetched % PROGRESS_INTERVAL == 0:
+                LOG.info(f'Fetched {fetched} STAC documents, sent {sender.sent} '
+                         f'({fetched / (time.monotonic() - start):.0f} per second)')
+
+    failed += len(sender.failed)
+    for body, error in sender.failed:
+        LOG.error(f"Unable to send {json.loads(body).get('id')}: {error}")
+    LOG.info(f'Sent {sender.sent} STAC documents to {queue_url} in {time.monotonic() - start:.1f} seconds')
+    if failed:
+        raise click.ClickException(f'{failed} STAC documents could not be submitted')
+
+
+def _iter_urls(s3_urls, from_file):
+    """Yield URLs from the command line, then from `from_file` without reading it all into memory"""
+    yield from s3_urls
+    if from_file is not None:
+        for line in from_file:
+            line = line.strip()
+            if line:
+                yield line
+
+
+def _fetch_documents(s3_urls, threads):
+    """Yield (url, STAC document or the Exception raised loading it), loading up to `threads` documents at once
+
+    Only a bounded number of URLs are read ahead, so that huge URL lists can be streamed.
+    """
+    with futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        in_flight = {}
+        for s3_url in s3_urls:
+            in_flight[executor.submit(load_document_from_s3, s3_url)] = s3_url
+            if len(in_flight) >= threads * 2:
+                done, _ = futures.wait(in_flight, return_when=futures.FIRST_COMPLETED)
+                yield from _fetched(done, in_flight)
+        yield from _fetched(futures.wait(in_flight).done, in_flight)
+
+
+def _fetched(done, in_flight):
+    for future in done:
+        s3_url = in_flight.pop(future)
+        exception = future.exception()
+        yield s3_url, future.result() if exception is None else exception
+
+
+def vector_convert(stac_document, destination, output_format, algorithm, sns_topic: Optional[str] = None,
+                   skip_existing: str = SKIP_NEVER, pyramid_tolerances: Sequence[float] = (),
+                   metrics: Sequence[str] = (), metrics_dir: Optional[str] = None,
+                   notify: Optional[Callable[[str, dict], None]] = None, **algorithm_options):
+    """Convert a raster dataset represented by a STAC document into a Vector stored on S3, returning its URL
+
+    Optionally sends an SNS notification of the new vector output, see :func:`notification`. It's published
+    immediately, or if `notify` is given, passed to it as `(message, attributes)` to publish later, eg. with
+    :meth:`SnsNotifier.add <dea_vectoriser.utils.SnsNotifier.add>`.
+
+    With `skip_existing` set to SKIP_EXISTS, nothing is done if the output already exists. With SKIP_UNCHANGED the
+    output must also have been created from the same input objects, which is checked against a fingerprint of their
+    ETags stored in its metadata. Either way only HEAD requests are made, before any raster is read.
+
+    Each of `pyramid_tolerances` adds a generalised level of detail to the output, simplified at that tolerance in
+    metres from the same polygons, see :meth:`Vectoriser.vectorise_pyramid
+    <dea_vectoriser.vectorisers.Vectoriser.vectorise_pyramid>`.
+
+    The time and memory used by each stage are reported in each of the `metrics` formats, see
+    :mod:`dea_vectoriser.profiling`.
+
+    Any `algorithm_options`, eg. `tile_size` or `threads`, are passed through to the vectoriser algorithm. With a
+    `resolution_level` option, a preview is written under its own name, see :meth:`Vectoriser.output_name
+    <dea_vectoriser.vectorisers.Vectoriser.output_name>`.
     """
     LOG.debug(f"Loaded STAC Document. Dataset Id: {stac_document.get('id')}")
 
-    raster_asset_urls = {}
-    output_relative_path = ""
-    filename = ""
-    vector = None
-
-    # Construct URLs for input assets and output locations for selected algorithm
-    # TODO: We can clean this hard-coded if/else by refactoring 'wofs' and 'burns' into Classes which implement a standard vectoriser interface.
-    if(algorithm == 'wofs'):
-        wofs_asset_url =  asset_url_from_stac(stac_document, 'water')
-        raster_asset_urls = {
-            'wofs_asset_url': wofs_asset_url
-        }
-
-        output_relative_path, filename = output_name_from_url(wofs_asset_url)
-        
-    elif(algorithm == 'burns'):
-        delta_nbr_asset_url = asset_url_from_stac(stac_document, 'delta_nbr')
-        delta_ndvi_asset_url = asset_url_from_stac(stac_document, 'delta_ndvi')
-        delta_bsi_asset_url = asset_url_from_stac(stac_document, 'delta_bsi')
-        fmask_asset_url = asset_url_from_stac(stac_document, 'fmask')
-        raster_asset_urls = {
-            'delta_nbr_asset_url': delta_nbr_asset_url,
-            'delta_ndvi_asset_url': delta_ndvi_asset_url,
-            'delta_bsi_asset_url' : delta_bsi_asset_url,
-            'fmask_asset_url' : fmask_asset_url
-        }
-
-        output_relative_path, filename = output_name_from_url(delta_nbr_asset_url)
-
-    else:
-        raise Exception("Unknown vectoriser algorithm, must be 'wofs' or 'burns'.")
-
-    # Compute the vectors
-    vector = ALGORITHMS[algorithm](raster_asset_urls)
-    LOG.debug("Generated in RAM Vectors.")
-
-    written_url = save_vector_to_s3(vector, destination + str(output_relative_path), filename,
-                                    output_format=output_format)
-    LOG.info(f"Wrote vector to {written_url}")
-
-    if sns_topic:
-        LOG.info(f"Sending Vector URL notification to {sns_topic}")
-        publish_sns_message(sns_topic, written_url)
+    with profile_scene(stac_document.get('id'), metrics, metrics_dir, algorithm=algorithm) as profile:
+        # Construct URLs for input assets and output locations for selected algorithm
+        vectoriser = get_vectoriser(algorithm)
+        raster_asset_urls = vectoriser.asset_urls(stac_document)
+        resolution_level = algorithm_options.get('resolution_level', 0)
+        output_relative_path, filename = vectoriser.output_name(stac_document, resolution_level)
+
+        output_prefix = destination + str(output_relative_path)
+        metadata = None
+        if skip_existing != SKIP_NEVER:
+            output_url = vector_output_url(output_prefix, filename, output_format)
+            with stage('check_existing'):
+                existing_metadata = object_metadata(output_url)
+                if skip_existing == SKIP_UNCHANGED:
+                    metadata = {FINGERPRINT_METADATA_KEY: input_fingerprint(raster_asset_urls.values())}
+
+            if existing_metadata is None:
+                LOG.debug(f"{output_url} doesn't exist yet")
+            elif skip_existing == SKIP_EXISTS:
+                LOG.info(f"Skipping, {output_url} already exists")
+                profile.outcome = 'skipped'
+                return output_url
+            elif existing_metadata.get(FINGERPRINT_METADATA_KEY) == metadata[FINGERPRINT_METADATA_KEY]:
+                LOG.info(f"Skipping, {output_url} already exists and its inputs are unchanged")
+                profile.outcome = 'skipped'
+                return output_url
+            else:
+                LOG.info(f"Replacing {output_url}, its inputs have changed")
+
+        # Compute the vectors
+        levels = None
+        if pyramid_tolerances:
+            vector, levels = vectoriser.vectorise_pyramid(raster_asset_urls, pyramid_tolerances, **algorithm_options)
+        else:
+            vector = vectoriser.vectorise(raster_asset_urls, **algorithm_options)
+        LOG.debug("Generated in RAM Vectors.")
+        count('polygons', len(vector))
+        count('vertices', shapely.get_num_coordinates(vector.geometry.to_numpy()).sum())
+
+        written_url = save_vector_to_s3(vector, output_prefix, filename, output_format=output_format,
+                                        metadata=metadata, layers=levels)
+        LOG.info(f"Wrote vector to {written_url}")
+
+        if sns_topic:
+            message, attributes = notification(stac_document, vector, written_url, algorithm, resolution_level)
+            if notify is not None:
+                notify(message, attributes)
+            else:
+                LOG.info(f"Sending Vector URL notification to {sns_topic}")
+                with stage('notify'):
+                    publish_sns_message(sns_topic, message, attributes)
+
+        profile.outcome = 'converted'
+        return written_url
+
+
+def notification(stac_document, vector: gp.GeoDataFrame, written_url: str, algorithm: str,
+                 resolution_level: int = 0) -> Tuple[str, dict]:
+    """Return the SNS message and message attributes announcing a vector output
+
+    The message is the URL of the output. The attributes describe it, so that subscribers can filter on them
+    without fetching it: the input's product, datetime and maturity, the algorithm, the number of features, and
+    their bounding box in EPSG:4326 as a [west, south, east, north] array. Previews also have their
+    resolution_level.
+    """
+    _, attributes = stac_to_msg_and_attributes(stac_document)
+    # Attributes can't be empty, so any missing from the STAC document are left out
+    attributes = {name: value for name, value in attributes.items() if value['StringValue'] not in (None, 'None')}
+    attributes['algorithm'] = {'DataType': 'String', 'StringValue': algorithm}
+    attributes['feature_count'] = {'DataType': 'Number', 'StringValue': str(len(vector))}
+    if resolution_level:
+        attributes['resolution_level'] = {'DataType': 'Number', 'StringValue': str(resolution_level)}
+    if not vector.empty:
+        bbox = Transformer.from_crs(vector.crs, 'EPSG:4326', always_xy=True).transform_bounds(*vector.total_bounds)
+        attributes['bbox'] = {'DataType': 'String.Array', 'StringValue': json.dumps([round(v, 6) for v in bbox])}
+    return written_url, attributes
 
 
 if __name__ == '__main__':
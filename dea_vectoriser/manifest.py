@@ -0,0 +1,71 @@
+"""
+A record of the status of every scene in a batch run, so that an interrupted run can be resumed
+
+The manifest is a local JSON Lines file, with one line appended as each scene finishes. A line is written and
+synced to disk as soon as its scene is done, so after a crash or spot instance interruption at most the scenes in
+progress are lost. When a scene appears more than once, its last line wins.
+"""
+import json
+import os
+from pathlib import Path
+from typing import Dict, Optional
+
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Manifest:
+    """Read and append to a batch run manifest. Use as a context manager.
+
+    :param path: local path of the manifest, which is created if it doesn't exist
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.statuses: Dict[str, dict] = {}
+        if self.path.exists():
+            with self.path.open() as f:
+                for line in f:
+                    # The last line may be incomplete, if the previous run was killed while writing it
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.statuses[record['url']] = record
+        self._file = None
+
+    def __enter__(self):
+        torn = self.path.exists() and not self._ends_with_newline()
+        self._file = self.path.open('a')
+        if torn:
+            # End the line torn by a killed run, so the first new record isn't joined onto it
+            self._file.write('\n')
+        return self
+
+    def __exit__(self, *exc_info):
+        self._file.close()
+        self._file = None
+
+    def _ends_with_newline(self) -> bool:
+        """Whether the manifest ends with a complete line, or is empty"""
+        with self.path.open('rb') as f:
+            if f.seek(0, os.SEEK_END) == 0:
+                return True
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
+    def is_done(self, url: str) -> bool:
+        return self.statuses.get(url, {}).get('status') == DONE
+
+    def record(self, url: str, status: str, output: Optional[str] = None, error: Optional[str] = None):
+        """Record the outcome of processing `url`"""
+        record = {'url': url, 'status': status}
+        if output is not None:
+            record['output'] = output
+        if error is not None:
+            record['error'] = error
+        self.statuses[url] = record
+
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
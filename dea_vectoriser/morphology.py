@@ -0,0 +1,251 @@
+"""
+Binary morphology used to clean up raster layers before they are vectorised.
+
+Two pipelines are used by the vectorisers:
+
+- :func:`erode_dilate`, for Water Observations: erode with a 3x3 cross `erosions` times, then dilate with it
+  `dilations` times.
+- :func:`close_erode_dilate`, for burnt area: close, erode and then dilate with a disk.
+
+Each pipeline can be run by any registered backend, all of which produce identical output:
+
+- ``reference``: the original scipy/scikit-image calls, kept as the definition of correct output.
+- ``packed``: the default. Bitwise operations on rasters packed 8 pixels to a byte, with each structuring element
+  decomposed into horizontal and vertical runs. Many times faster than ``reference`` for the small structuring
+  elements used today.
+- ``distance``: distance transform equivalents. Repeated erosions or dilations with a cross collapse into a single
+  taxicab distance transform, and a disk becomes a single Euclidean distance transform, so the cost doesn't grow
+  with the number of iterations or the radius.
+
+The default backend can be set with the ``VECT_MORPHOLOGY_BACKEND`` environment variable.
+"""
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from scipy import ndimage
+from skimage import morphology
+
+
+class ReferenceBackend:
+    """The original scipy/scikit-image implementation"""
+
+    @staticmethod
+    def erode_dilate(mask: np.ndarray, erosions: int, dilations: int) -> np.ndarray:
+        eroded = ndimage.binary_erosion(mask, iterations=erosions)
+        return ndimage.binary_dilation(eroded, iterations=dilations)
+
+    @staticmethod
+    def close_erode_dilate(mask: np.ndarray, radius: int) -> np.ndarray:
+        footprint = morphology.disk(radius)
+        closed = morphology.binary_closing(mask, footprint).astype('float32')
+        eroded = morphology.erosion(closed, footprint)
+        return ndimage.binary_dilation(eroded, footprint)
+
+
+class PackedBackend:
+    """Bitwise morphology on rasters packed 8 pixels to a byte
+
+    A disk is decomposed into the union of a few rectangles, and each rectangle into a horizontal and a vertical
+    run, so eroding (dilating) is the AND (OR) of shifted copies of the raster. Vertical shifts are row offsets and
+    horizontal shifts are bit shifts across neighbouring bytes, so every step handles 8 pixels per byte operation.
+    Iterated crosses are applied one after another without unpacking in between.
+    """
+
+    def erode_dilate(self, mask: np.ndarray, erosions: int, dilations: int) -> np.ndarray:
+        packed = _PackedRaster(mask, pad=1)
+        for _ in range(erosions):
+            packed.apply_cross(np.bitwise_and, border_value=False)
+        for _ in range(dilations):
+            packed.apply_cross(np.bitwise_or, border_value=False)
+        return packed.unpack()
+
+    def close_erode_dilate(self, mask: np.ndarray, radius: int) -> np.ndarray:
+        packed = _PackedRaster(mask, pad=radius)
+        rectangles = disk_rectangles(radius)
+        packed.apply_rectangles(rectangles, np.bitwise_or, border_value=False)
+        packed.apply_rectangles(rectangles, np.bitwise_and, border_value=True)
+        packed.apply_rectangles(rectangles, np.bitwise_and, border_value=True)
+        packed.apply_rectangles(rectangles, np.bitwise_or, border_value=False)
+        return packed.unpack()
+
+
+def disk_rectangles(radius: int) -> List[Tuple[int, int]]:
+    """Return the (height, width) of centred rectangles whose union is `skimage.morphology.disk(radius)`"""
+    half_widths = [int(np.sqrt(radius ** 2 - dy ** 2)) for dy in range(radius + 1)]
+    rectangles = []
+    for half_width in sorted(set(half_widths)):
+        half_height = max(dy for dy, width in enumerate(half_widths) if width >= half_width)
+        rectangles.append((2 * half_height + 1, 2 * half_width + 1))
+    return rectangles
+
+
+class _PackedRaster:
+    """A boolean raster packed into bits, with a border of `pad` pixels on every side
+
+    The border must be at least as wide as the reach of a single operation. It is refilled with the required
+    border value before each operation, since the operations leave it holding garbage.
+    """
+
+    def __init__(self, mask: np.ndarray, pad: int):
+        self.shape = mask.shape
+        self.pad_rows = pad
+        # At least one whole extra byte, which absorbs the bits that wrap around when shifting
+        self.pad_bytes = pad // 8 + 1
+        padded = np.pad(np.asarray(mask, dtype=bool),
+                        ((pad, pad), (8 * self.pad_bytes, 8 * self.pad_bytes + (-mask.shape[1]) % 8)))
+        self.bits = np.packbits(padded, axis=1)
+
+        inside = np.zeros(padded.shape[1], dtype=bool)
+        inside[8 * self.pad_bytes:8 * self.pad_bytes + mask.shape[1]] = True
+        self._inside_columns = np.packbits(inside)
+
+    def unpack(self) -> np.ndarray:
+        rows = self.bits[self.pad_rows:self.pad_rows + self.shape[0]]
+        columns = slice(8 * self.pad_bytes, 8 * self.pad_bytes + self.shape[1])
+        return np.unpackbits(rows, axis=1)[:, columns].view(bool)
+
+    def fill_border(self, value: bool):
+        bits = self.bits
+        bits[:self.pad_rows] = bits[bits.shape[0] - self.pad_rows:] = 0xFF if value else 0
+        if value:
+            bits |= ~self._inside_columns
+        else:
+            bits &= self._inside_columns
+
+    def apply_cross(self, op, border_value: bool):
+        """Erode (`op=np.bitwise_and`) or dilate (`op=np.bitwise_or`) with a 3x3 cross"""
+        self.fill_border(border_value)
+        bits = self.bits
+        out = bits.copy()
+        op(out[:-1], bits[1:], out=out[:-1])
+        op(out[1:], bits[:-1], out=out[1:])
+        op(out, _shift_columns(bits, 1), out=out)
+        op(out, _shift_columns(bits, -1), out=out)
+        self.bits = out
+
+    def apply_rectangles(self, rectangles, op, border_value: bool):
+        """Erode (`op=np.bitwise_and`) or dilate (`op=np.bitwise_or`) with the union of some rectangles"""
+        self.fill_border(border_value)
+        result = None
+        for height, width in rectangles:
+            rectangle = _run(_run(self.bits, width, axis=1, op=op), height, axis=0, op=op)
+            result = rectangle if result is None else op(result, rectangle, out=result)
+        self.bits = result
+
+
+def _shift_columns(bits: np.ndarray, shift: int) -> np.ndarray:
+    """Shift every packed row so that pixel `x` takes the value of pixel `x + shift`"""
+    byte_shift, bit_shift = divmod(shift, 8)
+    shifted = np.roll(bits, -byte_shift, axis=1) if byte_shift else bits
+    if not bit_shift:
+        return shifted
+    return (shifted << bit_shift) | (np.roll(shifted, -1, axis=1) >> (8 - bit_shift))
+
+
+def _run(bits: np.ndarray, length: int, axis: int, op) -> np.ndarray:
+    """Combine every pixel with its neighbours in a centred run of `length` pixels along `axis`"""
+    out = bits.copy()
+    for offset in range(1, length // 2 + 1):
+        if axis == 0:
+            op(out[:-offset], bits[offset:], out=out[:-offset])
+            op(out[offset:], bits[:-offset], out=out[offset:])
+        else:
+            op(out, _shift_columns(bits, offset), out=out)
+            op(out, _shift_columns(bits, -offset), out=out)
+    return out
+
+
+class DistanceBackend:
+    """Distance transform equivalents of the morphology operations
+
+    Eroding `n` times with a 3x3 cross removes every pixel within a taxicab distance of `n` of a False pixel, and
+    dilating `n` times adds every pixel within `n` of a True pixel. Likewise eroding or dilating with `disk(r)` is
+    a Euclidean distance threshold of `r`.
+    """
+
+    @staticmethod
+    def _erode(mask: np.ndarray, distance: float, border_value: bool, metric: str) -> np.ndarray:
+        if mask.all() and border_value:
+            return mask.copy()
+        if not border_value:
+            # Pixels outside the raster count as False, so measure distances from a False border
+            padded = np.pad(mask, 1, constant_values=False)
+            return _distance_transform(padded, metric)[1:-1, 1:-1] > distance
+        return _distance_transform(mask, metric) > distance
+
+    @staticmethod
+    def _dilate(mask: np.ndarray, distance: float, metric: str) -> np.ndarray:
+        if not mask.any():
+            return mask.copy()
+        return _distance_transform(~mask, metric) <= distance
+
+    def erode_dilate(self, mask: np.ndarray, erosions: int, dilations: int) -> np.ndarray:
+        mask = np.asarray(mask, dtype=bool)
+        eroded = self._erode(mask, erosions, border_value=False, metric='taxicab')
+        return self._dilate(eroded, dilations, metric='taxicab')
+
+    def close_erode_dilate(self, mask: np.ndarray, radius: int) -> np.ndarray:
+        mask = np.asarray(mask, dtype=bool)
+        result = self._dilate(mask, radius, metric='euclidean')
+        result = self._erode(result, radius, border_value=True, metric='euclidean')
+        result = self._erode(result, radius, border_value=True, metric='euclidean')
+        return self._dilate(result, radius, metric='euclidean')
+
+
+def _distance_transform(mask: np.ndarray, metric: str) -> np.ndarray:
+    """Distance from every True pixel to the nearest False pixel"""
+    if metric == 'euclidean':
+        return ndimage.distance_transform_edt(mask)
+    return ndimage.distance_transform_cdt(mask, metric=metric)
+
+
+BACKENDS: Dict[str, object] = {
+    'reference': ReferenceBackend(),
+    'packed': PackedBackend(),
+    'distance': DistanceBackend(),
+}
+
+DEFAULT_BACKEND = os.environ.get('VECT_MORPHOLOGY_BACKEND', 'packed')
+
+
+def register_backend(name: str, backend):
+    """Make a morphology backend available by name
+
+    `backend` must implement `erode_dilate(mask, erosions, dilations)` and `close_erode_dilate(mask, radius)`, and
+    produce the same output as the reference backend.
+    """
+    BACKENDS[name] = backend
+
+
+def get_backend(name: Optional[str] = None):
+    """Return the named morphology backend, or the default one"""
+    name = name or DEFAULT_BACKEND
+    try:
+        return BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"Unknown morphology backend {name!r}, must be one of {', '.join(BACKENDS)}") from None
+
+
+def erode_dilate(mask: np.ndarray, erosions: int, dilations: int, backend: Optional[str] = None) -> np.ndarray:
+    """Erode `mask` with a 3x3 cross `erosions` times, then dilate it `dilations` times
+
+    Pixels outside the raster are treated as False.
+    """
+    return get_backend(backend).erode_dilate(mask, erosions, dilations)
+
+
+def close_erode_dilate(mask: np.ndarray, radius: int, backend: Optional[str] = None) -> np.ndarray:
+    """Close `mask` with a disk of `radius`, then erode and dilate it with the same disk
+
+    When eroding, pixels outside the raster are treated as True.
+    """
+    return get_backend(backend).close_erode_dilate(mask, radius)
+
+
+def scale_reach(pixels: int, decimation: int) -> int:
+    """Scale a number of iterations or a radius, in pixels, to a raster decimated by `decimation`
+
+    The result covers the same ground distance, rounded up so that some cleanup is always done.
+    """
+    return -(-pixels // decimation)
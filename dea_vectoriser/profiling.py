@@ -0,0 +1,249 @@
+"""
+Per scene timing and memory instrumentation
+
+A scene is profiled by converting it inside :func:`profile_scene`. Code anywhere below it marks the stages of the
+conversion with :func:`stage`, and adds up quantities like polygon counts with :func:`count`. Outside a profiled
+scene both do nothing, so the algorithms can be used without profiling.
+
+For each stage the wall time, CPU time (of the whole process, including worker threads) and peak resident memory
+are recorded, summed over repeated calls, eg. once per tile. Peak memory is measured by resetting the kernel's high
+water mark at the start of each stage, where Linux allows it, otherwise it's the peak of the process so far.
+
+When the scene finishes the profile is emitted in any of the :data:`METRICS_FORMATS`:
+
+- ``json``: a single line JSON document, logged to the ``dea_vectoriser.profiling`` logger.
+- ``emf``: CloudWatch Embedded Metric Format documents, printed to stdout for the CloudWatch agent or Lambda.
+- ``prometheus``: the latest scene's metrics, in a Prometheus text file per process for node_exporter's textfile
+  collector.
+"""
+import contextvars
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+LOG = logging.getLogger(__name__)
+
+METRICS_FORMATS = ['json', 'emf', 'prometheus']
+
+EMF_NAMESPACE = os.environ.get('VECT_EMF_NAMESPACE', 'DEAVectoriser')
+
+_current_profile = contextvars.ContextVar('scene_profile', default=None)
+
+
+class SceneProfile:
+    """The stages and counts of converting one scene"""
+
+    def __init__(self, scene: str, **dimensions):
+        self.scene = scene
+        self.dimensions = dimensions
+        self.outcome = None
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self.counts: Dict[str, int] = {}
+        self.total: Dict[str, float] = {}
+        self._open: List[dict] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def measure(self, name: Optional[str] = None):
+        """Record the time and peak memory of the enclosed code as the stage `name`, or the scene total if None"""
+        _fold_peak_rss(self._open)
+        frame = {'peak_rss': 0}
+        self._open.append(frame)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            _fold_peak_rss(self._open)
+            self._open.pop()
+
+            totals = self.stages.setdefault(name, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0,
+                                                   'peak_rss_bytes': 0}) if name else self.total
+            totals['calls'] = totals.get('calls', 0) + 1
+            totals['wall_seconds'] = totals.get('wall_seconds', 0.0) + wall
+            totals['cpu_seconds'] = totals.get('cpu_seconds', 0.0) + cpu
+            totals['peak_rss_bytes'] = max(totals.get('peak_rss_bytes', 0), frame['peak_rss'])
+
+    def count(self, name: str, value: int):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + int(value)
+
+    def as_dict(self) -> dict:
+        return {'scene': self.scene, **self.dimensions, 'outcome': self.outcome,
+                'total': self.total, 'stages': self.stages, 'counts': self.counts}
+
+
+def _peak_rss() -> int:
+    """Peak resident memory in bytes, since it was last reset"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # Kilobytes on Linux, bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def _reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _fold_peak_rss(frames):
+    """Record the peak memory since the last reset in every open stage, then reset it"""
+    peak = _peak_rss()
+    for frame in frames:
+        frame['peak_rss'] = max(frame['peak_rss'], peak)
+    _reset_peak_rss()
+
+
+@contextmanager
+def profile_scene(scene: str, metrics: Sequence[str] = ('json',), metrics_dir=None, **dimensions):
+    """Profile converting `scene` in the enclosed code, emitting it in each of the `metrics` formats when done
+
+    `dimensions`, eg. the algorithm, are included with the metrics. The profile's `outcome` can be set by the
+    enclosed code, and is 'failed' if it raises.
+
+    :param metrics_dir: directory to write Prometheus text files into, required for the 'prometheus' format
+    """
+    profile = SceneProfile(scene, **dimensions)
+    token = _current_profile.set(profile)
+    try:
+        with profile.measure():
+            yield profile
+    except BaseException:
+        profile.outcome = 'failed'
+        raise
+    finally:
+        _current_profile.reset(token)
+        emit(profile, metrics, metrics_dir)
+
+
+@contextmanager
+def stage(name: str):
+    """Record the enclosed code as stage `name` of the scene being profiled, if any"""
+    profile = _current_profile.get()
+    if profile is None:
+        yield
+        return
+    with profile.measure(name):
+        yield
+
+
+def count(name: str, value: int):
+    """Add `value` to the count `name` of the scene being profiled, if any. Safe to call from worker threads which
+    were started in a copy of the profiled context, see :func:`contextvars.copy_context`"""
+    profile = _current_profile.get()
+    if profile is not None:
+        profile.count(name, value)
+
+
+def emit(profile: SceneProfile, metrics: Sequence[str], metrics_dir=None):
+    for metrics_format in metrics:
+        try:
+            if metrics_format == 'json':
+                LOG.info(to_json(profile))
+            elif metrics_format == 'emf':
+                for document in to_emf(profile):
+                    print(document, flush=True)
+            elif metrics_format == 'prometheus':
+                write_prometheus(profile, metrics_dir)
+            else:
+                raise ValueError(f'Unknown metrics format {metrics_format!r}')
+        except Exception:  # pylint: disable=broad-except
+            # Never let reporting metrics fail a conversion
+            LOG.exception(f'Unable to emit {metrics_format} metrics for {profile.scene}')
+
+
+def to_json(profile: SceneProfile) -> str:
+    return json.dumps(profile.as_dict(), separators=(',', ':'))
+
+
+def _emf_document(metrics: Dict[str, tuple], dimensions: Dict[str, str], timestamp: int, **properties) -> str:
+    """A single EMF document of {name: (value, unit)} metrics"""
+    return json.dumps({
+        '_aws': {
+            'Timestamp': timestamp,
+            'CloudWatchMetrics': [{
+                'Namespace': EMF_NAMESPACE,
+                'Dimensions': [list(dimensions)],
+                'Metrics': [{'Name': name, 'Unit': unit} for name, (_, unit) in metrics.items()],
+            }],
+        },
+        **dimensions,
+        **properties,
+        **{name: value for name, (value, _) in metrics.items()},
+    }, separators=(',', ':'))
+
+
+def _timing_metrics(timing: Dict[str, float]) -> Dict[str, tuple]:
+    return {'WallTime': (timing.get('wall_seconds', 0.0), 'Seconds'),
+            'CpuTime': (timing.get('cpu_seconds', 0.0), 'Seconds'),
+            'PeakRss': (timing.get('peak_rss_bytes', 0), 'Bytes')}
+
+
+def to_emf(profile: SceneProfile) -> List[str]:
+    """One EMF document for the scene, and one per stage with the stage as an extra dimension"""
+    timestamp = int(time.time() * 1000)
+    dimensions = {name: str(value) for name, value in profile.dimensions.items()}
+    scene_metrics = _timing_metrics(profile.total)
+    scene_metrics.update({_camel_case(name): (value, 'Bytes' if name.endswith('bytes') else 'Count')
+                          for name, value in profile.counts.items()})
+    documents = [_emf_document(scene_metrics, dimensions, timestamp, scene=profile.scene, outcome=profile.outcome)]
+    for name, timing in profile.stages.items():
+        documents.append(_emf_document(_timing_metrics(timing), {**dimensions, 'stage': name}, timestamp,
+                                       scene=profile.scene))
+    return documents
+
+
+def _camel_case(name: str) -> str:
+    return ''.join(word.capitalize() for word in name.split('_'))
+
+
+def to_prometheus(profile: SceneProfile) -> str:
+    """Gauges of the latest scene, in the Prometheus text exposition format
+
+    The scene id isn't a label, to keep the number of series bounded.
+    """
+    def labels(**extra):
+        pairs = {**profile.dimensions, **extra}
+        return '{' + ','.join(f'{name}="{value}"' for name, value in pairs.items()) + '}' if pairs else ''
+
+    lines = []
+    for metric, key in [('wall_seconds', 'wall_seconds'), ('cpu_seconds', 'cpu_seconds'),
+                        ('peak_rss_bytes', 'peak_rss_bytes')]:
+        lines.append(f'# TYPE dea_vectoriser_scene_{metric} gauge')
+        lines.append(f'dea_vectoriser_scene_{metric}{labels()} {profile.total.get(key, 0)}')
+        lines.append(f'# TYPE dea_vectoriser_stage_{metric} gauge')
+        lines.extend(f'dea_vectoriser_stage_{metric}{labels(stage=name)} {timing[key]}'
+                     for name, timing in profile.stages.items())
+    for name, value in profile.counts.items():
+        lines.append(f'# TYPE dea_vectoriser_scene_{name} gauge')
+        lines.append(f'dea_vectoriser_scene_{name}{labels()} {value}')
+    lines.append('# TYPE dea_vectoriser_scene_timestamp_seconds gauge')
+    lines.append(f'dea_vectoriser_scene_timestamp_seconds{labels(outcome=profile.outcome)} {time.time()}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(profile: SceneProfile, metrics_dir):
+    """Replace this process's Prometheus text file in `metrics_dir` with the metrics of `profile`"""
+    if metrics_dir is None:
+        raise ValueError('A metrics directory is required for Prometheus metrics')
+    path = Path(metrics_dir) / f'dea_vectoriser_{os.getpid()}.prom'
+    # Written alongside and renamed into place, so the collector never reads a partial file
+    partial_path = path.with_suffix('.prom.tmp')
+    partial_path.write_text(to_prometheus(profile))
+    os.replace(partial_path, path)
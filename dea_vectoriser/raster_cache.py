@@ -0,0 +1,159 @@
+"""
+An on-disk cache of downloaded rasters
+
+Running several algorithms over the same scene, or reprocessing a scene after a failure, reads the same GeoTIFFs
+again. With the cache enabled, :func:`open_raster` downloads and decodes each raster once, then stores its band 1
+pixels as an uncompressed ``.npy`` file, which later reads open memory-mapped: no download, no decompression, and
+no copy into memory until pixels are actually used.
+
+Entries are content addressed by the raster's URL and its S3 ETag (or for local files, their size and modification
+time), so a replaced object is never served stale. Checking the ETag is a single HEAD request. Rasters at other
+URLs, eg. ``https://`` or GDAL ``/vsicurl/`` paths, have no version to check, and are always read directly. The least
+recently used entries are evicted once the cache exceeds its byte budget.
+
+The cache is enabled by the command line's ``--raster-cache-dir`` (or ``VECT_RASTER_CACHE_DIR``), with its budget
+in ``--raster-cache-bytes``, or by calling :func:`configure`.
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+from pathlib import Path
+from typing import Optional
+from urllib.parse import urlparse
+
+import numpy as np
+from affine import Affine
+from rasterio.crs import CRS
+
+from dea_vectoriser import raster_io
+from dea_vectoriser.raster_io import Raster
+from dea_vectoriser.utils import object_etag
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 20 * 2 ** 30
+
+
+class RasterCache:
+    """A directory of rasters, keyed by URL and version, limited to `max_bytes`"""
+
+    def __init__(self, directory, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+    def key(self, url, resolution_level: int = 0) -> Optional[str]:
+        """Return the cache key of a raster's current version, or None if its version can't be checked"""
+        url = str(url)
+        if url.startswith('s3://'):
+            version = object_etag(url)
+        elif urlparse(url).scheme or url.startswith('/vsi'):
+            return None
+        else:
+            stat = os.stat(url)
+            version = f'{stat.st_size} {stat.st_mtime_ns}'
+        if resolution_level:
+            version += f' level {resolution_level}'
+        return hashlib.sha256(f'{url}\n{version}'.encode()).hexdigest()
+
+    def open(self, url, dtype=None, resolution_level: int = 0) -> Raster:
+        """Return band 1 of the raster at `url`, from the cache if possible"""
+        key = self.key(url, resolution_level)
+        if key is None:
+            LOG.debug(f'Not caching {url}, its version is unknown')
+            return raster_io.read_band(url, dtype, resolution_level)
+        cached = self.get(key)
+        if cached is not None and (dtype is None or cached.data.dtype == dtype):
+            LOG.debug(f'Raster cache hit for {url}')
+            return cached
+
+        LOG.debug(f'Raster cache miss for {url}')
+        raster = raster_io.read_band(url, dtype, resolution_level)
+        self.put(key, raster)
+        self.evict(keep=key)
+        # The memory-mapped copy lets the kernel page the pixels out, rather than holding them all in memory
+        cached = self.get(key)
+        return raster if cached is None else cached
+
+    def get(self, key: str) -> Optional[Raster]:
+        pixels, metadata = self._paths(key)
+        try:
+            # Copy on write, so that the arrays behave like freshly loaded ones without modifying the cache
+            data = np.load(pixels, mmap_mode='c')
+            metadata = json.loads(metadata.read_text())
+        except (OSError, ValueError):
+            return None
+
+        _touch(pixels)
+        return Raster(data, CRS.from_wkt(metadata['crs']), Affine(*metadata['transform']), metadata['nodata'])
+
+    def put(self, key: str, raster: Raster):
+        """Store a loaded raster. Files are written alongside and renamed into place, so that concurrent readers
+        and writers only ever see complete entries"""
+        pixels, metadata = self._paths(key)
+        temporary = f'.{uuid.uuid4().hex}.tmp'
+
+        metadata_tmp = metadata.with_name(metadata.name + temporary)
+        metadata_tmp.write_text(json.dumps({
+            'crs': raster.crs.to_wkt(),
+            'transform': list(raster.transform)[:6],
+            'nodata': raster.nodata,
+        }))
+        os.replace(metadata_tmp, metadata)
+
+        pixels_tmp = pixels.with_name(pixels.name + temporary)
+        with pixels_tmp.open('wb') as f:
+            np.save(f, np.ascontiguousarray(raster.data))
+        _touch(pixels_tmp)
+        os.replace(pixels_tmp, pixels)
+
+    def evict(self, keep: Optional[str] = None):
+        """Delete the least recently used entries, apart from `keep`, until the cache fits its budget"""
+        entries = []
+        for path in self.directory.glob('*.npy'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path.stem == keep:
+                continue
+            LOG.debug(f'Evicting {path} from the raster cache')
+            for entry_path in self._paths(path.stem):
+                entry_path.unlink(missing_ok=True)
+            total -= size
+
+    def _paths(self, key: str):
+        return self.directory / f'{key}.npy', self.directory / f'{key}.json'
+
+
+def _touch(path):
+    """Mark an entry as recently used, for eviction. The time is set explicitly, since file systems often only
+    update modification times at the resolution of the kernel's clock tick"""
+    now = time.time_ns()
+    os.utime(path, ns=(now, now))
+
+
+_cache: Optional[RasterCache] = None
+
+
+def configure(directory=None, max_bytes: int = DEFAULT_MAX_BYTES):
+    """Enable the raster cache in `directory`, or disable it if None"""
+    global _cache
+    _cache = RasterCache(directory, max_bytes) if directory else None
+
+
+def open_raster(url, dtype=None, resolution_level: int = 0) -> Raster:
+    """Read band 1 of a raster with :func:`dea_vectoriser.raster_io.read_band`, through the raster cache if it's
+    enabled"""
+    if _cache is None:
+        return raster_io.read_band(url, dtype, resolution_level)
+    return _cache.open(url, dtype, resolution_level)
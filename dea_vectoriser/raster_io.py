@@ -0,0 +1,72 @@
+"""
+Reading rasters with rasterio, tuned for Cloud Optimised GeoTIFFs on S3
+
+Only band 1 is read, straight into a preallocated array, along with the CRS and transform from the dataset. All
+reads happen inside :func:`cog_env`, which configures GDAL for fetching COGs over HTTP.
+
+Rasters can also be read at a lower `resolution_level`, decimated by ``2 ** resolution_level`` in each dimension.
+GDAL serves these reads from the COG's matching overview where it has one, fetching only a fraction of the bytes.
+"""
+import os
+from typing import NamedTuple, Optional
+
+import numpy as np
+import rasterio
+from affine import Affine
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+
+# GDAL configuration for reading COGs over HTTP. Opening a file doesn't list its 'directory' looking for sidecar
+# files, reads of neighbouring byte ranges are merged and multiplexed over HTTP/2 connections, and decoded blocks
+# are cached. Any of these can be overridden by setting them as environment variables.
+COG_GDAL_OPTIONS = {
+    'GDAL_DISABLE_READDIR_ON_OPEN': 'EMPTY_DIR',
+    'CPL_VSIL_CURL_ALLOWED_EXTENSIONS': '.tif,.tiff',
+    'GDAL_HTTP_MERGE_CONSECUTIVE_RANGES': 'YES',
+    'GDAL_HTTP_MULTIRANGE': 'YES',
+    'GDAL_HTTP_MULTIPLEX': 'YES',
+    'GDAL_HTTP_VERSION': '2',
+    'GDAL_HTTP_MAX_RETRY': 5,
+    'GDAL_HTTP_RETRY_DELAY': 1,
+    'VSI_CACHE': 'TRUE',
+    # Megabytes
+    'GDAL_CACHEMAX': 512,
+}
+
+# Coarsest resolution level which can be read: 8x decimated, the deepest overview DEA COGs routinely have
+MAX_RESOLUTION_LEVEL = 3
+
+
+class Raster(NamedTuple):
+    """Band 1 of a raster, and its georeferencing"""
+    data: np.ndarray
+    crs: CRS
+    transform: Affine
+    nodata: Optional[float] = None
+
+
+def cog_env() -> rasterio.Env:
+    """A rasterio environment configured with COG_GDAL_OPTIONS, apart from any set as environment variables"""
+    return rasterio.Env(**{name: value for name, value in COG_GDAL_OPTIONS.items() if name not in os.environ})
+
+
+def decimation(resolution_level: int) -> int:
+    """The factor a raster is decimated by in each dimension at `resolution_level`"""
+    if not 0 <= resolution_level <= MAX_RESOLUTION_LEVEL:
+        raise ValueError(f'resolution_level must be between 0 and {MAX_RESOLUTION_LEVEL}, not {resolution_level}')
+    return 2 ** resolution_level
+
+
+def read_band(url, dtype=None, resolution_level: int = 0) -> Raster:
+    """Read band 1 of the raster at `url`, optionally converting it to `dtype`
+
+    Above `resolution_level` 0, the raster is read decimated, from an overview if it has a suitable one or else by
+    nearest neighbour sampling, and the transform scaled to match.
+    """
+    factor = decimation(resolution_level)
+    with cog_env(), rasterio.open(url) as dataset:
+        height, width = -(-dataset.height // factor), -(-dataset.width // factor)
+        data = np.empty((height, width), dtype=dtype or dataset.dtypes[0])
+        dataset.read(1, out=data, resampling=Resampling.nearest)
+        transform = dataset.transform * Affine.scale(dataset.width / width, dataset.height / height)
+        return Raster(data, dataset.crs, transform, dataset.nodata)
@@ -0,0 +1,139 @@
+"""
+Tools for converting rasters which are too large to hold in memory into geopandas vector data.
+
+The raster is read one window (tile) at a time, with a halo of extra pixels around each tile so that the
+morphology steps produce exactly the same result they would on the full scene. Polygons are traced in pixel
+coordinates, so that those which cross a tile seam line up exactly and can be stitched back together.
+"""
+from collections import defaultdict
+from contextlib import ExitStack
+from typing import Callable, Dict, Iterator, List, NamedTuple, Sequence, Tuple, Union
+
+import geopandas as gp
+import numpy as np
+import pandas as pd
+import rasterio
+import rasterio.features
+import shapely
+from affine import Affine
+from rasterio.windows import Window
+
+from dea_vectoriser.profiling import count, stage
+from dea_vectoriser.raster_io import cog_env
+from dea_vectoriser.utils import LOG
+from dea_vectoriser.vectorise import polygons_from_shapes
+
+DEFAULT_TILE_SIZE = 2048
+
+
+
+class Labelled(NamedTuple):
+    """A layer of several classes which don't overlap, vectorised in a single pass, see
+    :func:`dea_vectoriser.vectorise.vectorise_labels`"""
+    data: np.ndarray
+    #: {raster value: output label} for each class to vectorise. Pixels with any other value are not vectorised
+    labels: Dict[int, str]
+
+
+# Converts a list of tiles, one per input raster, into binary or Labelled layers keyed by their output label
+LayersFunc = Callable[[List[np.ndarray]], Dict[str, Union[np.ndarray, Labelled]]]
+
+
+def iter_tiles(height: int, width: int, tile_size: int, halo: int = 0) -> Iterator[Tuple[Window, Window]]:
+    """Yield (core, read) Windows covering a raster
+
+    `core` windows tile the raster without overlapping. Each `read` window is its `core` window grown by `halo`
+    pixels on every side, clipped to the raster.
+    """
+    for row_off in range(0, height, tile_size):
+        for col_off in range(0, width, tile_size):
+            core = Window(col_off, row_off, min(tile_size, width - col_off), min(tile_size, height - row_off))
+            read_col, read_row = max(col_off - halo, 0), max(row_off - halo, 0)
+            read = Window(read_col, read_row,
+                          min(col_off + core.width + halo, width) - read_col,
+                          min(row_off + core.height + halo, height) - read_row)
+            yield core, read
+
+
+def vectorise_tiled(urls: Sequence[str], layers_func: LayersFunc, tile_size: int = DEFAULT_TILE_SIZE,
+                    halo: int = 0) -> gp.GeoDataFrame:
+    """Return a vector representation of one or more aligned rasters, processed one tile at a time
+
+    :param urls: rasters sharing the same grid. Only band 1 of each is read
+    :param layers_func: converts the list of tiles (one per url, in order) into a dict of
+                        {label: array with 1 or True where polygons should be created}. A :class:`Labelled` layer
+                        is labelled by its classes instead of its key
+    :param tile_size: width and height in pixels of the tiles to process
+    :param halo: extra pixels to read around each tile. Must be at least the total reach of any morphology
+                 applied by `layers_func`, for the result to match processing the whole raster at once
+
+    :return: Geodataframe containing shapely geometries with their label in a series called attribute
+    """
+    order = []
+    interior = defaultdict(list)
+    # Polygons which touch a tile seam, and may continue into the neighbouring tile
+    on_seams = defaultdict(list)
+
+    with ExitStack() as stack:
+        stack.enter_context(cog_env())
+        datasets = [stack.enter_context(rasterio.open(url)) for url in urls]
+        height, width = datasets[0].height, datasets[0].width
+        crs, transform = datasets[0].crs, datasets[0].transform
+
+        for core, read in iter_tiles(height, width, tile_size, halo):
+            LOG.debug(f'Vectorising tile {core}')
+            with stage('read'):
+                tiles = [dataset.read(1, window=read) for dataset in datasets]
+            count('raster_bytes', sum(tile.nbytes for tile in tiles))
+            with stage('morphology'):
+                layers = layers_func(tiles)
+
+            rows = slice(core.row_off - read.row_off, core.row_off - read.row_off + core.height)
+            cols = slice(core.col_off - read.col_off, core.col_off - read.col_off + core.width)
+            seams = (core.col_off if core.col_off > 0 else None,
+                     core.row_off if core.row_off > 0 else None,
+                     core.col_off + core.width if core.col_off + core.width < width else None,
+                     core.row_off + core.height if core.row_off + core.height < height else None)
+
+            for key, layer in layers.items():
+                if isinstance(layer, Labelled):
+                    data = np.asarray(layer.data)[rows, cols]
+                    mask = np.isin(data, list(layer.labels))
+                    labels = layer.labels
+                else:
+                    mask = np.asarray(layer)[rows, cols] == 1
+                    data = mask.view(np.uint8)
+                    labels = {1: key}
+                with stage('shapes'):
+                    polygons, values = polygons_from_shapes(rasterio.features.shapes(
+                        data, mask=mask, transform=Affine.translation(core.col_off, core.row_off)))
+                values = values.astype(data.dtype)
+
+                bounds = shapely.bounds(polygons)
+                touches_seam = np.zeros(len(polygons), dtype=bool)
+                for axis, seam in enumerate(seams):
+                    if seam is not None:
+                        touches_seam |= bounds[:, axis] == seam
+                for value, label in labels.items():
+                    if label not in order:
+                        order.append(label)
+                    selected = values == value
+                    on_seams[label].extend(polygons[selected & touches_seam])
+                    interior[label].append(polygons[selected & ~touches_seam])
+
+    codes, polygons = [], []
+    for code, label in enumerate(order):
+        label_polygons = interior[label]
+        if on_seams[label]:
+            # Stitching leaves redundant vertices where polygons crossed a seam, simplify(0) removes them
+            with stage('stitch'):
+                label_polygons.append(shapely.simplify(shapely.get_parts(shapely.union_all(on_seams[label])), 0))
+        label_polygons = np.concatenate(label_polygons)
+        codes.append(np.full(len(label_polygons), code, dtype=np.int8))
+        polygons.append(label_polygons)
+
+    matrix = [transform.a, transform.b, transform.d, transform.e, transform.c, transform.f]
+    geometry = gp.GeoSeries(np.concatenate(polygons) if polygons else [], crs=crs.to_string())
+    return gp.GeoDataFrame(data={'attribute': pd.Categorical.from_codes(np.concatenate(codes) if codes else [],
+                                                                        categories=order)},
+                           geometry=geometry.affine_transform(matrix))
@@ -1,19 +1,36 @@
 """
 Useful functions, mostly related to AWS and STAC
 """
+import hashlib
 import json
 import logging
 import os
+import queue
+import threading
+import time
 from concurrent import futures
 from pathlib import PurePosixPath
-from typing import Tuple, Optional
+from typing import Dict, Iterable, List, Tuple, Optional
 from urllib.parse import urlparse
 
 import boto3
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 from toolz import dicttoolz, get_in
 
 LOG = logging.getLogger(__name__)
 
+# Shared by every client: enough pooled connections for the upload and worker thread pools, standard retries with
+# backoff for throttling and transient errors, and TCP keep-alive so idle pooled connections survive between polls
+CLIENT_CONFIG = Config(max_pool_connections=50,
+                       retries={'max_attempts': 10, 'mode': 'standard'},
+                       tcp_keepalive=True)
+
+_session: Optional[boto3.Session] = None
+_clients: Dict[str, object] = {}
+_clients_lock = threading.Lock()
+_resources = threading.local()
+
 
 def stac_to_msg_and_attributes(stac):
     """
@@ -41,20 +58,71 @@ def stac_to_msg_and_attributes(stac):
     return json.dumps(stac), message_attributes
 
 
-def publish_sns_message(sns_arn, message):
+def publish_sns_message(sns_arn, message, attributes: Optional[dict] = None):
     """Send an SNS Message"""
-    client = boto3.client("sns")
+    client = get_client("sns")
     client.publish(
         TopicArn=sns_arn,
         Message=message,
+        MessageAttributes=attributes or {},
     )
 
 
-def upload_directory(directory, bucket, prefix, boto3_session: boto3.Session = None):
-    """Recursively upload a directory to an s3 bucket"""
-    if boto3_session is None:
-        boto3_session = boto3.Session()
-    s3 = boto3_session.client("s3")
+def get_client(service: str):
+    """Return the boto3 client for `service`, created once and shared by every thread in this process
+
+    Creating a client costs tens of milliseconds of CPU and a credential lookup, and each one has its own connection
+    pool, so they are created once per process and reused.
+    """
+    with _clients_lock:
+        if service not in _clients:
+            _clients[service] = _get_session().client(service, config=CLIENT_CONFIG)
+        return _clients[service]
+
+
+def get_resource(service: str):
+    """Return the boto3 resource for `service`, created once per thread
+
+    Unlike clients, boto3 resources aren't thread safe, so each thread gets its own.
+    """
+    resources = _resources.__dict__
+    if service not in resources:
+        with _clients_lock:
+            resources[service] = _get_session().resource(service, config=CLIENT_CONFIG)
+    return resources[service]
+
+
+def _get_session() -> boto3.Session:
+    """The process wide session, which resolves credentials once. Sessions aren't thread safe, hold _clients_lock"""
+    global _session
+    if _session is None:
+        _session = boto3.Session()
+    return _session
+
+
+def reset_clients():
+    """Forget every cached session, client and resource
+
+    Called in child processes after a fork, because boto3 clients and their connection pools can't be shared between
+    processes. Each worker process creates its own on first use.
+    """
+    global _session, _clients_lock, _resources
+    _session = None
+    _clients.clear()
+    _clients_lock = threading.Lock()
+    _resources = threading.local()
+
+
+os.register_at_fork(after_in_child=reset_clients)
+
+
+def upload_directory(directory, bucket, prefix, boto3_session: boto3.Session = None, extra_args: dict = None):
+    """Recursively upload a directory to an s3 bucket
+
+    `extra_args`, eg. {'Metadata': {...}}, are applied to every uploaded object. If any file fails to upload, the
+    first error is raised once all the other uploads have finished.
+    """
+    s3 = get_client("s3") if boto3_session is None else boto3_session.client("s3")
 
     def error(e):
         raise e
@@ -68,8 +136,10 @@ def upload_directory(directory, bucket, prefix, boto3_session: boto3.Session = N
         s3.upload_file(
             Filename=filename,
             Bucket=bucket,
-            Key=(prefix + "/" if prefix else "") + os.path.relpath(filename, directory))
+            Key=(prefix + "/" if prefix else "") + os.path.relpath(filename, directory),
+            ExtraArgs=extra_args)
 
+    errors = []
     with futures.ThreadPoolExecutor() as executor:
         upload_task = {}
 
@@ -79,23 +149,319 @@ def upload_directory(directory, bucket, prefix, boto3_session: boto3.Session = N
         for task in futures.as_completed(upload_task):
             try:
                 task.result()
-            except Exception as e:
-                print("Exception {} encountered while uploading file {}".format(e, upload_task[task]))
+            except Exception as e:  # pylint: disable=broad-except
+                LOG.error(f'Unable to upload {upload_task[task]}: {e}')
+                errors.append(e)
 
+    # Every upload is finished or failed by now, so none are left running after the error is raised
+    if errors:
+        raise errors[0]
 
-def receive_messages(queue_url):
-    """Yield SQS Messages until the queue is empty"""
-    sqs = boto3.resource('sqs')
+
+def receive_message_batches(queue_url, batch_size: int = 10, wait_time_seconds: int = 20,
+                            max_empty_receives: Optional[int] = 1, yield_empty: bool = False):
+    """Yield batches of SQS Messages, long polling the queue
+
+    :param batch_size: maximum number of messages to receive per request, at most 10
+    :param wait_time_seconds: seconds to long poll for, at most 20. 0 for short polling
+    :param max_empty_receives: stop after this many consecutive receives return no messages, or None to poll
+                               forever
+    :param yield_empty: also yield an empty batch for each receive which returns no messages, so that consumers
+                        get a chance to catch up on their own work while the queue is idle
+    """
+    sqs = get_resource('sqs')
     queue = sqs.Queue(queue_url)
 
-    # Receive message from SQS queue
-    messages = queue.receive_messages(MaxNumberOfMessages=1)
+    empty_receives = 0
+    while max_empty_receives is None or empty_receives < max_empty_receives:
+        messages = queue.receive_messages(MaxNumberOfMessages=batch_size, WaitTimeSeconds=wait_time_seconds)
+        if messages:
+            empty_receives = 0
+            yield messages
+        else:
+            empty_receives += 1
+            if yield_empty:
+                yield []
+
+
+def receive_messages(queue_url, **kwargs):
+    """Yield SQS Messages until the queue is empty
+
+    Accepts the same keyword arguments as :func:`receive_message_batches`.
+    """
+    for messages in receive_message_batches(queue_url, **kwargs):
+        yield from messages
+
+
+def delete_messages(queue_url, messages) -> list:
+    """Delete SQS Messages in batches of up to 10
 
-    while len(messages) > 0:
+    :return: the messages which could not be deleted
+    """
+    sqs = get_resource('sqs')
+    queue = sqs.Queue(queue_url)
+
+    failed = []
+    for start in range(0, len(messages), 10):
+        batch = messages[start:start + 10]
+        response = queue.delete_messages(Entries=[{'Id': str(i), 'ReceiptHandle': message.receipt_handle}
+                                                  for i, message in enumerate(batch)])
+        for failure in response.get('Failed', []):
+            message = batch[int(failure['Id'])]
+            LOG.warning(f"Unable to delete message {message.message_id}: {failure.get('Message')}")
+            failed.append(message)
+    return failed
+
+
+class MessageDeleter:
+    """Acknowledge processed SQS Messages, deleting them in batches of up to 10
+
+    Pending messages are deleted once 10 have accumulated, once the oldest has waited `max_delay` seconds, or on
+    :meth:`flush`. If a :class:`VisibilityHeartbeat` is given, messages stay registered with it until they are
+    actually deleted. Use as a context manager to flush on exit.
+    """
+
+    def __init__(self, queue_url, heartbeat=None, max_delay: float = 30):
+        self.queue_url = queue_url
+        self.heartbeat = heartbeat
+        self.max_delay = max_delay
+        self._pending = []
+        self._oldest = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+    def add(self, message):
+        if not self._pending:
+            self._oldest = time.monotonic()
+        self._pending.append(message)
+        if len(self._pending) >= 10 or time.monotonic() - self._oldest >= self.max_delay:
+            self.flush()
+
+    def flush(self):
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        delete_messages(self.queue_url, pending)
+        if self.heartbeat is not None:
+            for message in pending:
+                self.heartbeat.remove(message)
+
+
+def send_batch_with_retries(send, entries: List[dict], description: str, max_attempts: int = 5,
+                            backoff: float = 0.2) -> Tuple[int, List[Tuple[dict, str]]]:
+    """Send up to 10 entries with a single batch request, eg. `send_message_batch` or `publish_batch`
+
+    :param send: makes the request, given the list of entries with their 'Id's added, returning the response with
+                 its 'Successful' and 'Failed' entries
+    :param description: what an entry is, for log messages, eg. 'SQS message'
+
+    Entries which fail for reasons other than a sender fault, and whole requests which fail, are retried with
+    exponential backoff, up to `max_attempts` times. Every entry which can't be sent is logged.
+
+    :return: the number of entries sent, and the `(entry, error)` of each which couldn't be
+    """
+    pending = {str(i): {'Id': str(i), **entry} for i, entry in enumerate(entries)}
+    sent, failed = 0, []
+
+    for attempt in range(max_attempts):
+        if not pending:
+            break
+        if attempt:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        try:
+            response = send(list(pending.values()))
+        except (BotoCoreError, ClientError) as e:
+            LOG.warning(f'Unable to send {description}s, retrying: {e}')
+            continue
+        for success in response.get('Successful', []):
+            del pending[success['Id']]
+            sent += 1
+        for failure in response.get('Failed', []):
+            error = failure.get('Message', failure['Code'])
+            if failure['SenderFault']:
+                failed.append((pending.pop(failure['Id']), error))
+            else:
+                LOG.debug(f'Retrying {description} which failed to send: {error}')
+
+    failed.extend((entry, f'Too many attempts ({max_attempts})') for entry in pending.values())
+    for _, error in failed:
+        LOG.error(f'Unable to send {description}: {error}')
+    return sent, failed
+
+
+class MessageSender:
+    """Send messages to an SQS Queue in batches of up to 10
+
+    Pending messages are sent with a single `send_message_batch` request once 10 have accumulated, or once another
+    would take the request past SQS's 256 KiB limit, or on :meth:`flush`. Entries which fail for reasons other than a
+    sender fault are retried on their own, with exponential backoff, up to `max_attempts` times. Use as a context
+    manager to flush on exit.
+
+    After flushing, :attr:`sent` counts the messages sent, and :attr:`failed` lists the `(body, error)` of each
+    message which couldn't be.
+    """
+    max_batch_bytes = 256 * 1024
+
+    def __init__(self, queue_url, max_attempts: int = 5, backoff: float = 0.2):
+        self.queue_url = queue_url
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.sent = 0
+        self.failed = []
+        self._pending = []
+        self._pending_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+    def add(self, body: str, attributes: Optional[dict] = None):
+        # Attributes can't be empty, so any missing from the STAC document are left out
+        attributes = {name: value for name, value in (attributes or {}).items()
+                      if value.get('StringValue') not in (None, 'None')}
+        size = len(body.encode()) + sum(len(name) + len(value['DataType']) + len(value.get('StringValue', ''))
+                                        for name, value in attributes.items())
+        if self._pending and self._pending_bytes + size > self.max_batch_bytes:
+            self.flush()
+        self._pending.append((body, attributes))
+        self._pending_bytes += size
+        if len(self._pending) >= 10:
+            self.flush()
+
+    def flush(self):
+        pending, self._pending, self._pending_bytes = self._pending, [], 0
+        if not pending:
+            return
+        client = get_client('sqs')
+        sent, failed = send_batch_with_retries(
+            lambda entries: client.send_message_batch(QueueUrl=self.queue_url, Entries=entries),
+            [{'MessageBody': body, 'MessageAttributes': attributes} for body, attributes in pending],
+            'SQS message', self.max_attempts, self.backoff)
+        self.sent += sent
+        self.failed.extend((entry['MessageBody'], error) for entry, error in failed)
+
+
+class SnsNotifier:
+    """Publish SNS notifications in batches of up to 10, from a background thread
+
+    :meth:`add` queues a message and returns immediately. The thread publishes waiting messages with a single
+    `publish_batch` request once 10 have accumulated, or `linger` seconds after the first of them arrived. Entries
+    which fail for reasons other than a sender fault are retried in the background, with exponential backoff, up to
+    `max_attempts` times. Use as a context manager, which publishes everything still waiting on exit.
+
+    After exiting, :attr:`sent` counts the messages published, and :attr:`failed` lists the `(message, error)` of
+    each message which couldn't be.
+    """
+    _stop = object()
+
+    def __init__(self, topic_arn, max_attempts: int = 5, backoff: float = 0.2, linger: float = 1.0):
+        self.topic_arn = topic_arn
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.linger = linger
+        self.sent = 0
+        self.failed = []
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='sns-notifier', daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._queue.put(self._stop)
+        self._thread.join()
+
+    def add(self, message: str, attributes: Optional[dict] = None):
+        self._queue.put((message, attributes or {}))
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            batch, deadline = [], time.monotonic() + self.linger
+            while True:
+                if item is self._stop:
+                    stopping = True
+                    break
+                batch.append(item)
+                if len(batch) >= 10:
+                    break
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+            if batch:
+                self._publish(batch)
+
+    def _publish(self, batch):
+        client = get_client('sns')
+        sent, failed = send_batch_with_retries(
+            lambda entries: client.publish_batch(TopicArn=self.topic_arn, PublishBatchRequestEntries=entries),
+            [{'Message': message, 'MessageAttributes': attributes} for message, attributes in batch],
+            'SNS message', self.max_attempts, self.backoff)
+        self.sent += sent
+        self.failed.extend((entry['Message'], error) for entry, error in failed)
+
+
+class VisibilityHeartbeat:
+    """Keep in flight SQS Messages hidden from other consumers
+
+    Runs a background thread which periodically extends the visibility timeout of every message registered with
+    :meth:`add`, until it is removed with :meth:`remove`. Use as a context manager.
+
+    :param visibility_timeout: seconds of visibility to request on each extension
+    :param interval: seconds between extensions, must be comfortably less than `visibility_timeout`
+    """
+
+    def __init__(self, visibility_timeout: int = 300, interval: int = 60):
+        self.visibility_timeout = visibility_timeout
+        self.interval = interval
+        self._messages = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='sqs-visibility-heartbeat', daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def add(self, message):
+        """Start extending the visibility of `message`, beginning immediately"""
+        self._change_visibility(message)
+        with self._lock:
+            self._messages[message.receipt_handle] = message
+
+    def remove(self, message):
+        with self._lock:
+            self._messages.pop(message.receipt_handle, None)
+
+    def extend(self):
+        """Extend the visibility timeout of all registered messages now"""
+        with self._lock:
+            messages = list(self._messages.values())
         for message in messages:
-            yield message
+            self._change_visibility(message)
 
-        messages = queue.receive_messages(MaxNumberOfMessages=1)
+    def _change_visibility(self, message):
+        try:
+            message.change_visibility(VisibilityTimeout=self.visibility_timeout)
+        except Exception as e:  # pylint: disable=broad-except
+            LOG.warning(f'Unable to extend visibility of message {message.message_id}: {e}')
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.extend()
 
 
 def asset_url_from_stac(stac_document, asset_type) -> Optional[str]:
@@ -145,12 +511,38 @@ def output_name_from_url(src_url,
     return relative_path, filename
 
 
+def object_metadata(s3_url) -> Optional[Dict[str, str]]:
+    """Return the user metadata of an S3 object, or None if it doesn't exist, without downloading it"""
+    bucket, key = url_to_bucket_and_key(s3_url)
+    try:
+        response = get_client('s3').head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+    return response['Metadata']
+
+
+def object_etag(s3_url) -> str:
+    """Return the ETag of an S3 object, which changes whenever it's replaced, without downloading it"""
+    bucket, key = url_to_bucket_and_key(s3_url)
+    return get_client('s3').head_object(Bucket=bucket, Key=key)['ETag']
+
+
+def input_fingerprint(s3_urls: Iterable[str]) -> str:
+    """Fingerprint a set of S3 objects by their URLs and ETags, without downloading them
+
+    The fingerprint changes whenever any of the objects is replaced.
+    """
+    etags = [f"{s3_url} {object_etag(s3_url)}" for s3_url in sorted(s3_urls)]
+    return hashlib.sha256('\n'.join(etags).encode()).hexdigest()
+
+
 def load_document_from_s3(s3_url):
     """Load a JSON document from an S3 URL"""
     bucket, key = url_to_bucket_and_key(s3_url)
     LOG.debug(f"Loading S3 object from Bucket: {bucket} Key: {key}")
-    s3_client = boto3.client('s3')
-    s3_response_object = s3_client.get_object(Bucket=bucket, Key=key)
+    s3_response_object = get_client('s3').get_object(Bucket=bucket, Key=key)
     return json.loads(s3_response_object['Body'].read())
 
 
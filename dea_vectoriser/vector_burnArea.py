@@ -1,12 +1,11 @@
 import geopandas as gp
+import numpy as np
 import pandas as pd
 import xarray as xr
-from fiona.crs import from_epsg
-from scipy import ndimage
-from typing import Tuple
-
-from skimage import morphology
-from skimage.morphology import ball
+from concurrent import futures
+from contextvars import copy_context
+from functools import partial
+from typing import Dict, Iterable, Optional, Tuple
 
 import geopandas as gp
 import rasterio.features
@@ -14,16 +13,43 @@ import xarray as xr
 from pathlib import Path
 from shapely.geometry import shape
 
-from dea_vectoriser.vectorise import vectorise_data
+from dea_vectoriser.morphology import close_erode_dilate, scale_reach
+from dea_vectoriser.profiling import count, stage
+from dea_vectoriser.raster_cache import open_raster
+from dea_vectoriser.raster_io import decimation
+from dea_vectoriser.tiled import Labelled, vectorise_tiled
+from dea_vectoriser.vectorise import simplify_to_crs, vectorise_data, vectorise_labels
+
+# Radius of the disk which threshold_Delta_dataset() and create_fmask_mask() close, erode and dilate with, at full
+# resolution
+MORPHOLOGY_RADIUS = 3
+
+# Pixels which can influence the result of threshold_Delta_dataset() and create_fmask_mask(): a closing, an erosion
+# and a dilation, each by disk(3)
+MORPHOLOGY_HALO = 4 * MORPHOLOGY_RADIUS
+
+# Default number of threads to load and process the four input rasters with
+DEFAULT_THREADS = 4
+
+# The burn index models, and the STAC asset each is loaded from
+BURN_INDICES = {'BSI': 'delta_bsi_asset_url', 'NDVI': 'delta_ndvi_asset_url', 'NBR': 'delta_nbr_asset_url'}
+
+# Threshold applied to each model for the likely burn area, and for the agreement between models
+BURN_AREA_THRESHOLDS = {'BSI': 0.1, 'NDVI': 0.1, 'NBR': 0.1}
+AGREEMENT_THRESHOLDS = {'BSI': 0.2, 'NDVI': 0.1, 'NBR': 0.1}
+
+# Values of the agreement raster from generate_burn_agreement(), and the label each is vectorised with
+AGREEMENT_LABELS = {1: 'low_agreement', 2: 'moderate_agreement', 3: 'high_agreement'}
 
-def load_burn_data(url) -> xr.Dataset:
-    """Open a GeoTIFF into an in memory DataArray
-    with DataArray labelled as given name"""
-    geotiff_burn = xr.open_rasterio(url)
-    burn_dataset = geotiff_burn.to_dataset('band')
+def load_burn_data(url, resolution_level: int = 0) -> xr.Dataset:
+    """Read a GeoTIFF into an in memory Dataset, with band 1 labelled 1 and its crs and transform as attributes"""
+    raster = open_raster(url, resolution_level=resolution_level)
+    burn_dataset = xr.Dataset({1: (('y', 'x'), raster.data)},
+                              attrs={'crs': raster.crs, 'transform': raster.transform})
     return burn_dataset
 
-def threshold_Delta_dataset(burn_dataset: xr.Dataset, threshold: float =0.5, greater: bool =True) -> xr.DataArray:
+def threshold_Delta_dataset(burn_dataset: xr.Dataset, threshold: float =0.5, greater: bool =True,
+                            radius: int = MORPHOLOGY_RADIUS) -> xr.DataArray:
     """Apply a threshold to in memory continuous dataset 
     For now, conduct erosion and dilation.
   
@@ -31,6 +57,7 @@ def threshold_Delta_dataset(burn_dataset: xr.Dataset, threshold: float =0.5, gre
             threshold to be applied to xr.Dataset
             direction of threshold to be conducted. Default TRUE means comparison will be conducted 
             as greater or equal to threshold value.
+            radius of the disk used for the morphology
     Output: a xr.DataArray containing 1,0 with 1 meeting the criteria of applied threshold
     """
 
@@ -43,18 +70,14 @@ def threshold_Delta_dataset(burn_dataset: xr.Dataset, threshold: float =0.5, gre
     else:
         threshold_data = ( burn_dataset[1] <= threshold )*1
 
-            # erode then dilate binary array by 2 iterations
-    dilated_data = xr.DataArray(morphology.binary_closing(threshold_data, morphology.disk(3)).astype(burn_dataset[1].dtype),
-                                 coords=burn_dataset[1].coords)
-    erroded_data = xr.DataArray(morphology.erosion(dilated_data, morphology.disk(3)).astype(burn_dataset[1].dtype),
-                                 coords=burn_dataset[1].coords)
-    dilated_data = xr.DataArray(ndimage.binary_dilation(erroded_data, morphology.disk(3)).astype(burn_dataset[1].dtype),
-                                 coords=burn_dataset[1].coords)
+    # close, erode then dilate binary array with a disk of radius 3
+    dilated_data = xr.DataArray(close_erode_dilate(threshold_data.data, radius).astype(burn_dataset[1].dtype),
+                                coords=burn_dataset[1].coords)
 
     
     return dilated_data
 
-def create_fmask_mask(fmask_dataset: xr.Dataset) -> xr.Dataset:
+def create_fmask_mask(fmask_dataset: xr.Dataset, radius: int = MORPHOLOGY_RADIUS) -> xr.Dataset:
     '''Create a mask from fmask and then dilate and erode data. 
     Include values (2: cloud 3: shadow 4: snow) in fmask
     mask that are therefore not equal to 1 or 5 (1: valid, 5: water). 
@@ -65,34 +88,52 @@ def create_fmask_mask(fmask_dataset: xr.Dataset) -> xr.Dataset:
     
     #make binary mask based on fmask
     fmask_mask =  (( fmask_dataset == 5 ) | ( fmask_dataset == 1  ))*1
-    # erode then dilate binary array by 2 iterations
-    dilated_data = xr.DataArray(morphology.binary_closing(fmask_mask[1], morphology.disk(3)).astype(fmask_dataset[1].dtype),
-                                 coords=fmask_dataset[1].coords)
-    erroded_data = xr.DataArray(morphology.erosion(dilated_data, morphology.disk(3)).astype(fmask_dataset[1].dtype),
-                                 coords=fmask_dataset[1].coords)
-    dilated_data = xr.DataArray(ndimage.binary_dilation(erroded_data, morphology.disk(3)).astype(fmask_dataset[1].dtype),
-                                 coords=fmask_dataset[1].coords)
+    # close, erode then dilate binary array with a disk of radius 3
+    dilated_data = xr.DataArray(close_erode_dilate(fmask_mask[1].data, radius).astype(fmask_dataset[1].dtype),
+                                coords=fmask_dataset[1].coords)
     
     return dilated_data
 
 
-def generate_burn_agreement(BSI_dataset: xr.Dataset, NDVI_dataset: xr.Dataset, NBR_dataset: xr.Dataset,) -> Tuple[xr.DataArray, xr.DataArray, xr.DataArray]:
+def threshold_masks(datasets: Dict[str, xr.Dataset], *thresholds: Dict[str, float]
+                    ) -> Dict[Tuple[str, float], xr.DataArray]:
+    """Threshold each burn index model once for every distinct threshold it is used with
+
+    Input: datasets: {model name: xr.Dataset}, eg. {'BSI': BSI_dataset}
+           thresholds: any number of {model name: threshold}, eg. BURN_AREA_THRESHOLDS, AGREEMENT_THRESHOLDS
+    Output: a cache of masks keyed by (model name, threshold), from which every product can be derived without
+            repeating the morphology
+    """
+    return {(index, threshold): threshold_Delta_dataset(datasets[index], threshold=threshold, greater=True)
+            for index, threshold in _distinct_thresholds(thresholds)}
+
+def _distinct_thresholds(thresholds: Iterable[Dict[str, float]]):
+    return sorted({(index, threshold) for index_thresholds in thresholds
+                   for index, threshold in index_thresholds.items()})
+
+def _select_masks(masks: Dict[Tuple[str, float], xr.DataArray], thresholds: Dict[str, float]):
+    """Select the BSI, NDVI and NBR masks for a product from a cache created by threshold_masks()"""
+    return [masks[index, thresholds[index]] for index in BURN_INDICES]
+
+def generate_burn_agreement(BSI_dataset: xr.Dataset, NDVI_dataset: xr.Dataset, NBR_dataset: xr.Dataset,) -> xr.DataArray:
     """combine the three burn index models into an agreement burn map. 
 
+    Output: xr.DataArray of uint8 agreement levels, the number of models which find burn:
+            1: low agreement, 2: moderate agreement, 3: high agreement (see AGREEMENT_LABELS)
+    """
+    masks = threshold_masks({'BSI': BSI_dataset, 'NDVI': NDVI_dataset, 'NBR': NBR_dataset}, AGREEMENT_THRESHOLDS)
+    return agreement_levels(*_select_masks(masks, AGREEMENT_THRESHOLDS))
+
+def agreement_levels(BSI_burn: xr.DataArray, NDVI_burn: xr.DataArray, NBR_burn: xr.DataArray) -> xr.DataArray:
+    """Count how many of the thresholded models find burn at each pixel, into a single uint8 label raster
+
+    Input: the 1,0 outputs of threshold_Delta_dataset() for each model
     """
-    BSI_burn = threshold_Delta_dataset(BSI_dataset, threshold=0.2, greater=True)
-    NDVI_burn = threshold_Delta_dataset(NDVI_dataset, threshold=0.1, greater=True)
-    NBR_burn = threshold_Delta_dataset(NBR_dataset, threshold=0.1, greater=True)
-    
-    combined_agreement = BSI_burn + NDVI_burn + NBR_burn
     #combine boolean arrays so that where two overlap value become 2, three overlap value becomes 3.
-    
-    lowagreement = (combined_agreement == 1) * 1
-    modagreement = (combined_agreement == 2) * 1
-    highagreement = (combined_agreement == 3) * 1
-    
-        
-    return [lowagreement, modagreement, highagreement]
+    levels = np.zeros(BSI_burn.shape, dtype=np.uint8)
+    for burn in (BSI_burn, NDVI_burn, NBR_burn):
+        levels += np.asarray(burn) == 1
+    return xr.DataArray(levels, coords=BSI_burn.coords)
 
 def generate_burn_area(BSI_dataset: xr.Dataset, NDVI_dataset: xr.Dataset, NBR_dataset: xr.Dataset,) -> xr.DataArray:
     """Take three simple models. Apply threshold to models and find where DNBR and at least one other model indicate burn area is likely.
@@ -104,10 +145,19 @@ def generate_burn_area(BSI_dataset: xr.Dataset, NDVI_dataset: xr.Dataset, NBR_da
     output: xr.Dataset, boolean values where burn is likely to have occured
 
     """
-    BSI_burn = threshold_Delta_dataset(BSI_dataset, threshold=0.1, greater=True) * 1
-    NDVI_burn = threshold_Delta_dataset(NDVI_dataset, threshold=0.1, greater=True) * 1
-    NBR_burn = threshold_Delta_dataset(NBR_dataset, threshold=0.1, greater=True) * 1
-    
+    masks = threshold_masks({'BSI': BSI_dataset, 'NDVI': NDVI_dataset, 'NBR': NBR_dataset}, BURN_AREA_THRESHOLDS)
+    return combine_burn_models(*_select_masks(masks, BURN_AREA_THRESHOLDS))
+
+def combine_burn_models(BSI_burn: xr.DataArray, NDVI_burn: xr.DataArray, NBR_burn: xr.DataArray) -> xr.DataArray:
+    """Find where the thresholded DNBR and at least one other thresholded model indicate burn area is likely.
+
+    Input: the 1,0 outputs of threshold_Delta_dataset() for each model
+    output: xr.DataArray, boolean values where burn is likely to have occured
+    """
+    BSI_burn = BSI_burn * 1
+    NDVI_burn = NDVI_burn * 1
+    NBR_burn = NBR_burn * 1
+
     stacked_agreement = (NBR_burn * BSI_burn) + (NBR_burn * NDVI_burn)
     
     likely_burn = stacked_agreement >= 1
@@ -115,25 +165,92 @@ def generate_burn_area(BSI_dataset: xr.Dataset, NDVI_dataset: xr.Dataset, NBR_da
         
     return(likely_burn)
 
-def simplify_vectors(burn_dataframe: gp.GeoDataFrame, tolerance:int=10)-> gp.GeoDataFrame:
-# Simplify
+def simplify_vectors(burn_dataframe: gp.GeoDataFrame, tolerance: int = 10,
+                     native: bool = False) -> gp.GeoDataFrame:
+    """Simplify in 'epsg:3577' to ensure consistent results, see :func:`dea_vectoriser.vectorise.simplify_to_crs`"""
+    return simplify_to_crs(burn_dataframe, tolerance, native=native)
 
-    # change to 'epsg:3577' prior to simplifiying to insure consistent results
-    burn_dataframe = burn_dataframe.to_crs('epsg:3577')
 
-    # Run simplification with 10 tolerance
-    simplified_burn_shapes = burn_dataframe.simplify(10)
+def _load_and_threshold(url, thresholds: Iterable[float], resolution_level: int = 0) -> Dict[float, xr.DataArray]:
+    """Load a burn index raster and threshold it at each of `thresholds`, in a worker thread"""
+    burn_dataset = load_burn_data(url, resolution_level=resolution_level)
+    count('raster_bytes', burn_dataset[1].nbytes)
+    radius = scale_reach(MORPHOLOGY_RADIUS, decimation(resolution_level))
+    return {threshold: threshold_Delta_dataset(burn_dataset, threshold=threshold, greater=True, radius=radius)
+            for threshold in thresholds}
 
-    # Put simplified shapes in a dataframe
-    simple_burnt_dataframe = gp.GeoDataFrame(geometry=simplified_burn_shapes,
-                                      crs=from_epsg('3577'))
 
-    # add attribute labels back in
-    simple_burnt_dataframe['attribute'] = burn_dataframe['attribute']
-    
-    return(simple_burnt_dataframe)
+def _load_and_mask_fmask(url, resolution_level: int = 0) -> Tuple[xr.DataArray, xr.Dataset]:
+    """Load an fmask raster and create its mask, in a worker thread. Also returns the raster, for its georeferencing"""
+    fmask_raster = load_burn_data(url, resolution_level=resolution_level)
+    count('raster_bytes', fmask_raster[1].nbytes)
+    radius = scale_reach(MORPHOLOGY_RADIUS, decimation(resolution_level))
+    return create_fmask_mask(fmask_raster, radius=radius), fmask_raster
 
-def vectorise_burn(raster_urls) -> gp.GeoDataFrame:
+
+def _product_thresholds(include_agreement: bool):
+    return [BURN_AREA_THRESHOLDS, AGREEMENT_THRESHOLDS] if include_agreement else [BURN_AREA_THRESHOLDS]
+
+
+def load_burn_layers(raster_urls, threads: int = DEFAULT_THREADS, include_agreement: bool = False,
+                     resolution_level: int = 0
+                     ) -> Tuple[xr.DataArray, Optional[xr.DataArray], xr.DataArray, xr.Dataset]:
+    """Load the dBSI, dNDVI, dNBR and fmask rasters concurrently, and generate the burn area and fmask mask
+
+    Each raster is thresholded (or masked) in the thread which downloaded it, as soon as it arrives, so the
+    processing of early rasters overlaps with downloading the rest. The morphology releases the GIL, so with
+    enough `threads` the four pipelines also run on separate cores, sharing their arrays without copying.
+
+    Each model is thresholded once per distinct threshold, and the masks shared between the burn area and, if
+    `include_agreement`, the agreement levels.
+
+    At a lower `resolution_level`, the rasters are read decimated and the morphology scaled down to match.
+
+    Output: burn area, agreement levels (or None), fmask mask, and the fmask raster for its crs and transform
+    """
+    thresholds = _distinct_thresholds(_product_thresholds(include_agreement))
+    with futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        # Each task runs in a copy of this context, so that it's counted in the scene being profiled
+        index_masks = {index: executor.submit(copy_context().run, _load_and_threshold, raster_urls[asset],
+                                              [threshold for name, threshold in thresholds if name == index],
+                                              resolution_level)
+                       for index, asset in BURN_INDICES.items()}
+        fmask = executor.submit(copy_context().run, _load_and_mask_fmask, raster_urls['fmask_asset_url'],
+                                resolution_level)
+
+        masks = {(index, threshold): mask for index, future in index_masks.items()
+                 for threshold, mask in future.result().items()}
+        fmask_mask, fmask_raster = fmask.result()
+
+    burn_area = combine_burn_models(*_select_masks(masks, BURN_AREA_THRESHOLDS))
+    agreement = agreement_levels(*_select_masks(masks, AGREEMENT_THRESHOLDS)) if include_agreement else None
+    return burn_area, agreement, fmask_mask, fmask_raster
+
+
+def _tile_burn_layers(tiles, executor: futures.Executor, include_agreement: bool = False):
+    """Generate the burn area, fmask mask, and optionally agreement levels of a single tile, for vectorise_tiled()
+
+    The pipelines are run concurrently using `executor`.
+    """
+    BSI_tile, NDVI_tile, NBR_tile, fmask_tile = (xr.Dataset({1: (('y', 'x'), tile)}) for tile in tiles)
+    datasets = {'BSI': BSI_tile, 'NDVI': NDVI_tile, 'NBR': NBR_tile}
+    masks = {(index, threshold): executor.submit(threshold_Delta_dataset, datasets[index], threshold=threshold,
+                                                 greater=True)
+             for index, threshold in _distinct_thresholds(_product_thresholds(include_agreement))}
+    fmask_mask = executor.submit(create_fmask_mask, fmask_tile)
+    masks = {key: mask.result() for key, mask in masks.items()}
+
+    layers = {'potential_burn': combine_burn_models(*_select_masks(masks, BURN_AREA_THRESHOLDS)).data,
+              'not_analysed': fmask_mask.result().data}
+    if include_agreement:
+        # the agreement levels don't overlap, so all three are vectorised together in a single pass
+        layers['agreement'] = Labelled(agreement_levels(*_select_masks(masks, AGREEMENT_THRESHOLDS)).data,
+                                       AGREEMENT_LABELS)
+    return layers
+
+
+def vectorise_burn(raster_urls, tile_size: Optional[int] = None, threads: int = DEFAULT_THREADS,
+                   include_agreement: bool = False, resolution_level: int = 0) -> gp.GeoDataFrame:
     """Load from S3 dBSI, dNBR, dNDVI, and fmask rasters and
      produces two vector products. Add fmask mask to outputs.
     
@@ -144,18 +261,21 @@ def vectorise_burn(raster_urls) -> gp.GeoDataFrame:
         
     dNBRGPD: Burnt area defined only by delta Normalised Burn Ratio. Burn area is greater than 0.1 
     Rahman et al. 2018 found this a good threshold to define burn area using sentinel 2. 
+
+    tile_size: if set, process the rasters in tiles of this many pixels square, rather than loading them all into
+    memory at once
+
+    threads: number of threads to load and process the four rasters with
+
+    include_agreement: also output the agreement levels between the three burn models, labelled with
+    AGREEMENT_LABELS
+
+    resolution_level: if above 0, create a low detail preview from the rasters decimated by 2 ** resolution_level,
+    read from their overviews, with the morphology scaled to match. Previews are small enough that tile_size is
+    ignored
     
     """
     
-    BSI_raster = load_burn_data(raster_urls['delta_bsi_asset_url'])
-    NDVI_raster = load_burn_data(raster_urls['delta_ndvi_asset_url'])
-    NBR_raster = load_burn_data(raster_urls['delta_nbr_asset_url'])
-    fmask_raster = load_burn_data(raster_urls['fmask_asset_url'])
-    
-    dataset_crs = from_epsg(BSI_raster.crs[11:])
-    dataset_transform = BSI_raster.transform
-    # grab crs from input tiff
-    
 #     # Extract date from the first file path. Assumes that the last four path elements are year/month/day/YYYYMMDDTHHMMSS
     year, month, day, time = str(raster_urls['delta_bsi_asset_url']).split('/')[-5:-1]
     time_hour =time[-6:-4]
@@ -163,22 +283,44 @@ def vectorise_burn(raster_urls) -> gp.GeoDataFrame:
     obs_date = f'{year}-{month}-{day}T{time_hour}:{time_mins}:00:0Z'
 #     obs_date = '2021-08-05T00:00:00:0Z'
     
-    #do the science to the input dataset generate likely burn area 
-    burn_area_dataset = generate_burn_area(BSI_raster, NDVI_raster, NBR_raster)
+    if tile_size and not resolution_level:
+        urls = [raster_urls[key] for key in ('delta_bsi_asset_url', 'delta_ndvi_asset_url',
+                                             'delta_nbr_asset_url', 'fmask_asset_url')]
+        with futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            vectors = vectorise_tiled(urls, partial(_tile_burn_layers, executor=executor,
+                                                    include_agreement=include_agreement),
+                                      tile_size, halo=MORPHOLOGY_HALO)
+        burn_area_GPD = vectors[vectors['attribute'] == 'potential_burn']
+        fmaskGPD = vectors[vectors['attribute'] == 'not_analysed']
+        agreementGPD = vectors[vectors['attribute'].isin(AGREEMENT_LABELS.values())] if include_agreement else None
+    else:
+        # load the rasters concurrently and do the science to generate likely burn area, and create mask to
+        # highlight not-valid data
+        # Reading overlaps thresholding and morphology, so they're a single stage
+        with stage('load'):
+            burn_area_dataset, agreement, fmask_mask, fmask_raster = load_burn_layers(raster_urls, threads,
+                                                                                      include_agreement,
+                                                                                      resolution_level)
 
-    #create mask to create highlight not-valid data
-    fmask_mask = create_fmask_mask(fmask_raster)
+        # grab crs from input tiff
+        dataset_crs = fmask_raster.crs
+        dataset_transform = fmask_raster.transform
 
-    # vectorise the arrays
-    burn_area_GPD = vectorise_data(burn_area_dataset, dataset_transform, dataset_crs, label='potential_burn') #unsure if should change this lable?
-    fmaskGPD = vectorise_data(fmask_mask, dataset_transform, dataset_crs, label= 'not_analysed')
+        # vectorise the arrays
+        with stage('shapes'):
+            burn_area_GPD = vectorise_data(burn_area_dataset, dataset_transform, dataset_crs, label='potential_burn') #unsure if should change this lable?
+            fmaskGPD = vectorise_data(fmask_mask, dataset_transform, dataset_crs, label= 'not_analysed')
+            # the agreement levels don't overlap, so all three are vectorised together in a single pass
+            agreementGPD = vectorise_labels(agreement, dataset_transform, dataset_crs,
+                                            labels=AGREEMENT_LABELS) if include_agreement else None
 
     #Do simplification here if desiered
 #     burn_area_GPD = simplify_vectors(burn_area_GPD, tolerance=10)
 #     fmaskGPD = simplify_vectors(fmaskGPD, tolerance=10)
     
 #     Join layers together
-    Burn_agreement = gp.GeoDataFrame(pd.concat([burn_area_GPD, fmaskGPD],
+    layers = [burn_area_GPD, fmaskGPD] if agreementGPD is None else [burn_area_GPD, fmaskGPD, agreementGPD]
+    Burn_agreement = gp.GeoDataFrame(pd.concat(layers,
                                             ignore_index=True), crs=burn_area_GPD.crs)
 
     # add observation date as new attribute
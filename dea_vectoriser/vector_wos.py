@@ -15,26 +15,54 @@ Read in WOs GeoTIFF, Convert to Vectors
 from pathlib import Path
 
 import geopandas as gp
+import numpy as np
 import pandas as pd
 import xarray as xr
-from fiona.crs import from_epsg
-from scipy import ndimage
-from typing import Tuple, Union
+from typing import Optional, Tuple, Union
 import logging
 from dea_vectoriser.utils import (asset_url_from_stac)
 
-from dea_vectoriser.vectorise import vectorise_data
+from dea_vectoriser.morphology import erode_dilate, scale_reach
+from dea_vectoriser.profiling import count, stage
+from dea_vectoriser.raster_cache import open_raster
+from dea_vectoriser.raster_io import decimation
+from dea_vectoriser.tiled import vectorise_tiled
+from dea_vectoriser.vectorise import simplify_to_crs, vectorise_data
 LOG = logging.getLogger(__name__)
 
-def load_wos_data(url) -> xr.Dataset:
-    """Open a GeoTIFF info an in memory DataArray """
-    geotiff_wos = xr.open_rasterio(url)
-    wos_dataset = geotiff_wos.to_dataset('band')
-    wos_dataset = wos_dataset.rename({1: 'wo'})
+# Erosions and dilations applied to each layer by generate_raster_layers(), at full resolution
+EROSIONS, DILATIONS = 2, 3
+
+# Pixels which can influence the result of generate_raster_layers(): 2 erosions followed by 3 dilations
+MORPHOLOGY_HALO = EROSIONS + DILATIONS
+
+# Simplification tolerances in metres of each layer, at full resolution
+WATER_TOLERANCE, NOT_ANALYSED_TOLERANCE = 10, 15
+
+# Class values in the output of classify_wos()
+DRY, WATER, NOT_ANALYSED = 0, 1, 2
+
+# Lookup table from every possible uint8 WO bit value to its class. Only 128 is water, and the listed values are
+# 'dry', everything else has been masked and is not analysed.
+WO_CLASS_LUT = np.full(256, NOT_ANALYSED, dtype=np.uint8)
+WO_CLASS_LUT[[0, 1, 2, 8, 130, 142]] = DRY
+WO_CLASS_LUT[128] = WATER
+
+
+def load_wos_data(url, resolution_level: int = 0) -> xr.Dataset:
+    """Read a WO GeoTIFF into an in memory Dataset, with its crs and transform as attributes"""
+    raster = open_raster(url, dtype=np.uint8, resolution_level=resolution_level)
+    wos_dataset = xr.Dataset({'wo': (('y', 'x'), raster.data)},
+                             attrs={'crs': raster.crs, 'transform': raster.transform})
     return wos_dataset
 
 
-def generate_raster_layers(wos_dataset: xr.Dataset) -> Tuple[xr.DataArray, xr.DataArray]:
+def classify_wos(wo: np.ndarray) -> np.ndarray:
+    """Classify a uint8 water observation raster into DRY, WATER and NOT_ANALYSED in a single lookup table pass"""
+    return WO_CLASS_LUT[wo]
+
+
+def generate_raster_layers(wos_dataset: xr.Dataset, resolution_level: int = 0) -> Tuple[xr.DataArray, xr.DataArray]:
     """Convert in memory water observation raster to vector format.
 
     Defining the three 'classes':
@@ -44,85 +72,103 @@ def generate_raster_layers(wos_dataset: xr.Dataset) -> Tuple[xr.DataArray, xr.Da
     c) Not_analysed: every masking applied to the data except terrain shadow.
        bit values: composed of everything else,
 
+    At a lower `resolution_level`, the morphology is scaled down to cover roughly the same ground distance.
+
     Return
         Dilated Water Vector, Dilated Not Analysed Vector
     """
-    # 1 create binary arrays for two classes of interest
-    water_vals = (wos_dataset.wo == 128)  # water only has 128 water observations
-    # here we used reversed logic to turn all pixels that should be 'not analysed' to a value of 3. is is easier to
-    # list the 4 classes that are passed to the unlabled 'dry' class
-    not_analysed = wos_dataset.wo.where(((wos_dataset.wo == 0) | (wos_dataset.wo == 1) | (wos_dataset.wo == 8)
-                                         | (wos_dataset.wo == 2) | (wos_dataset.wo == 128) | (wos_dataset.wo == 130) | (
-                                                 wos_dataset.wo == 142)), 3)
-    not_analysed = not_analysed.where((not_analysed == 3), 0)  # now keep the 3 values and make everything else 0
+    # 1 classify every pixel in a single pass, then create binary arrays for two classes of interest
+    classes = classify_wos(wos_dataset.wo.data)
+    water_vals = classes == WATER
+    not_analysed = classes == NOT_ANALYSED
     # 2 conduct binary erosion and closing to remove single pixels
-    erroded_water = xr.DataArray(ndimage.binary_erosion(water_vals, iterations=2).astype(water_vals.dtype),
-                                 coords=water_vals.coords)
-    erroded_not_analysed = xr.DataArray(ndimage.binary_erosion(not_analysed, iterations=2).astype(not_analysed.dtype),
-                                        coords=not_analysed.coords)
     # dilating cloud 3 times after eroding 2, to create small overlap and illuminate gaps in data
-    dilated_water = xr.DataArray(ndimage.binary_dilation(erroded_water, iterations=3).astype(water_vals.dtype),
-                                 coords=water_vals.coords)
-    dilated_not_analysed = xr.DataArray(
-        ndimage.binary_dilation(erroded_not_analysed, iterations=3).astype(not_analysed.dtype),
-        coords=not_analysed.coords)
+    # The two layers are dilated separately, and vectorised separately, because they are meant to overlap
+    factor = decimation(resolution_level)
+    erosions, dilations = scale_reach(EROSIONS, factor), scale_reach(DILATIONS, factor)
+    dilated_water = xr.DataArray(erode_dilate(water_vals, erosions=erosions, dilations=dilations),
+                                 coords=wos_dataset.wo.coords)
+    dilated_not_analysed = xr.DataArray(erode_dilate(not_analysed, erosions=erosions, dilations=dilations),
+                                        coords=wos_dataset.wo.coords)
 
     return dilated_water, dilated_not_analysed
 
 
-def vectorise_wos(raster_urls) -> gp.GeoDataFrame:
-    """Load a Water Observation raster and convert to In Memory Vector"""
+def _tile_raster_layers(tiles):
+    """Run generate_raster_layers() on a single tile, for vectorise_tiled()"""
+    dilated_water, dilated_not_analysed = generate_raster_layers(xr.Dataset({'wo': (('y', 'x'), tiles[0])}))
+    return {'Water': dilated_water.data, 'Not_analysed': dilated_not_analysed.data}
+
+
+def vectorise_wos(raster_urls, tile_size: Optional[int] = None, simplify_native: bool = False,
+                  resolution_level: int = 0) -> gp.GeoDataFrame:
+    """Load a Water Observation raster and convert to In Memory Vector
+
+    :param tile_size: if set, process the raster in tiles of this many pixels square, rather than loading it all
+                      into memory at once
+    :param simplify_native: simplify in the raster's own CRS before reprojecting, see
+                            :func:`dea_vectoriser.vectorise.simplify_to_crs`
+    :param resolution_level: if above 0, create a low detail preview from the raster decimated by
+                             ``2 ** resolution_level``, read from its overviews. The morphology and simplification
+                             tolerances are scaled to match. Previews are small enough that `tile_size` is ignored
+    """
+    vectors = trace_wos(raster_urls, tile_size, resolution_level)
+    return simplify_wos(vectors, simplify_native, resolution_level)
+
+
+def trace_wos(raster_urls, tile_size: Optional[int] = None, resolution_level: int = 0) -> gp.GeoDataFrame:
+    """Load a Water Observation raster and trace its Water and Not_analysed polygons, without simplifying them
+
+    The polygons are in the raster's CRS. See :func:`vectorise_wos` for the parameters.
+    """
 
     input_raster_url = raster_urls['wofs_asset_url']
     LOG.debug(f"Found GeoTIFF URL: {input_raster_url}")
 
-    raster = load_wos_data(input_raster_url)
-    print(raster.dims)
-    dataset_crs = from_epsg(raster.crs[11:])
-    dataset_transform = raster.transform
-    # grab crs from input tiff
-
     # Extract date from the file path. Assumes that the last four path elements are year/month/day/YYYYMMDDTHHMMSS
     year, month, day, time = str(input_raster_url).split('/')[-5:-1]
     time_hour =time[-6:-4]
     time_mins =time[-4:-2]
     obs_date = f'{year}-{month}-{day}T{time_hour}:{time_mins}:00:0Z'
 
-    dilated_water, dilated_not_analysed = generate_raster_layers(raster)
-
-    # vectorise the arrays
-    notAnalysedGPD = vectorise_data(dilated_not_analysed, dataset_transform, dataset_crs, label='Not_analysed')
-
-    WaterGPD = vectorise_data(dilated_water, dataset_transform, dataset_crs, label='Water')
-
-    # Simplify
-
-    # change to 'epsg:3577' prior to simplifiying to insure consistent results
-    notAnalysedGPD = notAnalysedGPD.to_crs('epsg:3577')
-    WaterGPD = WaterGPD.to_crs('epsg:3577')
-
-    # Run simplification with 15 tolerance
-    simplified_water = WaterGPD.simplify(10)
-
-    simplified_not_analysed = notAnalysedGPD.simplify(15)
-
-    # Put simplified shapes in a dataframe
-    simple_waterGPD = gp.GeoDataFrame(geometry=simplified_water,
-                                      crs=from_epsg('3577'))
-
-    simple_notAnalysedGPD = gp.GeoDataFrame(geometry=simplified_not_analysed,
-                                            crs=from_epsg('3577'))
-
-    # add attribute labels back in
-    simple_waterGPD['attribute'] = WaterGPD['attribute']
-
-    simple_notAnalysedGPD['attribute'] = notAnalysedGPD['attribute']
-
-    # 6 Join layers together
-
-    all_classes = gp.GeoDataFrame(pd.concat([simple_waterGPD, simple_notAnalysedGPD], ignore_index=True),
-                                  crs=simple_notAnalysedGPD.crs)
+    if tile_size and not resolution_level:
+        vectors = vectorise_tiled([input_raster_url], _tile_raster_layers, tile_size, halo=MORPHOLOGY_HALO)
+        notAnalysedGPD = vectors[vectors['attribute'] == 'Not_analysed']
+        WaterGPD = vectors[vectors['attribute'] == 'Water']
+    else:
+        with stage('read'):
+            raster = load_wos_data(input_raster_url, resolution_level)
+        count('raster_bytes', raster.wo.nbytes)
+        # grab crs from input tiff
+        dataset_crs = raster.crs
+        dataset_transform = raster.transform
+
+        with stage('morphology'):
+            dilated_water, dilated_not_analysed = generate_raster_layers(raster, resolution_level)
+
+        # vectorise the arrays
+        with stage('shapes'):
+            notAnalysedGPD = vectorise_data(dilated_not_analysed, dataset_transform, dataset_crs,
+                                            label='Not_analysed')
+
+            WaterGPD = vectorise_data(dilated_water, dataset_transform, dataset_crs, label='Water')
+
+    # Join layers together, Water first
+    all_classes = gp.GeoDataFrame(pd.concat([WaterGPD, notAnalysedGPD], ignore_index=True), crs=WaterGPD.crs)
     # add observation date as new attribute
     all_classes['Observed_date'] = obs_date
 
     return all_classes
+
+
+def simplify_wos(vectors: gp.GeoDataFrame, simplify_native: bool = False, resolution_level: int = 0
+                 ) -> gp.GeoDataFrame:
+    """Simplify the output of :func:`trace_wos` in 'epsg:3577', with each class at its own tolerance"""
+    factor = decimation(resolution_level)
+    simple_waterGPD = simplify_to_crs(vectors[vectors['attribute'] == 'Water'], WATER_TOLERANCE * factor,
+                                      native=simplify_native)
+    simple_notAnalysedGPD = simplify_to_crs(vectors[vectors['attribute'] == 'Not_analysed'],
+                                            NOT_ANALYSED_TOLERANCE * factor, native=simplify_native)
+
+    return gp.GeoDataFrame(pd.concat([simple_waterGPD, simple_notAnalysedGPD], ignore_index=True),
+                           crs=simple_notAnalysedGPD.crs)
@@ -2,49 +2,68 @@
 Tools for converting in memory raster data into geopandas vector data.
 """
 import geopandas as gp
+import numpy as np
+import pandas as pd
 import rasterio.features
+import shapely
 import xarray as xr
+from pyproj import Transformer
+from io import BytesIO
 from pathlib import Path
-from shapely.geometry import shape
 from tempfile import TemporaryDirectory
+from typing import Dict, Iterable, Optional, Tuple
 
-from dea_vectoriser.utils import LOG, url_to_bucket_and_key, upload_directory
+from dea_vectoriser.profiling import count, stage
+from dea_vectoriser.utils import LOG, get_client, url_to_bucket_and_key, upload_directory
 
 # Maps from Format Name: File extension
 OUTPUT_FORMATS = {
     'Shapefile': '.shp',
     'GeoJSON': '.json',
-    'GPKG': '.gpkg'
+    'GPKG': '.gpkg',
+    'FlatGeobuf': '.fgb',
+    'GeoParquet': '.parquet',
 }
 
+# Formats which are a single file that can be written sequentially, and so are uploaded straight from memory.
+# The rest are written to a temporary directory, either for random access (GPKG) or for their sidecar files.
+STREAMED_FORMATS = {'GeoJSON', 'FlatGeobuf', 'GeoParquet'}
+
+# Cloud optimised formats, which are written with features sorted along a Hilbert curve so that nearby features
+# are stored together, and a small area can be read with a few ranged requests.
+SPATIALLY_SORTED_FORMATS = {'FlatGeobuf', 'GeoParquet'}
+
+# Equal area CRS the vectors are simplified and written in, for consistent results across UTM zones
+OUTPUT_CRS = 'epsg:3577'
+
+# Features per GeoParquet row group. Each row group records the bounding box of its features in the statistics of
+# its bbox columns, which readers use to skip row groups outside an area of interest.
+PARQUET_ROW_GROUP_SIZE = 10_000
+
 
 def vectorise_data(data_array: xr.DataArray, transform, crs, label='Label'):
     """Return a vector representation of the input raster.
 
     Input
-    data_array: an xarray.DataArray with boolean values (1,0) with 1 or True equal to the areas that will be turned
-                into vectors
+    data_array: an xarray.DataArray or numpy array with boolean values (1,0) with 1 or True equal to the areas that
+                will be turned into vectors
     label: default 'Label', String, the data label that will be added to each geometry in geodataframe
 
     Output
     Geodataframe containing shapely geometries with data type label in a series called attribute"""
 
-    vector = rasterio.features.shapes(
-        data_array.data.astype('float32'),
-        mask=data_array.data.astype('float32') == 1,  # this defines which part of array becomes polygons
-        transform=transform)
+    data = np.asarray(data_array.data if isinstance(data_array, xr.DataArray) else data_array)
 
-    # rasterio.features.shapes outputs tuples. we only want the polygon coordinate portions of the tuples
-    vectored_data = list(vector)  # put tuple output in list
+    # this defines which part of array becomes polygons. A boolean raster is already its own mask, without a copy
+    mask = data if data.dtype == bool else data == 1
 
-    # Extract the polygon coordinates from the list
-    polygons = [polygon for polygon, value in vectored_data]
+    # Every polygon has the value 1, so the mask doubles as the uint8 source raster, again without a copy
+    vector = rasterio.features.shapes(mask.view(np.uint8), mask=mask, transform=transform)
 
-    # create a list with the data label type
-    labels = [label for _ in polygons]
+    polygons, _ = polygons_from_shapes(vector)
 
-    # Convert polygon coordinates into polygon shapes
-    polygons = [shape(polygon) for polygon in polygons]
+    # A categorical column stores the label once, rather than once per polygon
+    labels = pd.Categorical.from_codes(np.zeros(len(polygons), dtype=np.int8), categories=[label])
 
     # Create a geopandas dataframe populated with the polygon shapes
     data_gdf = gp.GeoDataFrame(data={'attribute': labels},
@@ -53,31 +72,273 @@ def vectorise_data(data_array: xr.DataArray, transform, crs, label='Label'):
     return data_gdf
 
 
+def vectorise_labels(data_array: xr.DataArray, transform, crs, labels: Dict[int, str]):
+    """Return a vector representation of a raster of several classes which don't overlap, in a single pass.
+
+    Input
+    data_array: an xarray.DataArray or numpy array of integer class values
+    labels: {raster value: label} for each class to vectorise. Pixels with any other value are not vectorised
+
+    Output
+    Geodataframe containing shapely geometries with their class label in a series called attribute"""
+
+    data = np.asarray(data_array.data if isinstance(data_array, xr.DataArray) else data_array)
+
+    mask = np.isin(data, list(labels))
+    polygons, values = polygons_from_shapes(rasterio.features.shapes(data, mask=mask, transform=transform))
+
+    codes = pd.Index(list(labels)).get_indexer(values.astype(data.dtype))
+    return gp.GeoDataFrame(data={'attribute': pd.Categorical.from_codes(codes, categories=list(labels.values()))},
+                           geometry=polygons,
+                           crs=crs)
+
+
+def simplify_to_crs(vector_data: gp.GeoDataFrame, tolerance: float, crs=OUTPUT_CRS,
+                    native: bool = False) -> gp.GeoDataFrame:
+    """Reproject vector data to `crs` and simplify it with a `tolerance` in the units of `crs`
+
+    By default the vectors are reprojected and then simplified. With `native`, they are simplified in their own
+    projected CRS with the tolerance scaled to match, and only the much smaller simplified geometry is reprojected.
+    Between UTM and Albers the scale varies by well under 1% across a scene, so the result differs only in which
+    vertices are borderline. Data in a geographic CRS is always reprojected first.
+
+    Attribute columns are carried along unchanged.
+    """
+    if not native or vector_data.empty or vector_data.crs.is_geographic:
+        with stage('reproject'):
+            vector_data = vector_data.to_crs(crs)
+        with stage('simplify'):
+            return vector_data.set_geometry(vector_data.geometry.simplify(tolerance))
+
+    with stage('simplify'):
+        simplified = vector_data.set_geometry(vector_data.geometry.simplify(tolerance / crs_scale(vector_data, crs)))
+    with stage('reproject'):
+        return simplified.to_crs(crs)
+
+
+def crs_scale(vector_data: gp.GeoDataFrame, crs) -> float:
+    """Return the length in `crs` of a unit length in the CRS of `vector_data`, at the centre of its bounds"""
+    minx, miny, maxx, maxy = vector_data.total_bounds
+    centre_x, centre_y = (minx + maxx) / 2, (miny + maxy) / 2
+    step = max(maxx - minx, maxy - miny) / 100 or 1.0
+
+    transformer = Transformer.from_crs(vector_data.crs, crs, always_xy=True)
+    xs, ys = transformer.transform([centre_x, centre_x + step, centre_x], [centre_y, centre_y, centre_y + step])
+    return (np.hypot(xs[1] - xs[0], ys[1] - ys[0]) + np.hypot(xs[2] - xs[0], ys[2] - ys[0])) / (2 * step)
+
+
+def simplify_coverage(polygons: np.ndarray, tolerance: float) -> np.ndarray:
+    """Simplify an array of polygons which don't overlap, so that neighbours still share the edges they had in common
+
+    The boundaries of all the polygons are noded into edges which meet only at their ends, where three or more
+    polygons meet (or a single polygon's ring closes). Each edge is simplified once, keeping its ends fixed, so both
+    polygons on either side of a shared edge get the same simplified edge. The simplified edges are polygonised, and
+    each face assigned to the input polygon it overlaps the most. Faces which are mostly outside every polygon, ie.
+    holes and gaps, are dropped, and polygons too small to keep a face of their own are returned empty.
+    """
+    if len(polygons) == 0:
+        return polygons.copy()
+
+    edges = shapely.get_parts(shapely.line_merge(shapely.union_all(shapely.boundary(polygons))))
+    # Edges are simplified independently, so may now cross each other, and are noded again before polygonising
+    edges = shapely.union_all(shapely.simplify(edges, tolerance, preserve_topology=True))
+    faces = shapely.get_parts(shapely.polygonize(shapely.get_parts(edges)))
+
+    face_positions, polygon_positions = shapely.STRtree(polygons).query(faces, predicate='intersects')
+    overlaps = shapely.area(shapely.intersection(faces[face_positions], polygons[polygon_positions]))
+    # The polygon each face overlaps the most, unless more of the face is outside every polygon
+    best = pd.DataFrame({'face': face_positions, 'polygon': polygon_positions, 'overlap': overlaps})
+    outside = shapely.area(faces) - best.groupby('face')['overlap'].sum().reindex(range(len(faces)), fill_value=0)
+    best = best.loc[best.groupby('face')['overlap'].idxmax()]
+    best = best[best['overlap'] > outside[best['face']].to_numpy()]
+
+    simplified = np.full(len(polygons), shapely.Polygon(), dtype=object)
+    for polygon, face_group in best.groupby('polygon')['face']:
+        parts = faces[face_group.to_numpy()]
+        simplified[polygon] = parts[0] if len(parts) == 1 else shapely.union_all(parts)
+    return simplified
+
+
+def generalise(vector_data: gp.GeoDataFrame, tolerances: Iterable[float], coverages: Iterable[Iterable[str]] = (),
+               output_crs=None) -> Dict[str, gp.GeoDataFrame]:
+    """Simplify vectors at each of `tolerances`, in metres, into a pyramid of levels of detail
+
+    Every level is derived from the same vectors, so the rasters are only read and traced once. For the best
+    results, pass vectors which haven't already been simplified.
+
+    Polygons which don't overlap are simplified together as a coverage, so they keep their shared edges, see
+    :func:`simplify_coverage`. By default each value of the 'attribute' column is a coverage of its own, and
+    `coverages` can group several values whose polygons don't overlap each other, eg. the levels of a label raster.
+    Polygons smaller than the tolerance may be absorbed by their neighbours, and are left out of that level.
+
+    Levels are simplified in the CRS of `vector_data`, with the tolerance scaled from metres in OUTPUT_CRS, and
+    then reprojected to `output_crs` if it's given. Reprojecting moves shared vertices identically, so shared
+    edges stay shared.
+
+    :return: {layer name: simplified vectors}, named eg. 'simplified_50m'
+    """
+    polygons = vector_data.geometry.to_numpy()
+    if 'attribute' in vector_data:
+        attributes = vector_data['attribute'].astype(str).to_numpy()
+        groups = {value: value for value in np.unique(attributes)}
+        for coverage in coverages:
+            groups.update({value: tuple(sorted(coverage)) for value in coverage})
+        groups = pd.Series(attributes).map(groups)
+        coverage_positions = list(groups.groupby(groups).indices.values())
+    else:
+        coverage_positions = [np.arange(len(polygons))]
+    scale = crs_scale(vector_data, OUTPUT_CRS) if len(polygons) else 1.0
+
+    levels = {}
+    for tolerance in tolerances:
+        simplified = polygons.copy()
+        with stage('simplify'):
+            for positions in coverage_positions:
+                simplified[positions] = simplify_coverage(polygons[positions], tolerance / scale)
+        level = vector_data.set_geometry(gp.GeoSeries(simplified, index=vector_data.index, crs=vector_data.crs))
+        level = level[~level.geometry.is_empty]
+        if output_crs is not None:
+            with stage('reproject'):
+                level = level.to_crs(output_crs)
+        levels[f'simplified_{tolerance:g}m'] = level
+    return levels
+
+
+def polygons_from_shapes(shapes) -> Tuple[np.ndarray, np.ndarray]:
+    """Convert the output of rasterio.features.shapes() into an array of shapely Polygons, and their values
+
+    The GeoJSON like output is consumed as it is generated, collecting the coordinates of every ring into one flat
+    array, so the polygons can be created in bulk instead of one Python object at a time.
+    """
+    coords = []
+    ring_offsets = [0]
+    polygon_offsets = [0]
+    values = []
+    for geometry, value in shapes:
+        for ring in geometry['coordinates']:
+            coords.extend(ring)
+            ring_offsets.append(len(coords))
+        polygon_offsets.append(len(ring_offsets) - 1)
+        values.append(value)
+
+    polygons = shapely.from_ragged_array(shapely.GeometryType.POLYGON,
+                                         np.array(coords, dtype='float64').reshape(-1, 2),
+                                         (np.array(ring_offsets), np.array(polygon_offsets)))
+    return polygons, np.array(values)
+
+
+def spatially_sort(vector_data: gp.GeoDataFrame) -> gp.GeoDataFrame:
+    """Sort features along a Hilbert curve through their bounding box centres"""
+    if vector_data.empty:
+        return vector_data
+    return vector_data.iloc[np.argsort(vector_data.geometry.hilbert_distance(), kind='stable')]
+
+
+def write_vector(vector_data: gp.GeoDataFrame, destination, output_format='GPKG', layer: Optional[str] = None):
+    """Write vector data to a local path or a file like object
+
+    FlatGeobuf is written with its packed Hilbert R-tree spatial index, and GeoParquet with bbox columns whose row
+    group statistics act as a coarse spatial index. GeoParquet requires pyarrow.
+
+    A `layer` name adds the vector data to an existing GPKG as another layer.
+    """
+    if output_format in SPATIALLY_SORTED_FORMATS:
+        vector_data = spatially_sort(vector_data)
+
+    if output_format == 'GeoParquet':
+        bounds = vector_data.geometry.bounds
+        vector_data = vector_data.assign(bbox_xmin=bounds['minx'], bbox_ymin=bounds['miny'],
+                                         bbox_xmax=bounds['maxx'], bbox_ymax=bounds['maxy'])
+        vector_data.to_parquet(destination, index=False, row_group_size=PARQUET_ROW_GROUP_SIZE)
+    elif output_format == 'FlatGeobuf':
+        vector_data.to_file(destination, driver=output_format, SPATIAL_INDEX='YES')
+    elif layer is not None:
+        vector_data.to_file(destination, driver=output_format, layer=layer)
+    else:
+        vector_data.to_file(destination, driver=output_format)
+
+
+def vector_output_url(dest_prefix: str, filename: str, output_format='GPKG') -> str:
+    """Return the URL which save_vector_to_s3() writes to, for the same arguments"""
+    bucket, key_prefix = url_to_bucket_and_key(dest_prefix)
+    key = (key_prefix + "/" if key_prefix else "") + filename + OUTPUT_FORMATS[output_format]
+    return f"s3://{bucket}/{key}"
+
+
 def save_vector_to_s3(
-        vector_data: gp.GeoDataFrame, dest_prefix: str, filename: str, output_format='GPKG') -> str:
+        vector_data: gp.GeoDataFrame, dest_prefix: str, filename: str, output_format='GPKG',
+        metadata: Optional[Dict[str, str]] = None, layers: Optional[Dict[str, gp.GeoDataFrame]] = None) -> str:
     """Save a GeoPandas Vector to an AWS S3 Object
 
     :param vector_data: Vector data to serialise to S3
     :param dest_prefix: An S3 URL prefix. Eg: 's3://my-bucket/prefix/paths
     :param filename: Filename without an extension
     :param output_format: Vector format to create
+    :param metadata: S3 user metadata to store with the written object(s)
+    :param layers: More vector data to save alongside, by name, eg. from :func:`generalise`. A GPKG stores them as
+                   extra layers of the same file, and other formats as separate objects named `<filename>_<name>`
 
     :return: string URL of written S3 Object. (Some formats may write multiple objects)
     """
     LOG.debug(f'Saving vector output to path: {dest_prefix}, filename: {filename}')
 
-    # Append the correct file extension to the filename
-    filename = filename + OUTPUT_FORMATS[output_format]
+    # Each layer's filename, with the correct file extension appended
+    extension = OUTPUT_FORMATS[output_format]
+    layers = {name: _writable(layer) for name, layer in (layers or {}).items()}
+    filenames = {name: f'{filename}_{name}{extension}' for name in layers}
+    filename = filename + extension
 
     bucket, key_prefix = url_to_bucket_and_key(dest_prefix)
     LOG.debug(f'Saving Vector output into Bucket: {bucket} with Prefix: {key_prefix}')
+    extra_args = {'Metadata': metadata} if metadata else None
+
+    vector_data = _writable(vector_data)
+
+    if output_format in STREAMED_FORMATS:
+        # The main object is uploaded last, so that once it exists, so do all the layers
+        for name, layer in layers.items():
+            _stream_to_s3(layer, bucket, (key_prefix + "/" if key_prefix else "") + filenames[name], output_format,
+                          extra_args)
+        key = (key_prefix + "/" if key_prefix else "") + filename
+        _stream_to_s3(vector_data, bucket, key, output_format, extra_args)
+        return f"s3://{bucket}/{key}"
 
     with TemporaryDirectory() as tmpdir:
         tmpdir = Path(tmpdir)
 
         LOG.debug(f'Writing Vector data to local file: {tmpdir / filename}')
-        vector_data.to_file(tmpdir / filename, driver=output_format)
+        with stage('write'):
+            write_vector(vector_data, tmpdir / filename, output_format)
+            for name, layer in layers.items():
+                if output_format == 'GPKG':
+                    write_vector(layer, tmpdir / filename, output_format, layer=name)
+                else:
+                    write_vector(layer, tmpdir / filenames[name], output_format)
+        count('bytes_written', sum(path.stat().st_size for path in tmpdir.iterdir()))
 
         LOG.debug(f'Uploading {tmpdir} to Bucket: {bucket} Prefix: {key_prefix}')
-        upload_directory(tmpdir, bucket, key_prefix)
+        with stage('upload'):
+            upload_directory(tmpdir, bucket, key_prefix, extra_args=extra_args)
     return f"s3://{bucket}/{key_prefix}/{filename}"
+
+
+def _writable(vector_data: gp.GeoDataFrame) -> gp.GeoDataFrame:
+    """Fiona is unable to write categorical columns, write their values instead"""
+    categorical_columns = vector_data.select_dtypes('category').columns
+    if len(categorical_columns):
+        vector_data = vector_data.astype({column: str for column in categorical_columns})
+    return vector_data
+
+
+def _stream_to_s3(vector_data: gp.GeoDataFrame, bucket: str, key: str, output_format: str, extra_args):
+    """Write vector data in a streamed format into memory, and upload it to S3"""
+    buffer = BytesIO()
+    with stage('write'):
+        write_vector(vector_data, buffer, output_format)
+    buffer.seek(0)
+    count('bytes_written', buffer.getbuffer().nbytes)
+
+    LOG.debug(f'Uploading {buffer.getbuffer().nbytes} bytes from memory to Bucket: {bucket} Key: {key}')
+    # Large outputs are sent as a multipart upload, in parallel parts
+    with stage('upload'):
+        get_client('s3').upload_fileobj(buffer, bucket, key, ExtraArgs=extra_args)
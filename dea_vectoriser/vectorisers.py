@@ -0,0 +1,213 @@
+"""
+The vectoriser algorithms, and a registry of them by name
+
+Each algorithm is a :class:`Vectoriser`, which declares the STAC assets it reads and hints for scheduling it: how
+much memory it needs, how far its morphology reaches across tile seams, and whether several scenes can safely be
+processed in parallel processes.
+
+Algorithms from other packages are discovered through the ``dea_vectoriser.vectorisers`` entry point group, eg. in
+``setup.cfg``::
+
+    [options.entry_points]
+    dea_vectoriser.vectorisers =
+        my_product = my_package.vectorisers:MyProductVectoriser
+"""
+import abc
+import logging
+import os
+from importlib.metadata import entry_points
+from pathlib import PurePosixPath
+from typing import Dict, FrozenSet, Iterable, Optional, Tuple, Type
+
+import geopandas as gp
+
+from dea_vectoriser import vector_burnArea, vector_wos
+from dea_vectoriser.raster_io import decimation
+from dea_vectoriser.utils import VectoriserException, asset_url_from_stac, output_name_from_url
+from dea_vectoriser.vectorise import OUTPUT_CRS, generalise
+
+LOG = logging.getLogger(__name__)
+
+ENTRY_POINT_GROUP = 'dea_vectoriser.vectorisers'
+
+# Shape of a Sentinel-2 tile at 10m, the largest scene routinely processed. Used for memory estimates when the
+# actual size isn't known yet.
+TYPICAL_SCENE_SHAPE = (10980, 10980)
+
+
+class Vectoriser(abc.ABC):
+    """Converts the raster assets of one STAC dataset into a GeoDataFrame
+
+    Subclasses set the class attributes and implement :meth:`vectorise`.
+    """
+    #: Name used to select the algorithm, eg. with --algorithm
+    name: str = ''
+
+    #: {key in the raster_urls passed to vectorise(): STAC asset type}
+    assets: Dict[str, str] = {}
+
+    #: The STAC asset type whose URL names the output
+    output_asset: str = ''
+
+    #: Keyword options accepted by vectorise(), which are passed through from the command line when set
+    options: FrozenSet[str] = frozenset()
+
+    #: Pixels of context needed around each tile for tiled processing to match processing whole rasters
+    halo: int = 0
+
+    #: Approximate peak bytes of memory needed per pixel of raster held in memory
+    bytes_per_pixel: float = 0
+
+    #: Whether scenes can be processed in several processes at once
+    parallel_safe: bool = True
+
+    #: Groups of output attribute values which tile the plane without overlapping, and are generalised together so
+    #: neighbouring polygons keep their shared edges. Other attribute values are each generalised on their own
+    coverages: Tuple[FrozenSet[str], ...] = ()
+
+    def asset_urls(self, stac_document) -> Dict[str, str]:
+        """Return the raster_urls for vectorise() from a STAC document"""
+        raster_urls = {}
+        for key, asset_type in self.assets.items():
+            url = asset_url_from_stac(stac_document, asset_type)
+            if url is None:
+                raise VectoriserException(f"STAC document {stac_document.get('id')} has no '{asset_type}' asset, "
+                                          f"required by the {self.name} vectoriser")
+            raster_urls[key] = url
+        return raster_urls
+
+    def output_name(self, stac_document, resolution_level: int = 0) -> Tuple[PurePosixPath, str]:
+        """Return the relative output directory and filename (without extension) for a STAC document
+
+        Previews at a lower `resolution_level` are named for their decimation, eg. ``<filename>_preview4x``, so they
+        sit alongside the full resolution output.
+        """
+        relative_path, filename = output_name_from_url(asset_url_from_stac(stac_document, self.output_asset))
+        if resolution_level:
+            filename = f'{filename}_preview{decimation(resolution_level)}x'
+        return relative_path, filename
+
+    def memory_estimate(self, shape: Tuple[int, int] = TYPICAL_SCENE_SHAPE, tile_size: Optional[int] = None,
+                        resolution_level: int = 0) -> int:
+        """Approximate peak bytes of memory needed to process a scene of `shape` (height, width) pixels"""
+        height, width = shape
+        if resolution_level:
+            # Previews are never tiled
+            factor = decimation(resolution_level)
+            return int(-(-height // factor) * -(-width // factor) * self.bytes_per_pixel)
+        if tile_size:
+            height = min(height, tile_size + 2 * self.halo)
+            width = min(width, tile_size + 2 * self.halo)
+        return int(height * width * self.bytes_per_pixel)
+
+    @abc.abstractmethod
+    def vectorise(self, raster_urls: Dict[str, str], **options) -> gp.GeoDataFrame:
+        """Convert the rasters at `raster_urls`, keyed as in :attr:`assets`, into vectors"""
+
+    def vectorise_pyramid(self, raster_urls: Dict[str, str], tolerances: Iterable[float], **options
+                          ) -> Tuple[gp.GeoDataFrame, Dict[str, gp.GeoDataFrame]]:
+        """Vectorise, and generalise the result into levels of detail, see :func:`dea_vectoriser.vectorise.generalise`
+
+        Returns the vectors and the levels. Algorithms which simplify their output override this to generalise the
+        polygons before simplifying them, so each level is simplified only once.
+        """
+        vectors = self.vectorise(raster_urls, **options)
+        return vectors, generalise(vectors, tolerances, self.coverages)
+
+
+class WofsVectoriser(Vectoriser):
+    """Water Observations, see :func:`dea_vectoriser.vector_wos.vectorise_wos`"""
+    name = 'wofs'
+    assets = {'wofs_asset_url': 'water'}
+    output_asset = 'water'
+    options = frozenset({'tile_size', 'simplify_native', 'resolution_level'})
+    halo = vector_wos.MORPHOLOGY_HALO
+    # The uint8 raster, its classes, two boolean layers and the morphology's working copies
+    bytes_per_pixel = 8
+
+    def vectorise(self, raster_urls, **options):
+        return vector_wos.vectorise_wos(raster_urls, **options)
+
+    def vectorise_pyramid(self, raster_urls, tolerances, simplify_native=False, resolution_level=0, **options):
+        traced = vector_wos.trace_wos(raster_urls, resolution_level=resolution_level, **options)
+        vectors = vector_wos.simplify_wos(traced, simplify_native, resolution_level)
+        return vectors, generalise(traced, tolerances, self.coverages, output_crs=OUTPUT_CRS)
+
+
+class BurnsVectoriser(Vectoriser):
+    """Burnt area, see :func:`dea_vectoriser.vector_burnArea.vectorise_burn`"""
+    name = 'burns'
+    assets = {
+        'delta_nbr_asset_url': 'delta_nbr',
+        'delta_ndvi_asset_url': 'delta_ndvi',
+        'delta_bsi_asset_url': 'delta_bsi',
+        'fmask_asset_url': 'fmask',
+    }
+    output_asset = 'delta_nbr'
+    options = frozenset({'tile_size', 'threads', 'include_agreement', 'resolution_level'})
+    halo = vector_burnArea.MORPHOLOGY_HALO
+    # Three float32 indices, their float32 threshold masks, fmask and its mask, and the combined burn area
+    bytes_per_pixel = 40
+    # Each pixel is labelled with a single level of agreement
+    coverages = (frozenset(vector_burnArea.AGREEMENT_LABELS.values()),)
+
+    def vectorise(self, raster_urls, **options):
+        return vector_burnArea.vectorise_burn(raster_urls, **options)
+
+
+VECTORISERS: Dict[str, Vectoriser] = {}
+
+
+def register_vectoriser(vectoriser_class: Type[Vectoriser]):
+    """Make a Vectoriser available by its name"""
+    VECTORISERS[vectoriser_class.name] = vectoriser_class()
+    return vectoriser_class
+
+
+def _load_entry_points():
+    points = entry_points()
+    points = points.select(group=ENTRY_POINT_GROUP) if hasattr(points, 'select') else points.get(ENTRY_POINT_GROUP, [])
+    for point in points:
+        try:
+            register_vectoriser(point.load())
+        except Exception:  # pylint: disable=broad-except
+            LOG.exception(f'Unable to load vectoriser {point.name} from {point.value}')
+
+
+def get_vectoriser(name: str) -> Vectoriser:
+    try:
+        return VECTORISERS[name]
+    except KeyError:
+        raise VectoriserException(f"Unknown vectoriser algorithm {name!r}, must be one of "
+                                  f"{', '.join(VECTORISERS)}") from None
+
+
+def plan_workers(vectoriser: Vectoriser, requested: int, tile_size: Optional[int] = None,
+                 available_memory: Optional[int] = None, resolution_level: int = 0) -> int:
+    """Return how many worker processes to run `vectoriser` with, at most `requested`
+
+    Algorithms which aren't parallel safe get a single worker, and the rest are limited to as many as fit in
+    `available_memory` (by default, the physical memory of this machine) at their memory estimate.
+    """
+    if requested > 1 and not vectoriser.parallel_safe:
+        LOG.warning(f'The {vectoriser.name} vectoriser is not parallel safe, using a single worker')
+        return 1
+
+    if available_memory is None:
+        try:
+            available_memory = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        except (AttributeError, ValueError, OSError):
+            return requested
+
+    estimate = vectoriser.memory_estimate(tile_size=tile_size, resolution_level=resolution_level)
+    fit = max(1, available_memory // estimate) if estimate else requested
+    if fit < requested:
+        LOG.warning(f'Using {fit} workers rather than {requested}, each {vectoriser.name} scene needs about '
+                    f'{estimate / 2 ** 30:.1f} GiB of memory. Set --tile-size to reduce it')
+        return fit
+    return requested
+
+
+register_vectoriser(WofsVectoriser)
+register_vectoriser(BurnsVectoriser)
+_load_entry_points()
@@ -1,11 +1,13 @@
 import json
+import time
+from types import SimpleNamespace
 
 import boto3
-import xarray as xr
 from click.testing import CliRunner
 
-from dea_vectoriser.cli import cli as dea_vectoriser_cli
-from dea_vectoriser.utils import load_document_from_s3, stac_to_msg_and_attributes, receive_messages, \
+from dea_vectoriser.cli import cli as dea_vectoriser_cli, process_messages_in_pool
+from dea_vectoriser.raster_io import read_band
+from dea_vectoriser.utils import get_client, load_document_from_s3, stac_to_msg_and_attributes, receive_messages, \
     url_to_bucket_and_key
 
 DESTINATION_BUCKET = 'second-bucket'
@@ -15,8 +17,7 @@ def test_process_from_queue(samples_on_s3, sample_data, sqs, monkeypatch):
     # `moto` is unable to mock AWS S3, since the IO happens within compiled GDAL, not within Python
     # Instead, we'll replace the call to rasterio to load a local file instead
     sample_tiff = list(sample_data.glob('**/*.tif'))[0]
-    sample_xarray = xr.open_rasterio(sample_tiff)
-    monkeypatch.setattr('dea_vectoriser.vector_wos.xr.open_rasterio', lambda _: sample_xarray)
+    monkeypatch.setattr('dea_vectoriser.raster_io.read_band', lambda _, *args: read_band(sample_tiff, *args))
 
     # Send STAC messages to our mocked SQS Queue, Ready for the CLI to receive for processing
     stac_urls = [url for url in samples_on_s3 if url.endswith('json')]
@@ -35,6 +36,7 @@ def test_process_from_queue(samples_on_s3, sample_data, sqs, monkeypatch):
     result = runner.invoke(dea_vectoriser_cli,
                            ['process-sqs-messages',
                             '--destination', f"s3://{DESTINATION_BUCKET}/",
+                            '--wait-time-seconds', '1',
                             queue_url])
 
     print(result.stdout)
@@ -46,12 +48,126 @@ def test_process_from_queue(samples_on_s3, sample_data, sqs, monkeypatch):
     assert len(response['Contents']) == len(stac_urls)
 
 
+def test_process_from_queue_with_workers(samples_on_s3, sample_data, sqs, monkeypatch):
+    # Open the sample separately in each worker process, a forked GDAL file handle can't be shared between them
+    sample_tiff = list(sample_data.glob('**/*.tif'))[0]
+    monkeypatch.setattr('dea_vectoriser.raster_io.read_band', lambda _, *args: read_band(sample_tiff, *args))
+
+    stac_urls = [url for url in samples_on_s3 if url.endswith('json')]
+    client = boto3.client("sqs")
+    queue_url = client.get_queue_url(QueueName="first-queue")['QueueUrl']
+
+    for obj_url in stac_urls:
+        stac_document = load_document_from_s3(obj_url)
+        msg, msg_attribs = stac_to_msg_and_attributes(stac_document)
+        client.send_message(QueueUrl=queue_url,
+                            MessageBody=msg,
+                            MessageAttributes=msg_attribs)
+
+    runner = CliRunner()
+    result = runner.invoke(dea_vectoriser_cli,
+                           ['process-sqs-messages',
+                            '--destination', f"s3://{DESTINATION_BUCKET}/",
+                            '--workers', '2',
+                            '--wait-time-seconds', '1',
+                            queue_url])
+
+    print(result.stdout)
+    assert result.exit_code == 0
+
+    # Worker processes write to their own copy of the mocked S3, but messages are only deleted once processed
+    # successfully, so the queue should now be completely empty
+    attributes = client.get_queue_attributes(
+        QueueUrl=queue_url,
+        AttributeNames=['ApproximateNumberOfMessages', 'ApproximateNumberOfMessagesNotVisible'])['Attributes']
+    assert attributes['ApproximateNumberOfMessages'] == '0'
+    assert attributes['ApproximateNumberOfMessagesNotVisible'] == '0'
+
+
+def test_process_from_queue_leaves_failed_messages(samples_on_s3, sample_data, sqs, monkeypatch):
+    sample_tiff = list(sample_data.glob('**/*.tif'))[0]
+    monkeypatch.setattr('dea_vectoriser.raster_io.read_band', lambda _, *args: read_band(sample_tiff, *args))
+
+    stac_url = [url for url in samples_on_s3 if url.endswith('json')][0]
+    client = boto3.client("sqs")
+    queue_url = client.get_queue_url(QueueName="first-queue")['QueueUrl']
+    # A document without the assets the algorithm needs fails, but mustn't stop the others being processed
+    client.send_message(QueueUrl=queue_url, MessageBody=json.dumps({'id': 'no-assets'}))
+    msg, msg_attribs = stac_to_msg_and_attributes(load_document_from_s3(stac_url))
+    client.send_message(QueueUrl=queue_url, MessageBody=msg, MessageAttributes=msg_attribs)
+
+    result = CliRunner().invoke(dea_vectoriser_cli,
+                                ['process-sqs-messages',
+                                 '--destination', f"s3://{DESTINATION_BUCKET}/",
+                                 '--wait-time-seconds', '1',
+                                 queue_url])
+
+    assert result.exit_code == 0
+    assert len(boto3.client('s3').list_objects_v2(Bucket=DESTINATION_BUCKET)['Contents']) == 1
+    # The failed message is left in flight, to reappear once its visibility timeout expires
+    attributes = client.get_queue_attributes(
+        QueueUrl=queue_url,
+        AttributeNames=['ApproximateNumberOfMessages', 'ApproximateNumberOfMessagesNotVisible'])['Attributes']
+    assert attributes['ApproximateNumberOfMessages'] == '0'
+    assert attributes['ApproximateNumberOfMessagesNotVisible'] == '1'
+
+
+class RecordingDeleter:
+    def __init__(self):
+        self.added = []
+        self.flushes = 0
+
+    def add(self, message):
+        self.added.append(message)
+
+    def flush(self):
+        self.flushes += 1
+
+
+def _convert_id(stac_document, notify):
+    notify(stac_document['id'], {})
+    return stac_document['id']
+
+
+def test_pool_collects_finished_messages_while_queue_is_idle():
+    message = SimpleNamespace(message_id='1', receipt_handle='1', body=json.dumps({'id': 'scene'}))
+    heartbeat = SimpleNamespace(add=lambda message: None, remove=lambda message: None)
+    deleter = RecordingDeleter()
+    notifications = []
+
+    def batches():
+        yield [message]
+        # With --max-empty-receives 0 an idle queue never ends, but empty receives still let the pool catch up
+        deadline = time.monotonic() + 30
+        while not deleter.added and time.monotonic() < deadline:
+            time.sleep(0.05)
+            yield []
+        assert deleter.added == [message]
+        assert deleter.flushes > 0
+        assert notifications == [('scene', {})]
+
+    process_messages_in_pool(batches(), 2, heartbeat, deleter, _convert_id,
+                             notify=lambda *notification: notifications.append(notification))
+
+
+def test_pool_leaves_malformed_messages():
+    malformed = SimpleNamespace(message_id='1', receipt_handle='1', body=json.dumps({'foo': 1}))
+    good = SimpleNamespace(message_id='2', receipt_handle='2', body=json.dumps({'id': 'scene'}))
+    removed = []
+    heartbeat = SimpleNamespace(add=lambda message: None, remove=removed.append)
+    deleter = RecordingDeleter()
+
+    process_messages_in_pool(iter([[malformed, good]]), 2, heartbeat, deleter, _convert_id)
+
+    assert removed == [malformed]
+    assert deleter.added == [good]
+
+
 def test_set_args_from_env_variables(samples_on_s3, sample_data, monkeypatch, sns, sqs):
     # `moto` is unable to mock AWS S3, since the IO happens within compiled GDAL, not within Python
     # Instead, we'll replace the call to rasterio to load a local file instead
     sample_tiff = list(sample_data.glob('**/*.tif'))[0]
-    sample_xarray = xr.open_rasterio(sample_tiff)
-    monkeypatch.setattr('dea_vectoriser.vector_wos.xr.open_rasterio', lambda _: sample_xarray)
+    monkeypatch.setattr('dea_vectoriser.raster_io.read_band', lambda _, *args: read_band(sample_tiff, *args))
 
     sample_stac = [sample for sample in samples_on_s3 if sample.endswith('json')][0]
 
@@ -83,7 +199,7 @@ def test_set_args_from_env_variables(samples_on_s3, sample_data, monkeypatch, sn
     assert len(response['Contents']) == 1
 
     # Check that a single SNS message was sent
-    messages = list(receive_messages(queue.url))
+    messages = list(receive_messages(queue.url, wait_time_seconds=1))
     assert len(messages) == 1
     for message in messages:
         body = json.loads(message.body)
@@ -93,3 +209,88 @@ def test_set_args_from_env_variables(samples_on_s3, sample_data, monkeypatch, sn
         bucket, key = url_to_bucket_and_key(s3_url)
         response = s3_client.head_object(Bucket=bucket, Key=key)
         assert response
+
+
+def test_s3_to_sqs(samples_on_s3, sqs):
+    stac_urls = [url for url in samples_on_s3 if url.endswith('json')]
+    queue_url = boto3.client("sqs").get_queue_url(QueueName="first-queue")['QueueUrl']
+
+    # One URL on the command line, the rest from stdin, along with one which doesn't exist
+    runner = CliRunner()
+    result = runner.invoke(dea_vectoriser_cli,
+                           ['s3-to-sqs', '--queue-url', queue_url, '--from-file', '-', stac_urls[0]],
+                           input='\n'.join([*stac_urls[1:], 's3://first-bucket/missing.stac-item.json']) + '\n')
+
+    assert result.exit_code == 1
+    assert '1 STAC documents could not be submitted' in result.output
+
+    sent = sorted(json.loads(message.body)['id'] for message in receive_messages(queue_url, wait_time_seconds=1))
+    assert sent == sorted(load_document_from_s3(url)['id'] for url in stac_urls)
+
+
+def test_run_from_s3_url_with_jobs_and_manifest(samples_on_s3, sample_data, s3, tmp_path, monkeypatch):
+    # Open the sample separately in each worker process, a forked GDAL file handle can't be shared between them
+    sample_tiff = list(sample_data.glob('**/*.tif'))[0]
+    monkeypatch.setattr('dea_vectoriser.raster_io.read_band', lambda _, *args: read_band(sample_tiff, *args))
+
+    stac_urls = sorted(url for url in samples_on_s3 if url.endswith('json'))
+    missing_url = 's3://first-bucket/missing.stac-item.json'
+    manifest = tmp_path / 'manifest.jsonl'
+    args = ['run-from-s3-url', '--destination', f"s3://{DESTINATION_BUCKET}/", '--jobs', '2',
+            '--manifest', str(manifest), *stac_urls, missing_url]
+
+    runner = CliRunner()
+    result = runner.invoke(dea_vectoriser_cli, args)
+    assert result.exit_code == 1
+
+    records = [json.loads(line) for line in manifest.read_text().splitlines()]
+    statuses = {record['url']: record['status'] for record in records}
+    assert statuses == {**{url: 'done' for url in stac_urls}, missing_url: 'failed'}
+    assert all(record['output'].startswith(f"s3://{DESTINATION_BUCKET}/")
+               for record in records if record['status'] == 'done')
+
+    # Rerunning only retries the document which failed
+    result = runner.invoke(dea_vectoriser_cli, args)
+    assert result.exit_code == 1
+    records = [json.loads(line) for line in manifest.read_text().splitlines()]
+    assert [record['url'] for record in records[len(statuses):]] == [missing_url]
+
+
+def test_failed_notifications_fail_the_command(samples_on_s3, sample_data, monkeypatch, sns):
+    sample_tiff = list(sample_data.glob('**/*.tif'))[0]
+    monkeypatch.setattr('dea_vectoriser.raster_io.read_band', lambda _, *args: read_band(sample_tiff, *args))
+    topic_arn = boto3.client('sns').list_topics()['Topics'][0]['TopicArn']
+
+    def rejecting_publish_batch(TopicArn, PublishBatchRequestEntries):
+        return {'Successful': [], 'Failed': [{'Id': entry['Id'], 'SenderFault': True, 'Code': 'InvalidParameter'}
+                                             for entry in PublishBatchRequestEntries]}
+
+    monkeypatch.setattr(get_client('sns'), 'publish_batch', rejecting_publish_batch)
+
+    sample_stac = [sample for sample in samples_on_s3 if sample.endswith('json')][0]
+    result = CliRunner().invoke(dea_vectoriser_cli,
+                                ['run-from-s3-url',
+                                 '--destination', f"s3://{DESTINATION_BUCKET}/",
+                                 '--sns-topic', topic_arn,
+                                 sample_stac])
+
+    assert result.exit_code != 0
+    assert '1 SNS notifications could not be published' in result.output
+
+
+def test_include_agreement_is_passed_to_burns(monkeypatch):
+    calls = []
+    monkeypatch.setattr('dea_vectoriser.cli.convert_s3_url', lambda s3_url, **kwargs: calls.append(kwargs))
+
+    for algorithm in ['burns', 'wofs']:
+        result = CliRunner().invoke(dea_vectoriser_cli,
+                                    ['run-from-s3-url',
+                                     '--destination', f"s3://{DESTINATION_BUCKET}/",
+                                     '--algorithm', algorithm,
+                                     '--include-agreement',
+                                     's3://first-bucket/example.json'])
+        assert result.exit_code == 0, result.output
+
+    burns, wofs = calls
+    assert burns['include_agreement'] is True
+    assert 'include_agreement' not in wofs
@@ -0,0 +1,27 @@
+from dea_vectoriser.manifest import DONE, FAILED, Manifest
+
+
+def test_resume_after_torn_line(tmp_path):
+    path = tmp_path / 'manifest.jsonl'
+    with Manifest(path) as manifest:
+        manifest.record('a', DONE, output='s3://bucket/a.gpkg')
+    # The run was killed while writing its next line
+    with path.open('a') as f:
+        f.write('{"url": "b", "sta')
+
+    with Manifest(path) as manifest:
+        assert manifest.is_done('a')
+        assert not manifest.is_done('b')
+        manifest.record('c', DONE)
+        manifest.record('d', FAILED, error='Boom')
+
+    manifest = Manifest(path)
+    assert manifest.is_done('a') and manifest.is_done('c')
+    assert manifest.statuses['d'] == {'url': 'd', 'status': FAILED, 'error': 'Boom'}
+
+
+def test_new_manifest(tmp_path):
+    path = tmp_path / 'manifest.jsonl'
+    with Manifest(path) as manifest:
+        manifest.record('a', DONE)
+    assert path.read_text() == '{"url": "a", "status": "done"}\n'
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from dea_vectoriser import morphology
+
+BACKENDS = [name for name in morphology.BACKENDS if name != 'reference']
+
+
+def random_masks():
+    rng = np.random.default_rng(42)
+    yield rng.random((61, 77)) > 0.5
+    yield rng.random((40, 129)) > 0.9
+    # Speckled blocks, so that closing and erosion both have something to do
+    yield np.kron(rng.random((12, 15)) > 0.4, np.ones((5, 5), dtype=bool)) ^ (rng.random((60, 75)) > 0.95)
+    yield np.ones((23, 9), dtype=bool)
+    yield np.zeros((23, 9), dtype=bool)
+    yield np.eye(17, 33, dtype=bool)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('erosions, dilations', [(2, 3), (1, 1), (3, 2)])
+def test_erode_dilate_matches_reference(backend, erosions, dilations):
+    for mask in random_masks():
+        expected = morphology.erode_dilate(mask, erosions, dilations, backend='reference')
+        actual = morphology.erode_dilate(mask, erosions, dilations, backend=backend)
+        np.testing.assert_array_equal(expected, actual)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('radius', [1, 2, 3, 4, 9])
+def test_close_erode_dilate_matches_reference(backend, radius):
+    for mask in random_masks():
+        expected = morphology.close_erode_dilate(mask, radius, backend='reference')
+        actual = morphology.close_erode_dilate(mask, radius, backend=backend)
+        np.testing.assert_array_equal(expected, actual)
+
+
+@pytest.mark.parametrize('radius', [1, 2, 3, 4, 9])
+def test_disk_rectangles(radius):
+    from skimage.morphology import disk
+
+    footprint = np.zeros((2 * radius + 1, 2 * radius + 1), dtype=bool)
+    for height, width in morphology.disk_rectangles(radius):
+        footprint[radius - height // 2:radius + height // 2 + 1, radius - width // 2:radius + width // 2 + 1] = True
+    np.testing.assert_array_equal(footprint, disk(radius).astype(bool))
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        morphology.get_backend('no-such-backend')
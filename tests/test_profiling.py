@@ -0,0 +1,83 @@
+import json
+import logging
+
+import pytest
+
+from dea_vectoriser import profiling
+from dea_vectoriser.cli import vector_convert
+from dea_vectoriser.profiling import count, profile_scene, stage
+from dea_vectoriser.raster_io import read_band
+from dea_vectoriser.utils import load_document_from_s3
+from dea_vectoriser.vectorisers import get_vectoriser
+
+
+def test_stages_are_ignored_outside_a_profile():
+    with stage('read'):
+        count('raster_bytes', 10)
+
+
+def test_nested_and_repeated_stages(tmp_path):
+    with profile_scene('scene', metrics=[], algorithm='test') as profile:
+        for _ in range(3):
+            with stage('outer'):
+                with stage('inner'):
+                    count('polygons', 2)
+
+    assert profile.stages['outer']['calls'] == profile.stages['inner']['calls'] == 3
+    assert profile.stages['outer']['wall_seconds'] >= profile.stages['inner']['wall_seconds']
+    assert profile.stages['outer']['peak_rss_bytes'] >= profile.stages['inner']['peak_rss_bytes'] > 0
+    assert profile.total['wall_seconds'] >= profile.stages['outer']['wall_seconds']
+    assert profile.counts == {'polygons': 6}
+
+    prometheus = profiling.to_prometheus(profile)
+    assert 'dea_vectoriser_stage_wall_seconds{algorithm="test",stage="inner"}' in prometheus
+    assert 'dea_vectoriser_scene_polygons{algorithm="test"} 6' in prometheus
+
+
+def test_profile_vector_convert(samples_on_s3, sample_data, monkeypatch, caplog, capsys, tmp_path):
+    sample_tiff = list(sample_data.glob('**/*.tif'))[0]
+    monkeypatch.setattr('dea_vectoriser.raster_io.read_band', lambda _, *args: read_band(sample_tiff, *args))
+
+    stac_url = list(sorted(obj for obj in samples_on_s3 if obj.endswith('json')))[0]
+    stac_document = load_document_from_s3(stac_url)
+
+    with caplog.at_level(logging.INFO, logger='dea_vectoriser.profiling'):
+        vector_convert(stac_document, 's3://second-bucket/', 'GeoJSON', 'wofs',
+                       metrics=['json', 'emf', 'prometheus'], metrics_dir=tmp_path)
+
+    records = [json.loads(record.getMessage()) for record in caplog.records
+               if record.name == 'dea_vectoriser.profiling']
+    assert len(records) == 1
+    profile = records[0]
+    assert profile['scene'] == stac_document['id']
+    assert profile['algorithm'] == 'wofs'
+    assert profile['outcome'] == 'converted'
+    assert set(profile['stages']) == {'read', 'morphology', 'shapes', 'reproject', 'simplify', 'write', 'upload'}
+    assert profile['counts']['polygons'] > 0
+    assert profile['counts']['vertices'] > profile['counts']['polygons']
+    assert profile['counts']['raster_bytes'] == read_band(sample_tiff).data.nbytes
+    assert profile['counts']['bytes_written'] > 0
+
+    emf = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{')]
+    assert len(emf) == 1 + len(profile['stages'])
+    assert emf[0]['_aws']['CloudWatchMetrics'][0]['Dimensions'] == [['algorithm']]
+    assert emf[0]['Polygons'] == profile['counts']['polygons']
+    assert {document.get('stage') for document in emf[1:]} == set(profile['stages'])
+
+    prometheus_files = list(tmp_path.glob('*.prom'))
+    assert len(prometheus_files) == 1
+    assert 'dea_vectoriser_stage_cpu_seconds{algorithm="wofs",stage="upload"}' in prometheus_files[0].read_text()
+
+
+@pytest.mark.parametrize('algorithm, assets', [('wofs', ['wofs_asset_url']),
+                                               ('burns', ['delta_bsi_asset_url', 'delta_ndvi_asset_url',
+                                                          'delta_nbr_asset_url', 'fmask_asset_url'])])
+def test_profile_tiled_vectorise(sample_data, algorithm, assets):
+    sample_tiff = list(sample_data.glob('**/*.tif'))[0]
+
+    with profile_scene('scene', metrics=[]) as profile:
+        get_vectoriser(algorithm).vectorise({asset: sample_tiff for asset in assets}, tile_size=256)
+
+    assert {'read', 'morphology', 'shapes', 'stitch'} <= set(profile.stages)
+    # Tiles overlap by their halos, so more is read than the whole rasters
+    assert profile.counts['raster_bytes'] >= len(assets) * read_band(sample_tiff).data.nbytes
@@ -0,0 +1,85 @@
+import mmap
+import os
+import subprocess
+import sys
+
+import boto3
+import numpy as np
+from affine import Affine
+from rasterio.crs import CRS
+
+from dea_vectoriser import raster_cache, vector_wos
+from dea_vectoriser.raster_cache import RasterCache
+from dea_vectoriser.raster_io import Raster, read_band
+from dea_vectoriser.utils import url_to_bucket_and_key
+
+
+def is_memory_mapped(array):
+    while array is not None and not isinstance(array, mmap.mmap):
+        array = array.base
+    return array is not None
+
+
+def test_rasters_are_read_once(samples_on_s3, sample_data, tmp_path, monkeypatch):
+    sample_tiff = list(sample_data.glob('**/*.tif'))[0]
+    tiff_url = [url for url in samples_on_s3 if url.endswith('.tif')][0]
+    reads = []
+    monkeypatch.setattr('dea_vectoriser.raster_io.read_band',
+                        lambda url, *args: reads.append(url) or read_band(sample_tiff, *args))
+    monkeypatch.setattr(raster_cache, '_cache', RasterCache(tmp_path))
+
+    first = vector_wos.load_wos_data(tiff_url)
+    second = vector_wos.load_wos_data(tiff_url)
+    assert reads == [tiff_url]
+    # Served memory-mapped, identical to the original
+    assert is_memory_mapped(second.wo.data)
+    original = read_band(sample_tiff)
+    assert (second.wo.data == original.data).all()
+    assert (second.crs, second.transform) == (first.crs, first.transform) == (original.crs, original.transform)
+
+    # Replacing the object changes its ETag, so it's read again
+    bucket, key = url_to_bucket_and_key(tiff_url)
+    boto3.client('s3').put_object(Bucket=bucket, Key=key, Body=sample_tiff.read_bytes() + b'\0')
+    vector_wos.load_wos_data(tiff_url)
+    assert reads == [tiff_url, tiff_url]
+
+
+def test_least_recently_used_rasters_are_evicted(tmp_path):
+    rasters = {name: tmp_path / f'{name}.tif' for name in 'abc'}
+    for path in rasters.values():
+        path.touch()
+    cache = RasterCache(tmp_path / 'cache', max_bytes=2500)
+    raster = Raster(np.zeros((30, 30), dtype='uint8'), CRS.from_epsg(32753), Affine.identity())
+
+    keys = {name: cache.key(path) for name, path in rasters.items()}
+    for name in 'ab':
+        cache.put(keys[name], raster)
+    # Use 'a' after 'b', so 'b' is the least recently used
+    cache.get(keys['a'])
+    cache.put(keys['c'], raster)
+    cache.evict(keep=keys['c'])
+
+    assert cache.get(keys['a']) is not None
+    assert cache.get(keys['b']) is None
+    assert cache.get(keys['c']) is not None
+
+
+def test_unversioned_rasters_are_not_cached(sample_data, tmp_path, monkeypatch):
+    sample_tiff = list(sample_data.glob('**/*.tif'))[0]
+    reads = []
+    monkeypatch.setattr('dea_vectoriser.raster_io.read_band',
+                        lambda url, *args: reads.append(url) or read_band(sample_tiff, *args))
+    cache = RasterCache(tmp_path)
+
+    for url in ['https://example.com/scene.tif', '/vsicurl/https://example.com/scene.tif']:
+        assert cache.key(url) is None
+        cache.open(url)
+        cache.open(url)
+        assert reads[-2:] == [url, url]
+    assert not list(tmp_path.iterdir())
+
+
+def test_cache_is_not_configured_on_import(tmp_path):
+    env = dict(os.environ, VECT_RASTER_CACHE_DIR=str(tmp_path), VECT_RASTER_CACHE_BYTES='lots')
+    check = 'from dea_vectoriser import raster_cache; assert raster_cache._cache is None'
+    subprocess.run([sys.executable, '-c', check], env=env, check=True)
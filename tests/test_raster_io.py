@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+import rasterio
+from affine import Affine
+
+from dea_vectoriser.raster_io import COG_GDAL_OPTIONS, cog_env, read_band
+
+
+def test_read_band(sample_data):
+    sample_tiff = list(sample_data.glob('**/*.tif'))[0]
+    with rasterio.open(sample_tiff) as dataset:
+        expected = dataset.read(1)
+        crs, transform = dataset.crs, dataset.transform
+
+    raster = read_band(sample_tiff, dtype=np.int16)
+    assert raster.data.dtype == np.int16
+    assert (raster.data == expected).all()
+    assert (raster.crs, raster.transform) == (crs, transform)
+
+
+@pytest.mark.parametrize('resolution_level', [1, 3])
+def test_read_band_decimated(sample_data, resolution_level):
+    sample_tiff = list(sample_data.glob('**/*.tif'))[0]
+    full = read_band(sample_tiff)
+    factor = 2 ** resolution_level
+
+    raster = read_band(sample_tiff, resolution_level=resolution_level)
+    height, width = full.data.shape
+    assert raster.data.shape == (-(-height // factor), -(-width // factor))
+    assert raster.crs == full.crs
+    assert raster.transform.almost_equals(full.transform * Affine.scale(width / raster.data.shape[1],
+                                                                        height / raster.data.shape[0]))
+    # Nearest neighbour sampling never invents values, which would change the meaning of bit flags
+    assert set(np.unique(raster.data)) <= set(np.unique(full.data))
+
+    with pytest.raises(ValueError):
+        read_band(sample_tiff, resolution_level=4)
+
+
+def test_environment_variables_override_cog_options(monkeypatch):
+    monkeypatch.setenv('GDAL_HTTP_MULTIPLEX', 'NO')
+    with cog_env() as env:
+        options = env.options
+    assert 'GDAL_HTTP_MULTIPLEX' not in options
+    assert options['GDAL_DISABLE_READDIR_ON_OPEN'] == COG_GDAL_OPTIONS['GDAL_DISABLE_READDIR_ON_OPEN']
@@ -0,0 +1,114 @@
+from concurrent import futures
+from functools import partial
+
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio
+import shapely
+import xarray as xr
+from rasterio.transform import from_origin
+
+from dea_vectoriser import vector_burnArea, vector_wos
+from dea_vectoriser.tiled import iter_tiles, vectorise_tiled
+from dea_vectoriser.vectorise import vectorise_data, vectorise_labels
+
+CRS = 'EPSG:32755'
+TRANSFORM = from_origin(500000, 6000000, 10, 10)
+
+
+def random_blobs(shape, values, count=80, seed=0):
+    """Create a raster of overlapping circles filled with randomly chosen values"""
+    rng = np.random.default_rng(seed)
+    raster = np.zeros(shape, dtype=np.asarray(values).dtype)
+    yy, xx = np.ogrid[:shape[0], :shape[1]]
+    for _ in range(count):
+        y, x = rng.integers(0, shape[0]), rng.integers(0, shape[1])
+        radius = rng.integers(2, 30)
+        raster[(yy - y) ** 2 + (xx - x) ** 2 < radius ** 2] = rng.choice(values)
+    return raster
+
+
+def write_raster(path, data):
+    with rasterio.open(path, 'w', driver='GTiff', height=data.shape[0], width=data.shape[1], count=1,
+                       dtype=data.dtype, crs=CRS, transform=TRANSFORM) as dst:
+        dst.write(data, 1)
+    return str(path)
+
+
+def assert_same_polygons(expected, actual):
+    assert sorted(expected['attribute'].unique()) == sorted(actual['attribute'].unique())
+    for label in expected['attribute'].unique():
+        # Compare topologically, since a hole touching its shell at a vertex can be written in more than one way
+        expected_polygons = sort_polygons(expected[expected['attribute'] == label].geometry)
+        actual_polygons = sort_polygons(actual[actual['attribute'] == label].geometry)
+        assert len(expected_polygons) == len(actual_polygons)
+        assert shapely.equals(expected_polygons, actual_polygons).all()
+
+
+def sort_polygons(geometry):
+    polygons = np.asarray(geometry.values)
+    return polygons[np.lexsort(np.column_stack([shapely.bounds(polygons), shapely.area(polygons)]).T)]
+
+
+@pytest.mark.parametrize('tile_size, halo', [(64, 0), (100, 5), (1000, 12)])
+def test_tiles_cover_raster(tile_size, halo):
+    covered = np.zeros((250, 300), dtype=int)
+    for core, read in iter_tiles(250, 300, tile_size, halo):
+        covered[core.toslices()] += 1
+        assert read.col_off <= core.col_off and read.row_off <= core.row_off
+        assert read.col_off + read.width <= 300 and read.row_off + read.height <= 250
+    assert (covered == 1).all()
+
+
+def test_tiled_wos_matches_whole_raster(tmp_path):
+    wo = random_blobs((300, 300), np.array([128, 64, 2], dtype=np.uint8))
+    url = write_raster(tmp_path / 'wo.tif', wo)
+
+    dilated_water, dilated_not_analysed = vector_wos.generate_raster_layers(xr.Dataset({'wo': (('y', 'x'), wo)}))
+    expected = pd.concat([vectorise_data(dilated_water, TRANSFORM, CRS, label='Water'),
+                          vectorise_data(dilated_not_analysed, TRANSFORM, CRS, label='Not_analysed')])
+
+    tiled = vectorise_tiled([url], vector_wos._tile_raster_layers, tile_size=64, halo=vector_wos.MORPHOLOGY_HALO)
+
+    assert_same_polygons(expected, tiled)
+
+
+def test_tiled_burns_matches_whole_raster(tmp_path):
+    indices = [random_blobs((200, 200), np.array([0, 0.15, 0.3], dtype=np.float32), seed=seed)
+               for seed in range(3)]
+    fmask = random_blobs((200, 200), np.array([1, 2, 3, 5], dtype=np.uint8), seed=3)
+    urls = [write_raster(tmp_path / f'{i}.tif', data) for i, data in enumerate([*indices, fmask])]
+
+    BSI, NDVI, NBR, fmask_dataset = (xr.Dataset({1: (('y', 'x'), data)}) for data in [*indices, fmask])
+    expected = pd.concat([
+        vectorise_data(vector_burnArea.generate_burn_area(BSI, NDVI, NBR), TRANSFORM, CRS, label='potential_burn'),
+        vectorise_data(vector_burnArea.create_fmask_mask(fmask_dataset), TRANSFORM, CRS, label='not_analysed'),
+        vectorise_labels(vector_burnArea.generate_burn_agreement(BSI, NDVI, NBR), TRANSFORM, CRS,
+                         labels=vector_burnArea.AGREEMENT_LABELS)])
+
+    with futures.ThreadPoolExecutor(max_workers=2) as executor:
+        tiled = vectorise_tiled(urls, partial(vector_burnArea._tile_burn_layers, executor=executor,
+                                              include_agreement=True),
+                                tile_size=48, halo=vector_burnArea.MORPHOLOGY_HALO)
+
+    assert_same_polygons(expected, tiled)
+
+
+def test_tiled_agreement_levels_are_traced_in_one_pass(tmp_path, monkeypatch):
+    indices = [random_blobs((96, 96), np.array([0, 0.15, 0.3], dtype=np.float32), seed=seed) for seed in range(3)]
+    fmask = random_blobs((96, 96), np.array([1, 2], dtype=np.uint8), seed=3)
+    urls = [write_raster(tmp_path / f'{i}.tif', data) for i, data in enumerate([*indices, fmask])]
+    shapes = rasterio.features.shapes
+    passes = []
+    monkeypatch.setattr(rasterio.features, 'shapes',
+                        lambda *args, **kwargs: passes.append(1) or shapes(*args, **kwargs))
+
+    with futures.ThreadPoolExecutor(max_workers=2) as executor:
+        tiled = vectorise_tiled(urls, partial(vector_burnArea._tile_burn_layers, executor=executor,
+                                              include_agreement=True),
+                                tile_size=48, halo=vector_burnArea.MORPHOLOGY_HALO)
+
+    # Burn area, not analysed, and all the agreement levels, for each of the four tiles
+    assert len(passes) == 3 * 4
+    assert set(vector_burnArea.AGREEMENT_LABELS.values()) <= set(tiled['attribute'])
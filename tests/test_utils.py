@@ -1,11 +1,19 @@
 import json
+import multiprocessing
+import time
+from concurrent import futures
 from pathlib import PurePosixPath
 
 import boto3
 import pytest
+from boto3.exceptions import S3UploadFailedError
+from botocore.exceptions import ClientError
 
-from dea_vectoriser.utils import upload_directory, receive_messages, output_name_from_url, asset_url_from_stac, \
-    publish_sns_message
+from dea_vectoriser import utils
+from dea_vectoriser.utils import (get_client, get_resource, MessageSender, SnsNotifier, upload_directory,
+                                  receive_messages, output_name_from_url, asset_url_from_stac, publish_sns_message,
+                                  VisibilityHeartbeat, receive_message_batches, delete_messages, MessageDeleter,
+                                  send_batch_with_retries, stac_to_msg_and_attributes)
 
 
 def test_s3_directory_upload(s3, tmp_path):
@@ -27,6 +35,14 @@ def test_s3_directory_upload(s3, tmp_path):
         assert response
 
 
+def test_s3_directory_upload_failure_is_raised(s3, tmp_path):
+    (tmp_path / "hello.txt").touch()
+    (tmp_path / "world.txt").touch()
+
+    with pytest.raises(S3UploadFailedError):
+        upload_directory(tmp_path, "missing-bucket", prefix="")
+
+
 def test_receive_multiple_sqs_messages(sqs):
     # Send 12 messages to our queue, each with single number body counting to 12
     # 10 is the magic number, we want to receive more than that
@@ -41,7 +57,7 @@ def test_receive_multiple_sqs_messages(sqs):
 
     # Test our receive_messages function
     received = set()
-    for message in receive_messages(queue_url):
+    for message in receive_messages(queue_url, wait_time_seconds=1):
         received.add(message.body)
         message.delete()
 
@@ -50,6 +66,68 @@ def test_receive_multiple_sqs_messages(sqs):
     assert expected == received
 
 
+def test_receive_message_batches_and_delete(sqs):
+    client = boto3.client("sqs")
+    queue_url = client.get_queue_url(QueueName="first-queue")['QueueUrl']
+    client.send_message_batch(QueueUrl=queue_url,
+                              Entries=[{'Id': str(i), 'MessageBody': str(i)} for i in range(10)])
+
+    batches = list(receive_message_batches(queue_url, wait_time_seconds=0, max_empty_receives=2))
+    assert len(batches) == 1
+    assert len(batches[0]) == 10
+
+    assert delete_messages(queue_url, batches[0]) == []
+    attributes = client.get_queue_attributes(
+        QueueUrl=queue_url,
+        AttributeNames=['ApproximateNumberOfMessages', 'ApproximateNumberOfMessagesNotVisible'])['Attributes']
+    assert attributes['ApproximateNumberOfMessages'] == '0'
+    assert attributes['ApproximateNumberOfMessagesNotVisible'] == '0'
+
+
+def test_receive_message_batches_yields_empty_batches(sqs):
+    client = boto3.client("sqs")
+    queue_url = client.get_queue_url(QueueName="first-queue")['QueueUrl']
+    client.send_message(QueueUrl=queue_url, MessageBody='0')
+
+    batches = list(receive_message_batches(queue_url, wait_time_seconds=0, max_empty_receives=2, yield_empty=True))
+    assert [len(batch) for batch in batches] == [1, 0, 0]
+
+
+def test_message_deleter_flushes_old_messages(sqs, monkeypatch):
+    client = boto3.client("sqs")
+    queue_url = client.get_queue_url(QueueName="first-queue")['QueueUrl']
+    client.send_message_batch(QueueUrl=queue_url, Entries=[{'Id': str(i), 'MessageBody': str(i)} for i in range(2)])
+    first, second = receive_messages(queue_url, wait_time_seconds=0)
+
+    now = [1000.0]
+    monkeypatch.setattr('dea_vectoriser.utils.time.monotonic', lambda: now[0])
+    deleter = MessageDeleter(queue_url, max_delay=30)
+    deleter.add(first)
+    assert deleter._pending == [first]
+    now[0] += 30
+    deleter.add(second)
+    assert deleter._pending == []
+
+
+def test_visibility_heartbeat(sqs):
+    sqs_resource = boto3.resource('sqs')
+    queue = sqs_resource.get_queue_by_name(QueueName='first-queue')
+    queue.send_message(MessageBody='in flight')
+
+    [message] = queue.receive_messages(MaxNumberOfMessages=1, VisibilityTimeout=1)
+    with VisibilityHeartbeat(visibility_timeout=60, interval=1) as heartbeat:
+        heartbeat.add(message)
+        time.sleep(1.5)
+        # Without the heartbeat the message would have become visible again after 1 second
+        assert queue.receive_messages(MaxNumberOfMessages=1) == []
+        heartbeat.remove(message)
+
+    message.change_visibility(VisibilityTimeout=0)
+    [message] = queue.receive_messages(MaxNumberOfMessages=1)
+    assert message.body == 'in flight'
+    message.delete()
+
+
 def test_send_sns_message(sqs, sns):
     MSG_TEXT = 'Hello world!'
     sns_client = boto3.client('sns')
@@ -63,7 +141,7 @@ def test_send_sns_message(sqs, sns):
     )
     publish_sns_message(topic_arn, MSG_TEXT)
 
-    messages = list(receive_messages(queue.url))
+    messages = list(receive_messages(queue.url, wait_time_seconds=1))
     assert len(messages) == 1
     for message in messages:
         body = json.loads(message.body)
@@ -97,3 +175,118 @@ def test_load_and_process_stac(sample_data):
     s3_url = asset_url_from_stac(message, asset_type='water')
     assert s3_url is not None
     assert s3_url.startswith("s3://")
+
+
+def test_clients_are_shared_per_process(s3):
+    client = get_client('s3')
+    assert get_client('s3') is client
+    with futures.ThreadPoolExecutor(max_workers=2) as executor:
+        assert all(shared is client for shared in executor.map(lambda _: get_client('s3'), range(4)))
+        # Resources aren't thread safe, so each thread has its own
+        assert executor.submit(get_resource, 'sqs').result() is not get_resource('sqs')
+
+    # Forked worker processes start without any clients
+    with futures.ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('fork')) as executor:
+        assert executor.submit(count_cached_clients).result() == 0
+
+
+def count_cached_clients():
+    return len(utils._clients)
+
+
+def test_message_sender_retries_failed_entries(sqs, monkeypatch):
+    queue_url = boto3.client("sqs").get_queue_url(QueueName="first-queue")['QueueUrl']
+    client = get_client('sqs')
+    send_message_batch = client.send_message_batch
+    requests = []
+
+    def flaky_send_message_batch(QueueUrl, Entries):
+        requests.append(len(Entries))
+        if len(requests) > 1:
+            return send_message_batch(QueueUrl=QueueUrl, Entries=Entries)
+        # The first entry fails temporarily and the second is rejected, the rest succeed
+        response = send_message_batch(QueueUrl=QueueUrl, Entries=Entries[2:])
+        response['Failed'] = [{'Id': Entries[0]['Id'], 'SenderFault': False, 'Code': 'ServiceUnavailable'},
+                              {'Id': Entries[1]['Id'], 'SenderFault': True, 'Code': 'InvalidParameterValue'}]
+        return response
+
+    monkeypatch.setattr(client, 'send_message_batch', flaky_send_message_batch)
+
+    with MessageSender(queue_url, backoff=0) as sender:
+        for i in range(12):
+            sender.add(str(i))
+
+    # One batch of 10 and its retried entry, then a batch of the remaining 2
+    assert requests == [10, 1, 2]
+    assert sender.sent == 11
+    assert sender.failed == [('1', 'InvalidParameterValue')]
+    assert sorted(message.body for message in receive_messages(queue_url, wait_time_seconds=1)) == \
+        sorted(str(i) for i in range(12) if i != 1)
+
+
+def test_message_sender_leaves_out_missing_attributes(sqs):
+    queue_url = boto3.client('sqs').get_queue_url(QueueName='first-queue')['QueueUrl']
+    # No odc:product or dea:dataset_maturity property
+    stac_document = {'id': 'scene', 'properties': {'datetime': '2021-01-01T00:00:00Z'}}
+
+    with MessageSender(queue_url) as sender:
+        sender.add(*stac_to_msg_and_attributes(stac_document))
+
+    assert (sender.sent, sender.failed) == (1, [])
+    [message] = boto3.client('sqs').receive_message(QueueUrl=queue_url, MessageAttributeNames=['All'])['Messages']
+    assert sorted(message['MessageAttributes']) == ['action', 'datetime']
+
+
+def test_sns_notifier_publishes_batches_in_the_background(sqs, sns, monkeypatch):
+    topic_arn = boto3.client('sns').list_topics()['Topics'][0]['TopicArn']
+    client = get_client('sns')
+    publish_batch = client.publish_batch
+    requests = []
+
+    def flaky_publish_batch(TopicArn, PublishBatchRequestEntries):
+        requests.append(len(PublishBatchRequestEntries))
+        if len(requests) > 1:
+            return publish_batch(TopicArn=TopicArn, PublishBatchRequestEntries=PublishBatchRequestEntries)
+        # The first entry fails temporarily, the rest succeed
+        response = publish_batch(TopicArn=TopicArn, PublishBatchRequestEntries=PublishBatchRequestEntries[1:])
+        response['Failed'] = [{'Id': PublishBatchRequestEntries[0]['Id'], 'SenderFault': False,
+                               'Code': 'InternalError'}]
+        return response
+
+    monkeypatch.setattr(client, 'publish_batch', flaky_publish_batch)
+
+    with SnsNotifier(topic_arn, backoff=0, linger=0.5) as notifier:
+        start = time.monotonic()
+        for i in range(12):
+            notifier.add(f's3://bucket/{i}', {'feature_count': {'DataType': 'Number', 'StringValue': str(i)}})
+        # Adding never waits for publishing
+        assert time.monotonic() - start < 0.1
+
+    # A full batch of 10 and its retried entry, then the remaining 2 after lingering
+    assert requests == [10, 1, 2]
+    assert notifier.sent == 12
+    assert notifier.failed == []
+
+
+def test_send_batch_with_retries(caplog):
+    responses = [ClientError({'Error': {'Code': 'Throttling'}}, 'PublishBatch'),
+                 {'Successful': [{'Id': '0'}],
+                  'Failed': [{'Id': '1', 'SenderFault': True, 'Code': 'InvalidParameter', 'Message': 'Too big'},
+                             {'Id': '2', 'SenderFault': False, 'Code': 'InternalError'}]},
+                 {'Successful': [{'Id': '2'}]}]
+    requests = []
+
+    def send(entries):
+        requests.append([entry['Id'] for entry in entries])
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    sent, failed = send_batch_with_retries(send, [{'Message': str(i)} for i in range(3)], 'SNS message', backoff=0)
+
+    # The whole request is retried after an error, then only the entry which failed temporarily
+    assert requests == [['0', '1', '2'], ['0', '1', '2'], ['2']]
+    assert sent == 2
+    assert failed == [({'Id': '1', 'Message': '1'}, 'Too big')]
+    assert 'Unable to send SNS message: Too big' in caplog.text
@@ -1,14 +1,27 @@
+import json
+import threading
+from io import BytesIO
 from pathlib import Path
 
 import boto3
+import fiona
 import geopandas
+import numpy as np
+import pytest
+import shapely
 import xarray as xr
+from affine import Affine
+from scipy import ndimage
 from shapely.geometry import Point
 
-from dea_vectoriser import vector_wos
+from dea_vectoriser import vector_burnArea, vector_wos
+from dea_vectoriser import cli
 from dea_vectoriser.cli import vector_convert
-from dea_vectoriser.utils import load_document_from_s3
-from dea_vectoriser.vectorise import save_vector_to_s3
+from dea_vectoriser.raster_io import read_band
+from dea_vectoriser.utils import asset_url_from_stac, load_document_from_s3, url_to_bucket_and_key
+from dea_vectoriser.vectorisers import WofsVectoriser
+from dea_vectoriser.vectorise import (OUTPUT_FORMATS, crs_scale, generalise, save_vector_to_s3, simplify_to_crs,
+                                      vectorise_data, vectorise_labels)
 
 
 def test_create_vectors(sample_data, tmp_path):
@@ -26,14 +39,92 @@ def test_create_vectors(sample_data, tmp_path):
     assert Path(filename).exists()
 
 
+def test_wos_preview(sample_data):
+    raster_asset_urls = {'wofs_asset_url': list(sample_data.glob('**/*.tif'))[0]}
+
+    full = vector_wos.vectorise_wos(raster_asset_urls)
+    preview = vector_wos.vectorise_wos(raster_asset_urls, resolution_level=1, tile_size=256)
+
+    assert preview.crs == full.crs
+    assert set(preview['attribute']) == set(full['attribute'])
+    assert shapely.get_num_coordinates(preview.geometry.to_numpy()).sum() < \
+        shapely.get_num_coordinates(full.geometry.to_numpy()).sum()
+    # A coarser outline of the same water
+    water, preview_water = (vectors[vectors['attribute'] == 'Water'].unary_union for vectors in (full, preview))
+    assert water.symmetric_difference(preview_water).area / water.area < 0.25
+
+
+def test_classify_wos():
+    wo = np.arange(256, dtype=np.uint8)
+
+    classes = vector_wos.classify_wos(wo)
+
+    assert list(wo[classes == vector_wos.WATER]) == [128]
+    assert list(wo[classes == vector_wos.DRY]) == [0, 1, 2, 8, 130, 142]
+    assert (classes == vector_wos.NOT_ANALYSED).sum() == 256 - 7
+
+
+def test_load_burn_layers_concurrently(monkeypatch):
+    rng = np.random.default_rng(0)
+    rasters = {
+        'delta_bsi_asset_url': xr.Dataset({1: (('y', 'x'), rng.random((50, 60), dtype=np.float32) * 0.3)}),
+        'delta_ndvi_asset_url': xr.Dataset({1: (('y', 'x'), rng.random((50, 60), dtype=np.float32) * 0.3)}),
+        'delta_nbr_asset_url': xr.Dataset({1: (('y', 'x'), rng.random((50, 60), dtype=np.float32) * 0.3)}),
+        'fmask_asset_url': xr.Dataset({1: (('y', 'x'), rng.integers(0, 6, (50, 60), dtype=np.uint8))}),
+    }
+    # Every load waits until all four are in progress, so this only passes when they run at the same time
+    all_loading = threading.Barrier(len(rasters), timeout=10)
+
+    def load_burn_data(url, resolution_level=0):
+        all_loading.wait()
+        return rasters[url]
+
+    monkeypatch.setattr(vector_burnArea, 'load_burn_data', load_burn_data)
+    thresholds = []
+
+    def threshold_Delta_dataset(burn_dataset, threshold, greater, **options):
+        thresholds.append(threshold)
+        return original_threshold_Delta_dataset(burn_dataset, threshold=threshold, greater=greater, **options)
+
+    original_threshold_Delta_dataset = vector_burnArea.threshold_Delta_dataset
+    monkeypatch.setattr(vector_burnArea, 'threshold_Delta_dataset', threshold_Delta_dataset)
+
+    burn_area, agreement, fmask_mask, fmask_raster = vector_burnArea.load_burn_layers({url: url for url in rasters},
+                                                                                      include_agreement=True)
+    # The 0.1 NDVI and NBR masks are shared by both products, only BSI is thresholded twice
+    assert sorted(thresholds) == [0.1, 0.1, 0.1, 0.2]
+
+    BSI, NDVI, NBR = (rasters[key] for key in ('delta_bsi_asset_url', 'delta_ndvi_asset_url', 'delta_nbr_asset_url'))
+    assert (burn_area == vector_burnArea.generate_burn_area(BSI, NDVI, NBR)).all()
+    expected_agreement = sum(original_threshold_Delta_dataset(dataset, threshold=threshold, greater=True)
+                             for dataset, threshold in [(BSI, 0.2), (NDVI, 0.1), (NBR, 0.1)])
+    assert (agreement == expected_agreement).all()
+    assert (fmask_mask == vector_burnArea.create_fmask_mask(rasters['fmask_asset_url'])).all()
+    assert fmask_raster is rasters['fmask_asset_url']
+
+
+def test_vectorise_labels():
+    rng = np.random.default_rng(0)
+    levels = rng.integers(0, 4, (40, 50), dtype=np.uint8)
+    labels = {1: 'one', 3: 'three'}
+    transform = Affine(10, 0, 500000, 0, -10, 6000000)
+
+    vectors = vectorise_labels(levels, transform, 'EPSG:32755', labels)
+
+    assert list(vectors['attribute'].cat.categories) == ['one', 'three']
+    for value, label in labels.items():
+        expected = vectorise_data(levels == value, transform, 'EPSG:32755', label=label)
+        actual = vectors[vectors['attribute'] == label]
+        assert sorted(expected.geometry.normalize().to_wkt()) == sorted(actual.geometry.normalize().to_wkt())
+
+
 def test_convert_from_s3(samples_on_s3, sample_data, monkeypatch):
     """
     Test reading raster data from s3:// and writing vector data back to s3://
     """
     sample_tiff = list(sample_data.glob('**/*.tif'))[0]
     
-    sample_xarray = xr.open_rasterio(sample_tiff)
-    monkeypatch.setattr('dea_vectoriser.vector_wos.xr.open_rasterio', lambda _: sample_xarray)
+    monkeypatch.setattr('dea_vectoriser.raster_io.read_band', lambda _, *args: read_band(sample_tiff, *args))
 
     stac_url = list(sorted(obj for obj in samples_on_s3 if obj.endswith('json')))[0]
     stac_document = load_document_from_s3(stac_url)
@@ -49,6 +140,35 @@ def test_convert_from_s3(samples_on_s3, sample_data, monkeypatch):
     assert response['Contents'][0]['Key'] == expected_output_key
 
 
+def test_convert_skip_existing(samples_on_s3, sample_data, monkeypatch):
+    sample_tiff = list(sample_data.glob('**/*.tif'))[0]
+    monkeypatch.setattr('dea_vectoriser.raster_io.read_band', lambda _, *args: read_band(sample_tiff, *args))
+    conversions = []
+    monkeypatch.setattr(WofsVectoriser, 'vectorise',
+                        lambda self, urls: conversions.append(urls) or vector_wos.vectorise_wos(urls))
+
+    stac_url = list(sorted(obj for obj in samples_on_s3 if obj.endswith('json')))[0]
+    stac_document = load_document_from_s3(stac_url)
+
+    def convert(skip_existing):
+        return vector_convert(stac_document, 's3://second-bucket/', 'GeoJSON', 'wofs', skip_existing=skip_existing)
+
+    written_url = convert(cli.SKIP_UNCHANGED)
+    assert convert(cli.SKIP_UNCHANGED) == written_url
+    assert convert(cli.SKIP_EXISTS) == written_url
+    assert len(conversions) == 1
+
+    # Replacing the input raster changes its ETag, so only SKIP_EXISTS still skips it
+    bucket, key = url_to_bucket_and_key(asset_url_from_stac(stac_document, 'water'))
+    boto3.client('s3').put_object(Bucket=bucket, Key=key, Body=sample_tiff.read_bytes() + b'\0')
+    assert convert(cli.SKIP_EXISTS) == written_url
+    assert len(conversions) == 1
+    assert convert(cli.SKIP_UNCHANGED) == written_url
+    assert len(conversions) == 2
+    assert convert(cli.SKIP_NEVER) == written_url
+    assert len(conversions) == 3
+
+
 def test_save_vector_to_s3(s3):
     d = {'col1': ['name1', 'name2'], 'geometry': [Point(1, 2), Point(2, 1)]}
 
@@ -64,3 +184,149 @@ def test_save_vector_to_s3(s3):
     assert response['Contents'][0]['Key'] == 'part/more/stuff/example_filename.gpkg'
 #    response = client.head_object(Bucket='first-bucket', Key=)
 #    assert response
+
+
+def test_save_geojson_to_s3_from_memory(s3, monkeypatch):
+    gdf = geopandas.GeoDataFrame({'col1': ['name1', 'name2'], 'geometry': [Point(1, 2), Point(2, 1)]},
+                                 crs="EPSG:4326")
+
+    def no_temporary_directory():
+        raise AssertionError('GeoJSON should be uploaded without writing to disk')
+
+    monkeypatch.setattr('dea_vectoriser.vectorise.TemporaryDirectory', no_temporary_directory)
+
+    written_url = save_vector_to_s3(gdf, dest_prefix='s3://first-bucket/part', filename='example_filename',
+                                    output_format='GeoJSON')
+
+    assert written_url == 's3://first-bucket/part/example_filename.json'
+    body = boto3.client('s3').get_object(Bucket='first-bucket', Key='part/example_filename.json')['Body']
+    assert json.load(body)['features'][1]['properties']['col1'] == 'name2'
+
+
+@pytest.mark.parametrize('output_format', ['FlatGeobuf', 'GeoParquet'])
+def test_save_cloud_optimised_formats_to_s3(s3, output_format):
+    if output_format == 'GeoParquet':
+        pytest.importorskip('pyarrow')
+    rng = np.random.default_rng(0)
+    gdf = geopandas.GeoDataFrame({'attribute': ['Water'] * 200},
+                                 geometry=geopandas.points_from_xy(rng.random(200), rng.random(200)).buffer(0.01),
+                                 crs="EPSG:3577")
+
+    written_url = save_vector_to_s3(gdf, dest_prefix='s3://first-bucket/part', filename='example_filename',
+                                    output_format=output_format)
+
+    bucket, key = written_url[len('s3://'):].split('/', 1)
+    body = BytesIO(boto3.client('s3').get_object(Bucket=bucket, Key=key)['Body'].read())
+    result = geopandas.read_parquet(body) if output_format == 'GeoParquet' else geopandas.read_file(body)
+    assert len(result) == 200
+    # Features are stored in Hilbert curve order, so that nearby features can be read together
+    assert sorted(result.geometry.normalize().to_wkt()) == sorted(gdf.geometry.normalize().to_wkt())
+    assert (np.diff(result.geometry.hilbert_distance(total_bounds=gdf.total_bounds)) >= 0).all()
+
+
+def test_simplify_in_native_crs(sample_data):
+    sample_tiff = list(sample_data.glob('**/*.tif'))[0]
+    raster = vector_wos.load_wos_data(sample_tiff)
+    water, _ = vector_wos.generate_raster_layers(raster)
+    vectors = vectorise_data(water, raster.transform, raster.crs, label='Water')
+
+    reprojected_first = simplify_to_crs(vectors, 10)
+    simplified_first = simplify_to_crs(vectors, 10, native=True)
+
+    assert simplified_first.crs == reprojected_first.crs == 'EPSG:3577'
+    assert list(simplified_first['attribute']) == list(vectors['attribute'])
+    assert abs(crs_scale(vectors, 'epsg:3577') - 1) < 0.01
+    # Only vertices on the edge of the tolerance may differ
+    difference = simplified_first.symmetric_difference(reprojected_first, align=True).area.sum()
+    assert difference / reprojected_first.area.sum() < 0.01
+
+
+def test_generalise(sample_data):
+    raster_urls = {'wofs_asset_url': list(sample_data.glob('**/*.tif'))[0]}
+
+    vectors, levels = WofsVectoriser().vectorise_pyramid(raster_urls, [20, 100])
+
+    assert list(levels) == ['simplified_20m', 'simplified_100m']
+    vertices = [shapely.get_num_coordinates(level.geometry.to_numpy()).sum()
+                for level in [vectors, *levels.values()]]
+    assert vertices[0] > vertices[1] > vertices[2]
+    for level in levels.values():
+        assert level.crs == vectors.crs
+        assert set(level['attribute']) == set(vectors['attribute'])
+        assert set(level['Observed_date']) == set(vectors['Observed_date'])
+        assert level.geometry.is_valid.all()
+
+
+def test_generalise_keeps_shared_edges():
+    # Smooth blobs of three classes, so neighbouring polygons have long staircase boundaries to simplify
+    field = ndimage.gaussian_filter(np.random.default_rng(0).random((60, 60)), 4)
+    classes = np.digitize(field, np.quantile(field, [1 / 3, 2 / 3])).astype('uint8') + 1
+    vectors = vectorise_labels(xr.DataArray(classes, dims=('y', 'x')), Affine(25, 0, 0, 0, -25, 1500), 'EPSG:3577',
+                               {1: 'a', 2: 'b', 3: 'c'})
+
+    level = generalise(vectors, [40], coverages=[{'a', 'b', 'c'}])['simplified_40m']
+
+    original = vectors.geometry.to_numpy()
+    simplified = level.geometry.to_numpy()
+    assert shapely.get_num_coordinates(simplified).sum() < shapely.get_num_coordinates(original).sum() / 2
+    assert shapely.is_valid(simplified).all()
+    # No gaps or overlaps opened up between neighbours
+    union_area = shapely.area(shapely.union_all(simplified))
+    assert shapely.area(simplified).sum() == pytest.approx(union_area)
+    # ...apart from corners of the outer boundary being cut
+    assert union_area == pytest.approx(shapely.area(original).sum(), rel=1e-3)
+    # Neighbours still share a boundary, rather than each having their own simplified copy of it
+    left, right = shapely.STRtree(simplified).query(simplified, predicate='intersects')
+    neighbours = left < right
+    shared = shapely.intersection(simplified[left[neighbours]], simplified[right[neighbours]])
+    assert neighbours.any()
+    assert (shapely.length(shared) > 0).all()
+    assert shapely.area(shared) == pytest.approx(0)
+
+
+@pytest.mark.parametrize('output_format', ['GPKG', 'GeoJSON'])
+def test_save_vector_layers_to_s3(s3, output_format):
+    gdf = geopandas.GeoDataFrame({'attribute': ['Water', 'Not_analysed']},
+                                 geometry=[Point(0, 0).buffer(100), Point(500, 0).buffer(100)], crs='EPSG:3577')
+    levels = generalise(gdf, [50])
+
+    written_url = save_vector_to_s3(gdf, dest_prefix='s3://first-bucket/part', filename='example_filename',
+                                    output_format=output_format, layers=levels)
+
+    client = boto3.client('s3')
+    keys = sorted(obj['Key'] for obj in client.list_objects_v2(Bucket='first-bucket')['Contents'])
+    if output_format == 'GPKG':
+        assert keys == ['part/example_filename.gpkg']
+        body = client.get_object(Bucket='first-bucket', Key=keys[0])['Body'].read()
+        assert fiona.listlayers(BytesIO(body)) == ['example_filename', 'simplified_50m']
+        level = geopandas.read_file(BytesIO(body), layer='simplified_50m')
+    else:
+        assert keys == ['part/example_filename.json', 'part/example_filename_simplified_50m.json']
+        level = geopandas.read_file(client.get_object(Bucket='first-bucket', Key=keys[1])['Body'])
+    assert written_url == 's3://first-bucket/part/example_filename' + OUTPUT_FORMATS[output_format]
+    assert list(level['attribute']) == ['Water', 'Not_analysed']
+    assert (shapely.get_num_coordinates(level.geometry.to_numpy()) <
+            shapely.get_num_coordinates(gdf.geometry.to_numpy())).all()
+
+
+def test_notification_attributes(sample_data):
+    stac_document = json.loads(sorted(sample_data.glob('**/*.json'))[0].read_text())
+    vector = geopandas.GeoDataFrame(geometry=[Point(1500000, -3900000).buffer(100),
+                                              Point(1501000, -3901000).buffer(100)], crs='EPSG:3577')
+
+    message, attributes = cli.notification(stac_document, vector, 's3://bucket/output.gpkg', 'wofs')
+
+    assert message == 's3://bucket/output.gpkg'
+    assert attributes['product'] == {'DataType': 'String', 'StringValue': stac_document['properties']['odc:product']}
+    assert attributes['algorithm']['StringValue'] == 'wofs'
+    assert attributes['feature_count'] == {'DataType': 'Number', 'StringValue': '2'}
+    west, south, east, north = json.loads(attributes['bbox']['StringValue'])
+    assert 140 < west < east < 150 and -40 < south < north < -30
+
+    assert 'resolution_level' not in attributes
+
+    _, attributes = cli.notification(stac_document, vector.iloc[:0], 's3://bucket/output.gpkg', 'wofs')
+    assert 'bbox' not in attributes
+
+    _, attributes = cli.notification(stac_document, vector, 's3://bucket/output_preview4x.gpkg', 'wofs', 2)
+    assert attributes['resolution_level'] == {'DataType': 'Number', 'StringValue': '2'}
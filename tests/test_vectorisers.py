@@ -0,0 +1,79 @@
+import json
+from pathlib import PurePosixPath
+
+import geopandas
+import pytest
+
+from dea_vectoriser import vectorisers
+from dea_vectoriser.utils import VectoriserException
+from dea_vectoriser.vectorisers import (BurnsVectoriser, Vectoriser, VECTORISERS, WofsVectoriser, get_vectoriser,
+                                        plan_workers, register_vectoriser)
+
+
+def test_builtin_vectorisers_are_registered():
+    assert isinstance(get_vectoriser('wofs'), WofsVectoriser)
+    assert isinstance(get_vectoriser('burns'), BurnsVectoriser)
+
+    with pytest.raises(VectoriserException):
+        get_vectoriser('no-such-algorithm')
+
+
+def test_asset_urls_and_output_name(sample_data):
+    stac_path = sorted(sample_data.glob('**/*.json'))[0]
+    stac_document = json.loads(stac_path.read_text())
+    wofs = get_vectoriser('wofs')
+
+    raster_urls = wofs.asset_urls(stac_document)
+    assert list(raster_urls) == ['wofs_asset_url']
+    assert raster_urls['wofs_asset_url'].endswith('.tif')
+
+    relative_path, filename = wofs.output_name(stac_document)
+    assert isinstance(relative_path, PurePosixPath)
+    assert filename
+    assert wofs.output_name(stac_document, resolution_level=2) == (relative_path, f'{filename}_preview4x')
+
+    with pytest.raises(VectoriserException):
+        get_vectoriser('burns').asset_urls(stac_document)
+
+
+def test_plan_workers(caplog):
+    wofs = get_vectoriser('wofs')
+    estimate = wofs.memory_estimate()
+
+    assert plan_workers(wofs, 4, available_memory=10 * estimate) == 4
+    assert not caplog.records
+    assert plan_workers(wofs, 4, available_memory=2 * estimate) == 2
+    # Reducing the workers is always logged
+    assert 'Using 2 workers rather than 4' in caplog.records[-1].getMessage()
+    assert plan_workers(wofs, 4, available_memory=estimate // 2) == 1
+    # Tiles bound the memory needed, whatever the size of the scene
+    assert wofs.memory_estimate(tile_size=1024) < estimate
+    assert plan_workers(wofs, 4, tile_size=1024, available_memory=2 * estimate) == 4
+    # As do previews, at a sixteenth of the pixels for each level
+    assert wofs.memory_estimate(resolution_level=2) == pytest.approx(estimate / 16, rel=0.01)
+    assert plan_workers(wofs, 4, available_memory=2 * estimate, resolution_level=1) == 4
+
+
+def test_register_custom_vectoriser(monkeypatch):
+    monkeypatch.setattr(vectorisers, 'VECTORISERS', dict(VECTORISERS))
+
+    @register_vectoriser
+    class SerialVectoriser(Vectoriser):
+        name = 'serial'
+        assets = {'input_url': 'water'}
+        output_asset = 'water'
+        parallel_safe = False
+
+        def vectorise(self, raster_urls, **options):
+            return geopandas.GeoDataFrame()
+
+    assert isinstance(get_vectoriser('serial'), SerialVectoriser)
+    assert plan_workers(get_vectoriser('serial'), 8) == 1
+
+
+def test_vectorisers_must_implement_vectorise():
+    class Incomplete(Vectoriser):
+        name = 'incomplete'
+
+    with pytest.raises(TypeError):
+        register_vectoriser(Incomplete)